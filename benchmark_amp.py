@@ -0,0 +1,113 @@
+# coding=utf-8
+""" Loss-curve parity and timing of the `--amp` modes against fp32 training.
+
+Trains a small randomly initialised token classifier on fixed synthetic batches, once in fp32 and once per
+mixed precision mode, with the optimizer, scaler / unscale / clip / step sequence and helpers of the adapter training loops.
+Exits non-zero if a loss curve leaves the tolerance band around the fp32 one.
+"""
+
+import argparse
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForTokenClassification
+
+from utils_train import amp_autocast, amp_grad_scaler, build_optimizer, clip_grad_norm_
+
+
+def make_batches(args, generator):
+    batches = []
+    for _ in range(args.num_batches):
+        lengths = torch.randint(args.seq_length // 4, args.seq_length + 1, (args.batch_size,), generator=generator)
+        attention_mask = (torch.arange(args.seq_length)[None, :] < lengths[:, None]).long()
+        input_ids = torch.randint(5, args.vocab_size, (args.batch_size, args.seq_length), generator=generator)
+        # Learnable labels: a fixed function of the token id
+        labels = (input_ids % args.num_labels).masked_fill(attention_mask == 0, -100)
+        batches.append((input_ids * attention_mask + (1 - attention_mask), attention_mask, labels))
+    return batches
+
+
+def train_curve(args, amp, batches):
+    args.amp = amp
+    torch.manual_seed(args.seed)
+    config = AutoConfig.for_model(
+        "xlm-roberta",
+        vocab_size=args.vocab_size,
+        hidden_size=args.hidden_size,
+        num_hidden_layers=args.num_layers,
+        num_attention_heads=4,
+        intermediate_size=4 * args.hidden_size,
+        max_position_embeddings=args.seq_length + 2,
+        num_labels=args.num_labels,
+    )
+    model = AutoModelForTokenClassification.from_config(config).to(args.device)
+    optimizer, params = build_optimizer(model, args)
+    scaler = amp_grad_scaler(args)
+
+    losses = []
+    start = time.perf_counter()
+    model.train()
+    for step in range(args.steps):
+        input_ids, attention_mask, labels = (t.to(args.device) for t in batches[step % len(batches)])
+        with amp_autocast(args):
+            loss = model(input_ids, attention_mask=attention_mask, labels=labels)[0]
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        clip_grad_norm_(params, args.max_grad_norm)
+        scaler.step(optimizer)
+        scaler.update()
+        model.zero_grad()
+        losses.append(loss.item())
+    return losses, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", default="", type=str, help="Defaults to bf16 on CPU and fp16,bf16 on CUDA.")
+    parser.add_argument("--steps", default=60, type=int)
+    parser.add_argument("--num_batches", default=8, type=int)
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--seq_length", default=64, type=int)
+    parser.add_argument("--vocab_size", default=1000, type=int)
+    parser.add_argument("--hidden_size", default=128, type=int)
+    parser.add_argument("--num_layers", default=2, type=int)
+    parser.add_argument("--num_labels", default=9, type=int)
+    parser.add_argument("--learning_rate", default=1e-3, type=float)
+    parser.add_argument("--weight_decay", default=0.0, type=float)
+    parser.add_argument("--adam_epsilon", default=1e-8, type=float)
+    parser.add_argument("--max_grad_norm", default=1.0, type=float)
+    parser.add_argument("--window", default=10, type=int, help="Losses are compared as means over this many steps.")
+    parser.add_argument("--tolerance", default=0.05, type=float, help="Allowed relative difference to fp32.")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--no_cuda", action="store_true")
+    args = parser.parse_args()
+
+    args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    modes = args.modes.split(",") if args.modes else (["fp16", "bf16"] if args.device.type == "cuda" else ["bf16"])
+    batches = make_batches(args, torch.Generator().manual_seed(args.seed))
+
+    reference, reference_time = train_curve(args, "off", batches)
+    windows = range(0, args.steps, args.window)
+    reference_means = [sum(reference[i : i + args.window]) / len(reference[i : i + args.window]) for i in windows]
+
+    print("{:<6} {:>10} {:>10} {:>12} {:>9} {:>7}".format("amp", "time (s)", "speedup", "final loss", "max diff", "parity"))
+    print("{:<6} {:>10.2f} {:>10} {:>12.4f} {:>9} {:>7}".format("off", reference_time, "", reference_means[-1], "", ""))
+    failures = 0
+    for mode in modes:
+        losses, elapsed = train_curve(args, mode, batches)
+        means = [sum(losses[i : i + args.window]) / len(losses[i : i + args.window]) for i in windows]
+        max_diff = max(abs(m - r) / max(abs(r), 1e-6) for m, r in zip(means, reference_means))
+        parity = max_diff <= args.tolerance
+        failures += not parity
+        print(
+            "{:<6} {:>10.2f} {:>9.2f}x {:>12.4f} {:>9.4f} {:>7}".format(
+                mode, elapsed, reference_time / max(elapsed, 1e-9), means[-1], max_diff, "ok" if parity else "FAIL"
+            )
+        )
+
+    if failures:
+        raise SystemExit("{} amp mode(s) diverged from the fp32 loss curve".format(failures))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# coding=utf-8
+""" Scaling of the sharded multi-process feature conversion (`--preprocessing_num_workers`) from 1 to N cores.
+
+Converts one CoNLL file with an increasing number of worker processes and checks that every run produces
+exactly the features of the serial conversion, in the same order.
+"""
+
+import argparse
+import os
+import time
+
+from transformers import AutoTokenizer
+
+from benchmark_features import TASK_UTILS, conversion_kwargs, same_features
+from utils_features import convert_examples_to_features_fast, convert_examples_to_features_parallel
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="data-pos/en_ewt", type=str)
+    parser.add_argument("--mode", default="train", type=str)
+    parser.add_argument("--task", default="pos", type=str, choices=list(TASK_UTILS.keys()))
+    parser.add_argument("--model_type", default="roberta", type=str)
+    parser.add_argument("--tokenizer_name", default="xlm-roberta-base", type=str)
+    parser.add_argument("--labels", default="", type=str, help="Path to a file containing all labels.")
+    parser.add_argument("--max_seq_length", default=164, type=int)
+    parser.add_argument(
+        "--num_workers",
+        default="",
+        type=str,
+        help="Comma separated worker counts, defaults to powers of two up to the number of cores.",
+    )
+    args = parser.parse_args()
+
+    if args.num_workers:
+        worker_counts = [int(n) for n in args.num_workers.split(",")]
+    else:
+        worker_counts = [1]
+        while worker_counts[-1] * 2 <= os.cpu_count():
+            worker_counts.append(worker_counts[-1] * 2)
+
+    task_utils = TASK_UTILS[args.task]
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=True)
+    examples = task_utils.read_examples_from_file(args.data_dir, args.mode)
+    labels = task_utils.get_labels(args.labels)
+    # Labels not in the label file would raise a KeyError in every run, add them here
+    labels = labels + sorted({label for example in examples for label in example.labels} - set(labels))
+    kwargs = conversion_kwargs(args, tokenizer)
+
+    print("{} {}: {} examples, {} cores".format(args.data_dir, args.mode, len(examples), os.cpu_count()))
+    print("{:>8} {:>10} {:>8} {:>7}".format("workers", "time (s)", "speedup", "parity"))
+    serial_features, serial_time = None, None
+    failures = 0
+    for num_workers in worker_counts:
+        start = time.perf_counter()
+        features = convert_examples_to_features_parallel(
+            convert_examples_to_features_fast,
+            examples,
+            labels,
+            args.max_seq_length,
+            tokenizer,
+            num_workers=num_workers,
+            **kwargs,
+        )
+        elapsed = time.perf_counter() - start
+        if serial_features is None:
+            serial_features, serial_time = features, elapsed
+        parity = same_features(serial_features, features)
+        failures += not parity
+        print(
+            "{:>8} {:>10.2f} {:>7.2f}x {:>7}".format(
+                num_workers, elapsed, serial_time / max(elapsed, 1e-9), "ok" if parity else "FAIL"
+            )
+        )
+
+    if failures:
+        raise SystemExit("{} worker count(s) produced different features".format(failures))
+
+
+if __name__ == "__main__":
+    main()
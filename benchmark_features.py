@@ -0,0 +1,105 @@
+# coding=utf-8
+""" Parity check and timing of the word-by-word vs. batched fast-tokenizer feature conversion. """
+
+import argparse
+import glob
+import os
+import time
+
+from transformers import AutoTokenizer
+
+import utils_ner
+import utils_pos
+from utils_features import convert_examples_to_features_fast
+
+
+TASK_UTILS = {
+    "ner": utils_ner,
+    "pos": utils_pos,
+}
+
+
+def conversion_kwargs(args, tokenizer):
+    return dict(
+        cls_token_at_end=bool(args.model_type in ["xlnet"]),
+        cls_token=tokenizer.cls_token,
+        cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
+        sep_token=tokenizer.sep_token,
+        sep_token_extra=bool(args.model_type in ["roberta"]),
+        pad_on_left=bool(args.model_type in ["xlnet"]),
+        pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+        pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+    )
+
+
+def same_features(features, fast_features):
+    if len(features) != len(fast_features):
+        return False
+    for f, g in zip(features, fast_features):
+        if f.input_ids != g.input_ids or f.input_mask != g.input_mask:
+            return False
+        if f.segment_ids != g.segment_ids or f.label_ids != g.label_ids:
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_root", default="data", type=str, help="Directory containing one sub-directory per language.")
+    parser.add_argument("--task", default="ner", type=str, choices=list(TASK_UTILS.keys()))
+    parser.add_argument("--model_type", default="roberta", type=str)
+    parser.add_argument("--tokenizer_name", default="xlm-roberta-base", type=str)
+    parser.add_argument("--labels", default="", type=str, help="Path to a file containing all labels.")
+    parser.add_argument("--max_seq_length", default=164, type=int)
+    parser.add_argument("--modes", default="train,dev,test", type=str)
+    parser.add_argument("--batch_size", default=1000, type=int, help="Sentences per fast tokenizer call.")
+    args = parser.parse_args()
+
+    task_utils = TASK_UTILS[args.task]
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=True)
+    labels = task_utils.get_labels(args.labels)
+    kwargs = conversion_kwargs(args, tokenizer)
+
+    print("{:<24} {:>6} {:>8} {:>10} {:>10} {:>8} {:>7}".format("data_dir", "mode", "examples", "slow (s)", "fast (s)", "speedup", "parity"))
+    failures = 0
+    for data_dir in sorted(glob.glob(os.path.join(args.data_root, "*", ""))):
+        for mode in args.modes.split(","):
+            if not os.path.exists(os.path.join(data_dir, "{}.txt".format(mode))):
+                continue
+            examples = task_utils.read_examples_from_file(data_dir, mode)
+            dir_labels = labels
+            # Labels not in the label file would raise a KeyError in both conversions, skip them here
+            missing = sorted({label for example in examples for label in example.labels} - set(labels))
+            if missing:
+                dir_labels = labels + missing
+
+            start = time.perf_counter()
+            features = task_utils.convert_examples_to_features(examples, dir_labels, args.max_seq_length, tokenizer, **kwargs)
+            slow_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fast_features = convert_examples_to_features_fast(
+                examples, dir_labels, args.max_seq_length, tokenizer, batch_size=args.batch_size, **kwargs
+            )
+            fast_time = time.perf_counter() - start
+
+            parity = same_features(features, fast_features)
+            failures += not parity
+            print(
+                "{:<24} {:>6} {:>8} {:>10.2f} {:>10.2f} {:>7.1f}x {:>7}".format(
+                    os.path.basename(os.path.normpath(data_dir)),
+                    mode,
+                    len(examples),
+                    slow_time,
+                    fast_time,
+                    slow_time / max(fast_time, 1e-9),
+                    "ok" if parity else "FAIL",
+                )
+            )
+
+    if failures:
+        raise SystemExit("{} split(s) produced different features".format(failures))
+
+
+if __name__ == "__main__":
+    main()
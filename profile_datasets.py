@@ -0,0 +1,236 @@
+# coding=utf-8
+""" Profiles the sentence lengths of every data directory of a task with the tokenizer used for training.
+
+For each language the train, dev and test splits are tokenized once. The report shows the subword length
+histogram, the fertility (subwords per word), the share of sentences truncated at candidate lengths and the
+padding waste of fixed, random-batch and bucketed padding. The recommended `max_seq_length` and bucket
+boundaries are written to `<data_dir>/length_profile.json`, where the training scripts pick them up with
+`--use_length_profile`, e.g.
+
+    python profile_datasets.py --task ner --model_type xlmroberta --tokenizer_name xlm-roberta-base
+
+`--model_type` only matters for the number of special tokens counted in the lengths of the token level tasks
+(roberta adds a second separator), a profile is used by every training run with the same tokenizer and count.
+"""
+
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+from transformers import AutoTokenizer
+
+import utils_ner
+import utils_news
+import utils_pos
+import utils_sentiment
+from utils_data import LENGTH_PROFILE_FILE, find_data_file, special_tokens_count, tokenizer_fingerprint
+
+
+# task -> (data root, file extension, token level)
+TASKS = {
+    "ner": ("data", "txt", True),
+    "pos": ("data-pos", "txt", True),
+    "news": ("data-news", "tsv", False),
+    "senti": ("data-sentiment", "tsv", False),
+}
+MODES = ["train", "dev", "test"]
+
+
+def read_split(task, data_dir, mode):
+    """Returns the sentences of a split as lists of words (token level tasks) or texts."""
+    if task == "ner":
+        return [example.words for example in utils_ner.read_examples_from_file(data_dir, mode)]
+    if task == "pos":
+        return [example.words for example in utils_pos.read_examples_from_file(data_dir, mode)]
+    task_utils = utils_news if task == "news" else utils_sentiment
+    return [example.texts for example in task_utils.read_examples_from_file(None, data_dir, mode)]
+
+
+def sentence_lengths(sentences, tokenizer, token_level, special_tokens_count, batch_size=1000):
+    """Returns the number of subwords (with special tokens) and of words of every sentence."""
+    subwords, words = [], []
+    for start in range(0, len(sentences), batch_size):
+        batch = sentences[start : start + batch_size]
+        if token_level:
+            encodings = tokenizer(batch, is_split_into_words=True, add_special_tokens=False)
+            subwords.extend(len(input_ids) + special_tokens_count for input_ids in encodings["input_ids"])
+            words.extend(len(sentence) for sentence in batch)
+        else:
+            encodings = tokenizer(list(batch))
+            subwords.extend(len(input_ids) for input_ids in encodings["input_ids"])
+            words.extend(len(text.split()) for text in batch)
+    return np.asarray(subwords, dtype=np.int64), np.asarray(words, dtype=np.int64)
+
+
+def round_up(value, multiple_of):
+    return int(-(-value // multiple_of) * multiple_of)
+
+
+def bucket_batches(lengths, batch_size, rng, bucket_boundaries=None):
+    """The lengths of random batches, cut within buckets if `bucket_boundaries` are given."""
+    order = rng.permutation(len(lengths))
+    if not bucket_boundaries:
+        return [lengths[order[i : i + batch_size]] for i in range(0, len(order), batch_size)]
+    buckets = np.searchsorted(np.asarray(bucket_boundaries), lengths[order], side="left")
+    batches = []
+    for bucket in np.unique(buckets):
+        members = order[buckets == bucket]
+        batches.extend(lengths[members[i : i + batch_size]] for i in range(0, len(members), batch_size))
+    return batches
+
+
+def padding_waste(batches):
+    """Share of the padded batch positions that are padding, when every batch is padded to its longest sequence."""
+    padded = sum(len(batch) * int(batch.max()) for batch in batches)
+    return 1.0 - sum(int(batch.sum()) for batch in batches) / max(padded, 1)
+
+
+def profile_lengths(lengths, words, args, model_max_length):
+    truncation = {
+        str(length): float(np.mean(lengths > length)) for length in args.candidate_lengths if length <= model_max_length
+    }
+
+    # Shortest length (a multiple of `multiple_of`) that truncates at most `max_truncation_rate` of the sentences
+    max_seq_length = round_up(np.quantile(lengths, 1.0 - args.max_truncation_rate), args.multiple_of)
+    max_seq_length = int(min(max(max_seq_length, args.multiple_of), model_max_length))
+    truncated = np.minimum(lengths, max_seq_length)
+    quantiles = np.quantile(truncated, np.arange(1, args.num_buckets) / args.num_buckets)
+    bucket_boundaries = sorted({min(round_up(q, args.multiple_of), max_seq_length) for q in quantiles})
+    bucket_boundaries = [b for b in bucket_boundaries if b < max_seq_length] + [max_seq_length]
+
+    rng = np.random.RandomState(args.seed)
+    histogram, edges = np.histogram(lengths, bins=np.arange(0, int(lengths.max()) + args.bin_width + 1, args.bin_width))
+    return {
+        "num_sentences": int(len(lengths)),
+        "num_words": int(words.sum()),
+        "num_subwords": int(lengths.sum()),
+        "fertility": float((lengths.sum() - args.special_tokens_count * len(lengths)) / max(words.sum(), 1)),
+        "percentiles": {str(p): float(np.percentile(lengths, p)) for p in [50, 90, 95, 99, 100]},
+        "histogram": {"bin_edges": edges.tolist(), "counts": histogram.tolist()},
+        "truncation_rate": truncation,
+        "padding_waste": {
+            "fixed": 1.0 - float(truncated.sum()) / (len(truncated) * max_seq_length),
+            "random_batches": padding_waste(bucket_batches(truncated, args.batch_size, rng)),
+            "bucketed_batches": padding_waste(bucket_batches(truncated, args.batch_size, rng, bucket_boundaries)),
+        },
+        "recommended": {"max_seq_length": max_seq_length, "bucket_boundaries": bucket_boundaries},
+    }
+
+
+def print_histogram(histogram, width=50):
+    counts = histogram["counts"]
+    edges = histogram["bin_edges"]
+    scale = width / max(max(counts), 1)
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        if count:
+            print("    {:>5}-{:<5} {:>7} {}".format(low, high - 1, count, "#" * max(1, int(count * scale))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--task", default="ner", type=str, choices=list(TASKS.keys()))
+    parser.add_argument("--data_root", default="", type=str, help="Defaults to the task's data directory.")
+    parser.add_argument(
+        "--languages", default="all", type=str, help="Comma separated language directories, or 'all'."
+    )
+    parser.add_argument("--model_type", default="xlmroberta", type=str, help="The --model_type of the training runs.")
+    parser.add_argument("--tokenizer_name", default="xlm-roberta-base", type=str)
+    parser.add_argument("--cache_dir", default="", type=str)
+    parser.add_argument(
+        "--candidate_lengths",
+        default=[64, 96, 128, 164, 192, 256, 512],
+        type=int,
+        nargs="+",
+        help="Lengths at which the truncation rate is reported.",
+    )
+    parser.add_argument(
+        "--max_truncation_rate",
+        default=0.01,
+        type=float,
+        help="The recommended max_seq_length truncates at most this share of the sentences.",
+    )
+    parser.add_argument("--num_buckets", default=4, type=int)
+    parser.add_argument("--multiple_of", default=8, type=int, help="Lengths are rounded up to a multiple of this.")
+    parser.add_argument("--batch_size", default=32, type=int, help="Batch size used for the padding waste.")
+    parser.add_argument("--bin_width", default=16, type=int, help="Width of the histogram bins in subwords.")
+    parser.add_argument("--show_histograms", action="store_true")
+    parser.add_argument("--no_write", action="store_true", help=f"Only print the report, do not write {LENGTH_PROFILE_FILE}.")
+    parser.add_argument("--seed", default=42, type=int)
+    args = parser.parse_args()
+
+    data_root, extension, token_level = TASKS[args.task]
+    data_root = args.data_root or data_root
+    args.model_type = args.model_type.lower()
+    # Same special tokens as the feature conversion of the training scripts, roberta adds an extra separator
+    args.special_tokens_count = special_tokens_count(args.model_type) if token_level else 0
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name, cache_dir=args.cache_dir if args.cache_dir else None)
+    fingerprint = tokenizer_fingerprint(tokenizer)
+    # Some tokenizers report a huge placeholder when they have no limit
+    model_max_length = tokenizer.model_max_length if tokenizer.model_max_length <= 100000 else 512
+
+    if args.languages == "all":
+        data_dirs = sorted(glob.glob(os.path.join(data_root, "*", "")))
+    else:
+        data_dirs = [os.path.join(data_root, language) for language in args.languages.split(",")]
+
+    columns = ["{:>5}".format("@" + str(length)) for length in args.candidate_lengths if length <= model_max_length]
+    print(
+        "{:<16} {:>7} {:>9} {:>6} {:>6} {:>6} {} {:>6} {:>20} {:>7} {:>7} {:>7}".format(
+            "data_dir", "sents", "fertility", "p50", "p99", "max", " ".join(columns), "rec",
+            "buckets", "w.fixed", "w.rand", "w.bkt",
+        )
+    )
+    for data_dir in data_dirs:
+        modes = [mode for mode in MODES if os.path.exists(find_data_file(data_dir, "{}.{}".format(mode, extension)))]
+        if not modes:
+            continue
+        lengths, words = [], []
+        for mode in modes:
+            split_lengths, split_words = sentence_lengths(
+                read_split(args.task, data_dir, mode), tokenizer, token_level, args.special_tokens_count
+            )
+            lengths.append(split_lengths)
+            words.append(split_words)
+        lengths, words = np.concatenate(lengths), np.concatenate(words)
+        if not len(lengths):
+            continue
+
+        profile = profile_lengths(lengths, words, args, model_max_length)
+        profile.update(
+            {
+                "task": args.task,
+                "splits": modes,
+                "model_type": args.model_type,
+                "special_tokens_count": args.special_tokens_count,
+                "tokenizer_name": args.tokenizer_name,
+                "tokenizer": fingerprint,
+            }
+        )
+        print(
+            "{:<16} {:>7} {:>9.2f} {:>6.0f} {:>6.0f} {:>6.0f} {} {:>6} {:>20} {:>7.1%} {:>7.1%} {:>7.1%}".format(
+                os.path.basename(os.path.normpath(data_dir)),
+                profile["num_sentences"],
+                profile["fertility"],
+                profile["percentiles"]["50"],
+                profile["percentiles"]["99"],
+                profile["percentiles"]["100"],
+                " ".join("{:>5.1%}".format(rate) for rate in profile["truncation_rate"].values()),
+                profile["recommended"]["max_seq_length"],
+                ",".join(str(b) for b in profile["recommended"]["bucket_boundaries"]),
+                profile["padding_waste"]["fixed"],
+                profile["padding_waste"]["random_batches"],
+                profile["padding_waste"]["bucketed_batches"],
+            )
+        )
+        if args.show_histograms:
+            print_histogram(profile["histogram"])
+        if not args.no_write:
+            with open(os.path.join(data_dir, LENGTH_PROFILE_FILE), "w") as writer:
+                json.dump(profile, writer, indent=2)
+
+
+if __name__ == "__main__":
+    main()
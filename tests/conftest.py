@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# The training utilities are top-level modules of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,73 @@
+import gzip
+import os
+
+import pytest
+
+import utils_news
+import utils_ner
+import utils_sentiment
+from utils_data import find_data_file
+
+
+CONLL = (
+    "Abuja B-LOC\n"
+    "ni O\n"
+    "olú  O\n"
+    "ìlú O\n"
+    "\n"
+    "Mo O\r\n"
+    "ri B-PER extra-field I-PER\n"
+    "unlabelled\n"
+    "\n"
+    "\n"
+    ". O"
+)
+NEWS_TSV = "category\ttext\turl\npolitics\tÀwọn aṣòfin\thttp://a\nsports\tGoal \"quoted\"\thttp://b\n"
+SENTI_TSV = "tweet\tlabel\nmo fẹ́ràn rẹ̀\tpositive\nrara\tnegative\n"
+
+
+def _compress(path, data, extension):
+    if extension == ".gz":
+        with gzip.open(path + extension, "wb") as writer:
+            writer.write(data)
+    elif extension == ".zst":
+        zstandard = pytest.importorskip("zstandard")
+        with open(path + extension, "wb") as writer:
+            writer.write(zstandard.ZstdCompressor().compress(data))
+
+
+def _write_split(data_root, extension, file_name, text):
+    data_dir = os.path.join(data_root, extension.lstrip(".") or "plain")
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, file_name)
+    data = text.encode("utf-8")
+    if extension:
+        _compress(path, data, extension)
+    else:
+        with open(path, "wb") as writer:
+            writer.write(data)
+    assert find_data_file(data_dir, file_name) == path + extension
+    return data_dir
+
+
+def _fields(examples):
+    return [vars(example) for example in examples]
+
+
+@pytest.mark.parametrize("extension", [".gz", ".zst"])
+def test_compressed_conll_reads_like_plain_text(tmp_path, extension):
+    plain = _write_split(str(tmp_path), "", "train.txt", CONLL)
+    compressed = _write_split(str(tmp_path), extension, "train.txt", CONLL)
+    examples = utils_ner.read_examples_from_file(plain, "train")
+    assert [len(example.words) for example in examples] == [4, 3, 1]
+    assert _fields(utils_ner.read_examples_from_file(compressed, "train")) == _fields(examples)
+
+
+@pytest.mark.parametrize("extension", [".gz", ".zst"])
+@pytest.mark.parametrize("reader,text", [(utils_news, NEWS_TSV), (utils_sentiment, SENTI_TSV)], ids=["news", "senti"])
+def test_compressed_tsv_reads_like_plain_text(tmp_path, extension, reader, text):
+    plain = _write_split(str(tmp_path), "", "dev.tsv", text)
+    compressed = _write_split(str(tmp_path), extension, "dev.tsv", text)
+    examples = reader.read_examples_from_file(None, plain, "dev")
+    assert len(examples) == 2
+    assert _fields(reader.read_examples_from_file(None, compressed, "dev")) == _fields(examples)
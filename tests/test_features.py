@@ -0,0 +1,143 @@
+import pytest
+from tokenizers import Tokenizer, models, normalizers, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from utils_data import FeatureCache
+from utils_features import convert_examples_to_features_fast, stitch_windows
+from utils_ner import InputExample, convert_examples_to_features
+
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "the", "cat", "sat", "on", "mat", "##s", "##ting", "k", "##i", "##gali", "a", "."]
+LABELS = ["O", "B-LOC", "I-LOC"]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    # A WordPiece tokenizer built from a tiny vocabulary, so the test needs no download
+    wordpiece = Tokenizer(models.WordPiece({token: i for i, token in enumerate(VOCAB)}, unk_token="[UNK]"))
+    wordpiece.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    # A zero-width space is stripped, so a word made of it tokenizes to nothing
+    wordpiece.normalizer = normalizers.Replace("\u200b", "")
+    return PreTrainedTokenizerFast(
+        tokenizer_object=wordpiece, unk_token="[UNK]", pad_token="[PAD]", cls_token="[CLS]", sep_token="[SEP]"
+    )
+
+
+def _examples(empty_words=True):
+    sentences = [
+        (["the", "cat", "sat"], ["O", "O", "O"]),
+        (["kigali", "mats", "sitting", "dog", "."], ["B-LOC", "O", "O", "O", "O"]),
+        (["a", "cats", "on", "the", "mat", "in", "kigali", "kigali", "."], ["O"] * 6 + ["B-LOC", "I-LOC", "O"]),
+        (["the"], ["O"]),
+    ]
+    if empty_words:
+        sentences += [
+            # Words that tokenize to nothing: the subwords fit in 8 positions, the labels do not
+            (["the", "cat", "sat", "on", "the", "\u200b", "mat"], ["O"] * 7),
+            (["the", "\u200b", "cat"], ["O"] * 3),
+            (["a", "cat", "on", "the", "mat", "in", "\u200b", "kigali"], ["O"] * 7 + ["B-LOC"]),
+        ]
+    return [InputExample(guid="test-%d" % i, words=words, labels=labels) for i, (words, labels) in enumerate(sentences)]
+
+
+def _convert(convert, tokenizer, max_seq_length, empty_words=True, **kwargs):
+    return convert(
+        _examples(empty_words),
+        LABELS,
+        max_seq_length,
+        tokenizer,
+        cls_token=tokenizer.cls_token,
+        cls_token_segment_id=0,
+        sep_token=tokenizer.sep_token,
+        pad_token=tokenizer.pad_token_id,
+        **kwargs
+    )
+
+
+def _fields(feature):
+    return feature.input_ids, feature.input_mask, feature.segment_ids, feature.label_ids, feature.example_index
+
+
+@pytest.mark.parametrize("max_seq_length", [8, 12, 32], ids=["truncated", "some-truncated", "padded"])
+@pytest.mark.parametrize("pad_to_max_length", [True, False])
+@pytest.mark.parametrize("sep_token_extra", [False, True])
+def test_fast_conversion_matches_word_by_word_conversion(tokenizer, max_seq_length, pad_to_max_length, sep_token_extra):
+    kwargs = dict(pad_to_max_length=pad_to_max_length, sep_token_extra=sep_token_extra)
+    features = _convert(convert_examples_to_features, tokenizer, max_seq_length, **kwargs)
+    fast_features = _convert(convert_examples_to_features_fast, tokenizer, max_seq_length, batch_size=3, **kwargs)
+    assert [_fields(f) for f in fast_features] == [_fields(f) for f in features]
+    # Sentences with a word that tokenizes to nothing are dropped unless they are truncated
+    assert 5 not in [f.example_index for f in features]
+
+
+@pytest.mark.parametrize("doc_stride", [1, 2, 4])
+def test_doc_stride_windows_cover_every_word_once(tokenizer, doc_stride):
+    max_seq_length = 8
+    full = _convert(convert_examples_to_features, tokenizer, 64, empty_words=False, pad_to_max_length=False)
+    windows = _convert(
+        convert_examples_to_features_fast,
+        tokenizer,
+        max_seq_length,
+        empty_words=False,
+        pad_to_max_length=True,
+        doc_stride=doc_stride,
+    )
+    assert max(len(f.input_ids) for f in full) > max_seq_length, "no sentence is long enough to be split"
+
+    for feature in windows:
+        assert len(feature.input_ids) == len(feature.label_ids) == max_seq_length
+        length = sum(feature.input_mask)
+        assert feature.input_ids[0] == tokenizer.cls_token_id and feature.input_ids[length - 1] == tokenizer.sep_token_id
+        # Every window is a slice of the untruncated sentence
+        subwords = feature.input_ids[1 : length - 1]
+        sentence = full[feature.example_index].input_ids[1:-1]
+        assert any(sentence[start : start + len(subwords)] == subwords for start in range(len(sentence)))
+
+    # Read in order, the labelled positions of the windows are the words of the sentence
+    labels = stitch_windows(
+        [[label for label in f.label_ids if label != -100] for f in windows], [f.example_index for f in windows]
+    )
+    assert labels == [[label for label in f.label_ids if label != -100] for f in full]
+
+
+def test_stitch_windows_joins_windows_by_example():
+    sequences = [["a", "b"], ["c"], ["d"], ["e", "f"]]
+    assert stitch_windows(sequences, [0, 0, 1, 2]) == [["a", "b", "c"], ["d"], ["e", "f"]]
+
+
+def test_stitch_windows_keeps_dropped_examples_aligned():
+    # Example 1 produced no features, examples 4 and 5 neither
+    sequences = [["a"], ["b", "c"], ["d"]]
+    stitched = stitch_windows(sequences, [0, 2, 3], num_examples=6)
+    assert stitched == [["a"], [], ["b", "c"], ["d"], [], []]
+
+
+def _store_contents(store):
+    return [{field: getattr(store[i], field).tolist() for field in store.fields} for i in range(len(store))]
+
+
+def test_feature_cache_update_converts_only_changed_examples(tmp_path, tokenizer):
+    def convert(examples):
+        converted.append(len(examples))
+        return convert_examples_to_features(
+            examples, LABELS, 16, tokenizer, cls_token="[CLS]", sep_token="[SEP]", pad_to_max_length=False
+        )
+
+    examples = _examples()
+    cache = FeatureCache(str(tmp_path / "cache"))
+    converted = []
+    cache.load_or_update("v1", "family", lambda: examples, convert)
+    assert converted == [len(examples)]
+
+    # Reordered, one sentence edited and one appended
+    edited = InputExample(guid="edited", words=["the", "cat", "sat", "on", "a", "mat"], labels=["O"] * 6)
+    appended = InputExample(guid="appended", words=["kigali", "cats"], labels=["B-LOC", "O"])
+    updated = examples[::-1][:-1] + [edited, appended]
+    converted = []
+    store = cache.load_or_update("v2", "family", lambda: updated, convert)
+    assert converted == [2]
+
+    rebuilt = FeatureCache(str(tmp_path / "rebuilt")).load_or_update("v2", "family", lambda: updated, convert)
+    assert converted == [2, len(updated)]
+    assert store.example_indices().tolist() == rebuilt.example_indices().tolist()
+    assert _store_contents(store) == _store_contents(rebuilt)
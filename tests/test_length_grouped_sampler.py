@@ -0,0 +1,54 @@
+import random
+
+from utils_data import LengthGroupedBatchSampler
+
+
+def _lengths(num_examples, seed=0):
+    rng = random.Random(seed)
+    return [rng.randint(1, 64) for _ in range(num_examples)]
+
+
+def test_length_grouped_sampler_ranks_cover_every_batch():
+    lengths = _lengths(1001)
+    single = LengthGroupedBatchSampler(lengths, 10, seed=1)
+    single.set_epoch(2)
+    expected = sorted(map(tuple, single))
+    seen = []
+    for rank in range(4):
+        sampler = LengthGroupedBatchSampler(lengths, 10, seed=1, num_replicas=4, rank=rank)
+        sampler.set_epoch(2)
+        seen.extend(map(tuple, sampler))
+    # 101 batches padded to 104 by repeating three of them
+    assert len(seen) == 104
+    assert sorted(set(seen)) == sorted(set(expected))
+
+
+def test_length_grouped_sampler_shuffle_depends_on_epoch_only():
+    lengths = _lengths(200)
+    sampler = LengthGroupedBatchSampler(lengths, 8, seed=3)
+    sampler.set_epoch(5)
+    first, again = list(sampler), list(sampler)
+    assert first == again
+    sampler.set_epoch(6)
+    assert list(sampler) != first
+
+
+def test_length_grouped_sampler_pads_every_rank_to_the_longest_one():
+    # 3 batches of 4 on 2 ranks: the second rank repeats the first batch
+    lengths = list(range(1, 13))
+    ranks = [LengthGroupedBatchSampler(lengths, 4, seed=0, num_replicas=2, rank=rank) for rank in range(2)]
+    batches = [list(map(tuple, sampler)) for sampler in ranks]
+    assert [len(sampler) for sampler in ranks] == [len(b) for b in batches] == [2, 2]
+    assert batches[1][1] == batches[0][0]
+    assert sorted(i for batch in batches[0] + batches[1][:1] for i in batch) == list(range(12))
+
+
+def test_length_grouped_sampler_keeps_the_epoch_until_set_epoch():
+    lengths = _lengths(200)
+    sampler = LengthGroupedBatchSampler(lengths, 8, seed=3, num_replicas=2, rank=1)
+    # Iterating does not advance the epoch, the training loop calls set_epoch() before every epoch
+    assert list(sampler) == list(sampler)
+    sampler.set_epoch(0)
+    first = list(sampler)
+    sampler.set_epoch(1)
+    assert list(sampler) != first
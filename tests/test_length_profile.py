@@ -0,0 +1,48 @@
+import argparse
+import json
+
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from utils_data import LENGTH_PROFILE_FILE, apply_length_profile, special_tokens_count, tokenizer_fingerprint
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    wordlevel = Tokenizer(models.WordLevel({"[PAD]": 0, "[UNK]": 1, "[CLS]": 2, "[SEP]": 3}, unk_token="[UNK]"))
+    wordlevel.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(
+        tokenizer_object=wordlevel, unk_token="[UNK]", pad_token="[PAD]", cls_token="[CLS]", sep_token="[SEP]"
+    )
+
+
+def _apply(tmp_path, tokenizer, model_type, profile):
+    profile = dict(
+        {"task": "ner", "tokenizer": tokenizer_fingerprint(tokenizer)},
+        recommended={"max_seq_length": 96, "bucket_boundaries": [32, 64]},
+        **profile
+    )
+    with open(str(tmp_path / LENGTH_PROFILE_FILE), "w") as writer:
+        json.dump(profile, writer)
+    args = argparse.Namespace(data_dir=str(tmp_path), model_type=model_type, max_seq_length=164, bucket_boundaries=None)
+    apply_length_profile(args, tokenizer)
+    return args.max_seq_length
+
+
+def test_profile_is_shared_by_model_types_with_the_same_special_tokens(tmp_path, tokenizer):
+    profile = {"model_type": "bert", "special_tokens_count": special_tokens_count("bert")}
+    assert _apply(tmp_path, tokenizer, "xlmroberta", profile) == 96
+    assert _apply(tmp_path, tokenizer, "roberta", profile) == 164
+
+
+def test_profile_without_special_tokens_count(tmp_path, tokenizer):
+    assert _apply(tmp_path, tokenizer, "xlmroberta", {"model_type": "bert"}) == 96
+    assert _apply(tmp_path, tokenizer, "xlmroberta", {"model_type": "roberta"}) == 164
+    # Sequence level lengths count no special tokens
+    assert _apply(tmp_path, tokenizer, "xlmroberta", {"model_type": "roberta", "task": "news"}) == 96
+
+
+def test_profile_of_another_tokenizer_is_ignored(tmp_path, tokenizer):
+    profile = {"model_type": "xlmroberta", "special_tokens_count": 2}
+    assert _apply(tmp_path, tokenizer, "xlmroberta", dict(profile, tokenizer="another")) == 164
@@ -0,0 +1,35 @@
+import random
+
+import pytest
+
+from utils_data import LengthGroupedBatchSampler, ShardedEvalSampler
+
+
+def _lengths(num_examples, seed=0):
+    rng = random.Random(seed)
+    return [rng.randint(1, 64) for _ in range(num_examples)]
+
+
+@pytest.mark.parametrize("num_replicas", [1, 2, 3, 4, 7])
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"bucket_boundaries": [8, 32]}, {"sample_weights": [0.5] * 1001, "bucket_boundaries": [8, 32]}],
+    ids=["megabatches", "buckets", "weighted-buckets"],
+)
+def test_length_grouped_sampler_gives_every_rank_the_same_number_of_batches(num_replicas, options):
+    lengths = _lengths(1001)
+    for epoch in range(3):
+        counts = []
+        for rank in range(num_replicas):
+            sampler = LengthGroupedBatchSampler(lengths, 10, seed=42, num_replicas=num_replicas, rank=rank, **options)
+            sampler.set_epoch(epoch)
+            counts.append((len(sampler), len(list(sampler))))
+        assert len(set(counts)) == 1, counts
+        assert counts[0][0] == counts[0][1]
+
+
+@pytest.mark.parametrize("num_examples,num_replicas", [(11, 3), (3, 5), (0, 2)])
+def test_sharded_eval_sampler_covers_the_split_once_in_order(num_examples, num_replicas):
+    shards = [list(ShardedEvalSampler(range(num_examples), num_replicas, rank)) for rank in range(num_replicas)]
+    assert [index for shard in shards for index in shard] == list(range(num_examples))
+    assert max(map(len, shards)) - min(map(len, shards)) <= 1
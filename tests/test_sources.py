@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data import WeightedRandomSampler
+
+from utils_data import (
+    SOURCES_FILE,
+    CompositeDataset,
+    FeatureStore,
+    LengthGroupedBatchSampler,
+    parse_sources,
+    read_sources,
+    save_feature_store,
+)
+from utils_ner import InputFeatures
+
+
+@pytest.fixture
+def data_root(tmp_path):
+    for name in ["en_ewt", "ro_rrt", "wol"]:
+        os.makedirs(str(tmp_path / name))
+    return str(tmp_path)
+
+
+def test_parse_sources_weights_and_lookup(data_root):
+    sources = parse_sources("en_ewt + wol:2 + ro_rrt:0.5", data_root)
+    assert sources == [
+        (os.path.join(data_root, "en_ewt"), 1.0),
+        (os.path.join(data_root, "wol"), 2.0),
+        (os.path.join(data_root, "ro_rrt"), 0.5),
+    ]
+
+
+def test_read_sources_from_the_sources_file(data_root):
+    composite = os.path.join(data_root, "en_wol")
+    os.makedirs(composite)
+    assert read_sources(composite) is None
+    with open(os.path.join(composite, SOURCES_FILE), "w") as writer:
+        writer.write("# English with Wolof upsampled\nen_ewt\n\nwol:2\n")
+    assert read_sources(composite) == [(os.path.join(data_root, "en_ewt"), 1.0), (os.path.join(data_root, "wol"), 2.0)]
+
+
+@pytest.mark.parametrize(
+    "spec,message",
+    [
+        ("en_ewt:abc", "Source en_ewt of 'en_ewt:abc' has weight 'abc', not a number"),
+        ("en_ewt + hau", "Source {hau} of 'en_ewt + hau' is not a data directory"),
+        ("wol:0", "Source wol of 'wol:0' needs a positive weight"),
+        (" + ", "Empty composite dataset spec ' + '"),
+    ],
+)
+def test_parse_sources_rejects_malformed_specs(data_root, spec, message):
+    with pytest.raises(ValueError) as error:
+        parse_sources(spec, data_root)
+    assert str(error.value) == message.format(hau=os.path.join(data_root, "hau"))
+
+
+def _features(num_examples, offset):
+    features = []
+    for index in range(num_examples):
+        length = (index + offset) % 7 + 3
+        ids = list(range(offset + index, offset + index + length))
+        features.append(InputFeatures(ids, [1] * length, [0] * length, [index % 3] * length, example_index=index))
+    return features
+
+
+def test_composite_dataset_reads_like_a_concatenated_store(tmp_path):
+    sources = [_features(5, 0), _features(8, 100), _features(3, 200)]
+    stores = []
+    for index, features in enumerate(sources):
+        save_feature_store(features, str(tmp_path / "source-{}".format(index)))
+        stores.append(FeatureStore(str(tmp_path / "source-{}".format(index))))
+    save_feature_store([f for features in sources for f in features], str(tmp_path / "concatenated"))
+    concatenated = FeatureStore(str(tmp_path / "concatenated"))
+
+    composite = CompositeDataset(stores, weights=[1, 2, 0.5], names=["a", "b", "c"])
+    assert len(composite) == len(concatenated)
+    assert composite.lengths.tolist() == concatenated.lengths.tolist()
+    for index in range(len(composite)):
+        for field in ["input_ids", "input_mask", "segment_ids", "label_ids"]:
+            assert getattr(composite[index], field).tolist() == getattr(concatenated[index], field).tolist()
+
+
+def _source_shares(indices, sizes):
+    source_of = np.repeat(np.arange(len(sizes)), sizes)
+    return np.bincount(source_of[np.asarray(indices)], minlength=len(sizes)) / len(indices)
+
+
+class _Sized(object):
+    def __init__(self, size):
+        self.lengths = np.full(size, 8)
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def test_sampled_source_shares_match_the_weights():
+    sizes, weights = [300, 100, 600], [1, 4, 0.5]
+    composite = CompositeDataset([_Sized(size) for size in sizes], weights=weights)
+    expected = np.asarray(weights) * sizes / np.dot(weights, sizes)
+    sample_weights = composite.sample_weights()
+
+    # Random batches, as the training scripts without --group_by_length
+    sampler = WeightedRandomSampler(
+        sample_weights, int(round(sample_weights.sum())), generator=torch.Generator().manual_seed(0)
+    )
+    for _ in range(3):
+        assert _source_shares(list(sampler), sizes) == pytest.approx(expected, abs=0.02)
+
+    # Length grouped batches
+    sampler = LengthGroupedBatchSampler(composite.lengths, 10, seed=0, sample_weights=sample_weights)
+    indices = []
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        indices.extend(index for batch in sampler for index in batch)
+    assert _source_shares(indices, sizes) == pytest.approx(expected, abs=0.02)
+    assert CompositeDataset([_Sized(size) for size in sizes]).sample_weights() is None
@@ -0,0 +1,157 @@
+import argparse
+import copy
+import os
+import warnings
+
+import pytest
+import torch
+
+from utils_train import (
+    AdapterCheckpointer,
+    amp_autocast,
+    amp_grad_scaler,
+    build_optimizer,
+    checkpoint_step,
+    clip_grad_norm_,
+    load_trainable_weights,
+    store_frozen_weights,
+)
+
+
+def _adapter_model(seed):
+    torch.manual_seed(seed)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.Linear(8, 3))
+    # The first layer stands for the frozen backbone, the second for the adapter and head
+    model[0].weight.requires_grad_(False)
+    model[0].bias.requires_grad_(False)
+    return model
+
+
+def test_adapter_checkpoint_round_trip(tmp_path):
+    model = _adapter_model(seed=0)
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=0.1)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    checkpoint = os.path.join(str(tmp_path), "checkpoint-20")
+    checkpointer = AdapterCheckpointer()
+    checkpointer.save(checkpoint, model, optimizer, scheduler)
+    checkpointer.wait()
+
+    # Same backbone, different adapter and head
+    restored = _adapter_model(seed=1)
+    restored[0].load_state_dict(model[0].state_dict())
+    load_trainable_weights(restored, checkpoint)
+    for expected, actual in zip(model.state_dict().values(), restored.state_dict().values()):
+        assert torch.equal(expected, actual)
+    assert checkpoint_step(checkpoint + "/") == 20
+
+
+def test_load_trainable_weights_rejects_a_different_model(tmp_path):
+    model = _adapter_model(seed=0)
+    optimizer = torch.optim.SGD([p for p in model.parameters() if p.requires_grad], lr=0.1)
+    scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.0)
+    checkpointer = AdapterCheckpointer()
+    checkpointer.save(str(tmp_path / "checkpoint-1"), model, optimizer, scheduler)
+    checkpointer.wait()
+
+    with pytest.raises(ValueError):
+        load_trainable_weights(torch.nn.Sequential(torch.nn.Linear(4, 8)), str(tmp_path / "checkpoint-1"))
+
+
+def _amp_args(amp, device="cpu"):
+    return argparse.Namespace(
+        amp=amp, device=torch.device(device), learning_rate=1e-2, weight_decay=0.01, adam_epsilon=1e-8, max_grad_norm=0.1
+    )
+
+
+def _train_curve(args, model, scaler, steps):
+    # The steps of the adapter training loops: scale, backward, unscale, clip, step
+    optimizer, params = build_optimizer(model, args)
+    generator = torch.Generator().manual_seed(0)
+    losses, grad_norms = [], []
+    for _ in range(steps):
+        inputs = torch.randn(16, 4, generator=generator).to(args.device)
+        labels = torch.randint(0, 3, (16,), generator=generator).to(args.device)
+        with amp_autocast(args):
+            loss = torch.nn.functional.cross_entropy(model(inputs).float(), labels)
+        scaler.scale(loss).backward()
+        scaler.unscale_(optimizer)
+        grad_norms.append(clip_grad_norm_(params, args.max_grad_norm).item())
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+        losses.append(loss.item())
+    return losses, grad_norms, model
+
+
+def _train_step(args, model, scaler):
+    losses, grad_norms, model = _train_curve(args, model, scaler, steps=1)
+    return losses[0], grad_norms[0], model
+
+
+def _assert_same_step(reference, step, atol):
+    (loss, grad_norm, model), (expected_loss, expected_grad_norm, expected_model) = step, reference
+    assert loss == pytest.approx(expected_loss, abs=atol)
+    assert grad_norm == pytest.approx(expected_grad_norm, rel=atol)
+    assert grad_norm > 0.1, "the gradients were not clipped"
+    for param, expected in zip(model.parameters(), expected_model.parameters()):
+        assert torch.allclose(param.detach().float().cpu(), expected.detach(), atol=atol)
+    # The frozen layer is not updated
+    assert torch.equal(model[0].weight.detach().cpu(), expected_model[0].weight.detach())
+
+
+def test_amp_grad_scaler_is_disabled_outside_fp16():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", FutureWarning)
+        for amp in ["off", "bf16"]:
+            assert not amp_grad_scaler(_amp_args(amp)).is_enabled()
+
+
+def test_bf16_step_matches_fp32():
+    reference = _train_step(_amp_args("off"), _adapter_model(seed=0), amp_grad_scaler(_amp_args("off")))
+    step = _train_step(_amp_args("bf16"), _adapter_model(seed=0), amp_grad_scaler(_amp_args("bf16")))
+    _assert_same_step(reference, step, atol=2e-2)
+
+
+def test_bf16_loss_curve_matches_fp32():
+    reference, _, _ = _train_curve(_amp_args("off"), _adapter_model(seed=0), amp_grad_scaler(_amp_args("off")), 30)
+    losses, _, _ = _train_curve(_amp_args("bf16"), _adapter_model(seed=0), amp_grad_scaler(_amp_args("bf16")), 30)
+    assert reference[-1] < reference[0], "the fp32 run does not learn"
+    assert losses == pytest.approx(reference, rel=0.05)
+
+
+@pytest.mark.skipif(not hasattr(torch.amp, "GradScaler"), reason="torch < 2.3 has no device-generic GradScaler")
+def test_loss_scaled_step_unscales_before_clipping():
+    # A scaler with a large scale: clipping or stepping the scaled gradients would not match fp32
+    args = _amp_args("off")
+    reference = _train_step(args, _adapter_model(seed=0), amp_grad_scaler(args))
+    scaler = torch.amp.GradScaler("cpu", init_scale=2.0 ** 16)
+    step = _train_step(args, _adapter_model(seed=0), scaler)
+    _assert_same_step(reference, step, atol=1e-6)
+    assert scaler.get_scale() == 2.0 ** 16
+
+    reference, _, _ = _train_curve(args, _adapter_model(seed=0), amp_grad_scaler(args), steps=10)
+    losses, _, _ = _train_curve(args, _adapter_model(seed=0), torch.amp.GradScaler("cpu", init_scale=2.0 ** 16), 10)
+    assert losses == pytest.approx(reference, abs=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="--amp fp16 needs a CUDA device")
+def test_fp16_step_matches_fp32():
+    args = _amp_args("fp16", device="cuda")
+    model = _adapter_model(seed=0)
+    reference = _train_step(_amp_args("off"), copy.deepcopy(model), amp_grad_scaler(_amp_args("off")))
+    step = _train_step(args, model.to(args.device), amp_grad_scaler(args))
+    _assert_same_step(reference, step, atol=2e-2)
+
+
+def test_store_frozen_weights_converts_a_model_once():
+    args = argparse.Namespace(amp="bf16", frozen_dtype="bf16")
+    model = _adapter_model(seed=0)
+    store_frozen_weights(model, args)
+    assert model[0].weight.dtype == torch.bfloat16 and model[1].weight.dtype == torch.float32
+
+    # A second run on the shared backbone, e.g. the next language of a sweep, leaves it as is
+    frozen = model[0].weight
+    store_frozen_weights(model, args)
+    assert model[0].weight is frozen and model[0].weight.dtype == torch.bfloat16
+    with pytest.raises(ValueError):
+        store_frozen_weights(model, argparse.Namespace(amp="off", frozen_dtype="int8"))
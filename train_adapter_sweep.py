@@ -0,0 +1,276 @@
+# coding=utf-8
+""" Trains task adapters for many languages in one process, keeping a single base model resident.
+
+For every (task, language) pair the language adapter and a fresh task head are attached to the shared
+backbone, trained and evaluated with the task script's own `train()` / `evaluate()`, saved, and then
+deleted again so the next language starts from the same backbone. The backbone itself is never trained;
+with `--frozen_dtype` it is stored in that dtype once, before the first run, and every language trains on
+the same converted weights.
+
+Arguments not listed below are passed through to the task scripts, e.g.
+
+    python train_adapter_sweep.py --tasks ner,pos --languages yor,hau,wol \
+        --model_type roberta --model_name_or_path xlm-roberta-base \
+        --path_to_adapter "adapters/{language}/mlm" --output_dir sweeps \
+        --max_seq_length 164 --num_train_epochs 50 --per_gpu_train_batch_size 32 \
+        --learning_rate 5e-4 --do_train --do_eval --do_predict
+"""
+
+import argparse
+import gc
+import importlib
+import logging
+import os
+
+import torch
+from torch.nn import CrossEntropyLoss
+from transformers import AutoAdapterModel, AutoTokenizer
+
+import wandb
+from utils_data import SOURCES_FILE, apply_length_profile, find_data_file
+from utils_train import AMP_MODES, FROZEN_DTYPES, store_frozen_weights
+
+
+logger = logging.getLogger(__name__)
+
+# task -> (script module, data root, train file, head name, token level, wandb project, wandb entity)
+TASKS = {
+    "ner": ("train_ner_adapter", "data", "train.txt", "ner_head", True, "masakhane-ner-test-run", "double-bind-ner"),
+    "pos": (
+        "train_pos_adapter", "data-pos", "train.txt", "pos_head", True, "masakhane-pos-test-run", "double-bind-ner"
+    ),
+    "news": (
+        "train_news_adapter", "data-news", "train.tsv", "news_head", False, "masakhane-news-test-run", "double-bind-ner"
+    ),
+    "senti": (
+        "train_senti_adapters",
+        "data-sentiment",
+        "train.tsv",
+        "sentment_head",
+        False,
+        "masakhane-sentiment-test-run",
+        "double-bind-sentiment",
+    ),
+}
+
+
+def get_languages(task, languages):
+    _, data_root, train_file, _, token_level, _, _ = TASKS[task]
+    if languages == "all":
+        languages = sorted(os.listdir(data_root))
+    else:
+        languages = languages.split(",")
+
+    found = []
+    for language in languages:
+        data_dir = os.path.join(data_root, language)
+        # Composite directories (token level tasks) train on the sources listed in their sources file
+        if os.path.exists(find_data_file(data_dir, train_file)) or (
+            token_level and os.path.exists(os.path.join(data_dir, SOURCES_FILE))
+        ):
+            found.append(language)
+        else:
+            logger.warning("Skipping %s/%s: no %s in %s", task, language, train_file, data_dir)
+    return found
+
+
+def write_results(path, results):
+    with open(path, "w") as writer:
+        for key in sorted(results.keys()):
+            writer.write("{} = {}\n".format(key, str(results[key])))
+
+
+def run_language(sweep_args, script_argv, task, language, model, tokenizer):
+    module_name, data_root, _, head_name, token_level, project, entity = TASKS[task]
+    script = importlib.import_module(module_name)
+
+    data_dir = os.path.join(data_root, language)
+    args = script.get_parser().parse_args(
+        [
+            "--data_dir", data_dir,
+            "--model_type", sweep_args.model_type,
+            "--model_name_or_path", sweep_args.model_name_or_path,
+            "--output_dir", os.path.join(sweep_args.output_dir, task, language),
+            "--path_to_adapter", sweep_args.path_to_adapter.format(language=language, task=task),
+        ]
+        + script_argv
+    )
+    if getattr(args, "resume_from_checkpoint", None):
+        # The sweep loads the adapter under a per-language name, the checkpoint keys would not match it
+        raise ValueError("--resume_from_checkpoint continues a single run, use {} directly".format(module_name))
+    if not args.labels and os.path.exists(os.path.join(data_dir, "labels.txt")):
+        args.labels = os.path.join(data_dir, "labels.txt")
+    if (
+        os.path.exists(args.output_dir)
+        and os.listdir(args.output_dir)
+        and args.do_train
+        and not args.overwrite_output_dir
+    ):
+        raise ValueError(
+            "Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(
+                args.output_dir
+            )
+        )
+    os.makedirs(args.output_dir, exist_ok=True)
+    args.model_type = args.model_type.lower()
+    args.device = sweep_args.device
+    args.n_gpu = sweep_args.n_gpu
+
+    labels = script.get_labels(args.labels)
+    args.num_labels = len(labels)
+    pad_token_label_id = CrossEntropyLoss().ignore_index
+    script.set_seed(args)
+    if args.use_length_profile:
+        apply_length_profile(args, tokenizer)
+
+    run = wandb.init(
+        project=project,
+        entity=entity,
+        group=sweep_args.run_group or None,
+        name="{}-{}".format(task, language),
+        tags=[tag for tag in args.tags.split(",") if tag] + [task, language],
+        config={key: value for key, value in vars(args).items() if key != "device"},
+        reinit=True,
+    )
+
+    adapter_name = model.load_adapter(args.path_to_adapter, load_as="{}_{}".format(task, language))
+    model.set_active_adapters(adapter_name)
+    if token_level:
+        model.add_tagging_head(head_name, num_labels=len(labels))
+    else:
+        model.add_classification_head(head_name, num_labels=len(labels))
+    # Only the new adapter and head are not on the device yet
+    model.to(args.device)
+
+    try:
+        if args.do_train:
+            if token_level:
+                train_dataset = script.load_and_cache_examples(
+                    args, tokenizer, labels, pad_token_label_id, mode="train"
+                )
+                global_step, tr_loss = script.train(
+                    args, train_dataset, model, tokenizer, labels, pad_token_label_id, adapter_name
+                )
+            else:
+                train_dataset = script.load_and_cache_examples(args, tokenizer, labels, mode="train")
+                dev_dataset = script.load_and_cache_examples(args, tokenizer, labels, mode="dev")
+                global_step, tr_loss = script.train(
+                    args, train_dataset, dev_dataset, labels, model, tokenizer, adapter_name
+                )
+            print(f" {task}/{language}: global_step = {global_step}, average loss = {tr_loss}")
+
+            model.save_adapter(args.output_dir, adapter_name)
+            model.save_head(os.path.join(args.output_dir, head_name), head_name)
+            tokenizer.save_pretrained(args.output_dir)
+            torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
+
+        evaluations = [("dev", args.do_eval, "eval_results.txt"), ("test", args.do_predict, args.test_result_file)]
+        for mode, do_mode, file_name in evaluations:
+            if not do_mode:
+                continue
+            if token_level:
+                result, _ = script.evaluate(args, model, tokenizer, labels, pad_token_label_id, mode=mode)
+            else:
+                result, _ = script.evaluate(args, model, tokenizer, labels, mode=mode)
+            write_results(os.path.join(args.output_dir, file_name), result)
+            wandb.log({"{}_{}".format(mode, key): value for key, value in result.items()})
+    finally:
+        # Detach this language so the next one starts from the bare backbone
+        model.delete_head(head_name)
+        model.delete_adapter(adapter_name)
+        run.finish()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", default="ner", type=str, help="Comma separated tasks from: " + ", ".join(TASKS))
+    parser.add_argument(
+        "--languages",
+        default="all",
+        type=str,
+        help="Comma separated language directories, or 'all' for every language with a training file.",
+    )
+    parser.add_argument("--model_type", default=None, type=str, required=True)
+    parser.add_argument("--model_name_or_path", default=None, type=str, required=True)
+    parser.add_argument(
+        "--tokenizer_name",
+        default="",
+        type=str,
+        help="Pretrained tokenizer name or path if not the same as model_name",
+    )
+    parser.add_argument("--cache_dir", default="", type=str)
+    parser.add_argument(
+        "--path_to_adapter",
+        default=None,
+        type=str,
+        required=True,
+        help="Language adapter path, '{language}' and '{task}' are substituted for every run.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        default=None,
+        type=str,
+        required=True,
+        help="Each run writes to <output_dir>/<task>/<language>.",
+    )
+    parser.add_argument(
+        "--amp",
+        default="off",
+        type=str,
+        choices=AMP_MODES,
+        help="Mixed precision for the forward pass: fp16 (CUDA only, with loss scaling) or bf16 (CUDA or CPU).",
+    )
+    parser.add_argument(
+        "--frozen_dtype",
+        default="fp32",
+        type=str,
+        choices=FROZEN_DTYPES,
+        help="Storage for the shared backbone weights, converted once for all runs: bf16/fp16 (with the same "
+        "--amp) or weight-only int8 (CPU).",
+    )
+    parser.add_argument("--run_group", default="", type=str, help="wandb group shared by the runs of this sweep.")
+    parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
+    sweep_args, script_argv = parser.parse_known_args()
+
+    # Options the task scripts need as well
+    for option in ["tokenizer_name", "cache_dir", "amp", "frozen_dtype"]:
+        if getattr(sweep_args, option):
+            script_argv += ["--" + option, getattr(sweep_args, option)]
+    if sweep_args.no_cuda:
+        script_argv.append("--no_cuda")
+
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+
+    sweep_args.device = torch.device("cuda" if torch.cuda.is_available() and not sweep_args.no_cuda else "cpu")
+    sweep_args.n_gpu = torch.cuda.device_count() if sweep_args.device.type == "cuda" else 0
+
+    runs = []
+    for task in sweep_args.tasks.split(","):
+        runs.extend((task, language) for language in get_languages(task, sweep_args.languages))
+    print("Sweep runs: ", runs)
+
+    model = AutoAdapterModel.from_pretrained(
+        sweep_args.model_name_or_path, cache_dir=sweep_args.cache_dir if sweep_args.cache_dir else None
+    )
+    # The backbone is frozen in every run, its weights are converted once here and left alone by `train()`
+    model.requires_grad_(False)
+    store_frozen_weights(model, sweep_args)
+    model.to(sweep_args.device)
+    tokenizer = AutoTokenizer.from_pretrained(
+        sweep_args.tokenizer_name if sweep_args.tokenizer_name else sweep_args.model_name_or_path,
+        cache_dir=sweep_args.cache_dir if sweep_args.cache_dir else None,
+    )
+
+    for task, language in runs:
+        run_language(sweep_args, script_argv, task, language, model, tokenizer)
+
+
+if __name__ == "__main__":
+    main()
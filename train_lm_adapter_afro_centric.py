@@ -55,6 +55,8 @@ from transformers.trainer_utils import get_last_checkpoint
 from transformers.utils import check_min_version
 from transformers.utils.versions import require_version
 
+from utils_data import strip_compression_extension
+
 
 # Will error if the minimal version of Transformers is not installed. Remove at your own risks.
 check_min_version("4.21.0")
@@ -215,13 +217,17 @@ class DataTrainingArguments:
             raise ValueError("Need either a dataset name or a training/validation file.")
         else:
             if self.train_file is not None:
-                extension = self.train_file.split(".")[-1]
+                extension = strip_compression_extension(self.train_file).split(".")[-1]
                 if extension not in ["csv", "json", "txt"]:
-                    raise ValueError("`train_file` should be a csv, a json or a txt file.")
+                    raise ValueError(
+                        "`train_file` should be a csv, a json or a txt file, optionally .gz or .zst compressed."
+                    )
             if self.validation_file is not None:
-                extension = self.validation_file.split(".")[-1]
+                extension = strip_compression_extension(self.validation_file).split(".")[-1]
                 if extension not in ["csv", "json", "txt"]:
-                    raise ValueError("`validation_file` should be a csv, a json or a txt file.")
+                    raise ValueError(
+                        "`validation_file` should be a csv, a json or a txt file, optionally .gz or .zst compressed."
+                    )
 
 
 def main():
@@ -318,10 +324,10 @@ def main():
         data_files = {}
         if data_args.train_file is not None:
             data_files["train"] = data_args.train_file
-            extension = data_args.train_file.split(".")[-1]
+            extension = strip_compression_extension(data_args.train_file).split(".")[-1]
         if data_args.validation_file is not None:
             data_files["validation"] = data_args.validation_file
-            extension = data_args.validation_file.split(".")[-1]
+            extension = strip_compression_extension(data_args.validation_file).split(".")[-1]
         if extension == "txt":
             extension = "text"
         raw_datasets = load_dataset(
@@ -20,12 +20,13 @@ import glob
 import logging
 import os
 import random
+import time
 
 import numpy as np
 import torch
 from seqeval.metrics import f1_score, precision_score, recall_score, classification_report
 from torch.nn import CrossEntropyLoss
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset, WeightedRandomSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 from torch.utils.data import TensorDataset
@@ -39,8 +40,6 @@ import random
 
 
 from transformers import (
-    WEIGHTS_NAME,
-    AdamW,
     AutoConfig,
     AutoTokenizer,
     XLMRobertaTokenizer,
@@ -49,7 +48,54 @@ from transformers import (
 )
 
 import wandb
-from utils_ner import convert_examples_to_features, get_labels, read_examples_from_file
+from utils_ner import (
+    PREDICTION_FORMATS,
+    convert_examples_to_features,
+    get_labels,
+    read_examples_from_file,
+    write_predictions,
+)
+from utils_features import (
+    SubwordCache,
+    convert_examples_to_features_fast,
+    convert_examples_to_features_parallel,
+    stitch_windows,
+)
+from utils_data import (
+    CompositeDataset,
+    DynamicPaddingCollator,
+    FeatureCache,
+    LengthGroupedBatchSampler,
+    ShardedEvalSampler,
+    apply_length_profile,
+    feature_cache_key,
+    feature_family_key,
+    find_data_file,
+    read_sources,
+)
+from utils_train import (
+    AMP_MODES,
+    FROZEN_DTYPES,
+    TRAINABLE_WEIGHTS_NAME,
+    AdapterCheckpointer,
+    PackedTaggingForward,
+    TokenPredictionAccumulator,
+    all_reduce_sum,
+    amp_autocast,
+    amp_grad_scaler,
+    build_optimizer,
+    checkpoint_step,
+    clip_grad_norm_,
+    distributed_shard,
+    gradient_sync,
+    init_distributed,
+    is_main_process,
+    load_trainable_weights,
+    save_trained_weights,
+    store_frozen_weights,
+    tagging_head_logits,
+    wrap_distributed,
+)
 from torch.utils.data import DataLoader
 
 
@@ -70,14 +116,62 @@ def set_seed(args):
     if args.n_gpu > 0:
         torch.cuda.manual_seed_all(args.seed)
 
+
+def load_model(args, labels, checkpoint=None):
+    """ Builds the pre-trained model with the language adapter and a fresh tagging head.
+
+        With `checkpoint`, a `checkpoint-<step>` directory written during training, the adapter and head weights
+        are restored from it. Returns the model and the name of the adapter.
+    """
+    model = AutoAdapterModel.from_pretrained(args.model_name_or_path)
+    adapter_name = model.load_adapter(args.path_to_adapter)
+    model.set_active_adapters(adapter_name)
+    model.add_tagging_head("ner_head", num_labels=len(labels))
+    if checkpoint is not None:
+        load_trainable_weights(model, checkpoint)
+    return model, adapter_name
+
+
+def get_collate_fn(args, tokenizer, pad_token_label_id):
+    # Features are stored unpadded, each batch is padded to its longest sequence
+    return DynamicPaddingCollator(
+        pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+        pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+        pad_token_label_id=pad_token_label_id,
+        pad_on_left=bool(args.model_type in ["xlnet"]),
+    )
+
 def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, adapter_name):
     model.train_adapter(adapter_name)
+    store_frozen_weights(model, args)
     """ Train the model """
     loss_fct = torch.nn.CrossEntropyLoss()
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    collate_fn = get_collate_fn(args, tokenizer, pad_token_label_id)
+    # Sources of a composite dataset with a weight other than 1 are over- or under-sampled
+    sample_weights = train_dataset.sample_weights() if isinstance(train_dataset, CompositeDataset) else None
+    if args.group_by_length:
+        train_sampler = LengthGroupedBatchSampler(
+            train_dataset.lengths,
+            args.train_batch_size,
+            seed=args.seed,
+            num_replicas=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+            bucket_boundaries=args.bucket_boundaries,
+            sample_weights=sample_weights,
+        )
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn)
+    else:
+        if sample_weights is not None:
+            if args.local_rank != -1:
+                raise ValueError("Weighted training sources in distributed training need --group_by_length")
+            train_sampler = WeightedRandomSampler(sample_weights, int(round(sample_weights.sum())))
+        else:
+            train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(
+            train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn
+        )
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -85,30 +179,19 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, ada
     else:
         t_total = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
 
-    # Prepare optimizer and schedule (linear warmup and decay)
-    no_decay = ["bias", "LayerNorm.weight"]
-    optimizer_grouped_parameters = [
-        {
-            "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
-            "weight_decay": args.weight_decay,
-        },
-        {
-            "params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], 
-            "weight_decay": 0.0
-        },
-    ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
+    # Prepare optimizer and schedule (linear warmup and decay), over the trainable parameters only
+    optimizer, trainable_params = build_optimizer(model, args)
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total
     )
+    scaler = amp_grad_scaler(args)
 
-    # Check if saved optimizer or scheduler states exist
-    if os.path.isfile(os.path.join(args.model_name_or_path, "optimizer.pt")) and os.path.isfile(
-            os.path.join(args.model_name_or_path, "scheduler.pt")
-    ):
-        # Load in optimizer and scheduler states
-        optimizer.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "optimizer.pt")))
-        scheduler.load_state_dict(torch.load(os.path.join(args.model_name_or_path, "scheduler.pt")))
+    # Load in optimizer and scheduler states of the checkpoint training continues from
+    if args.resume_from_checkpoint:
+        optimizer.load_state_dict(
+            torch.load(os.path.join(args.resume_from_checkpoint, "optimizer.pt"), map_location=args.device)
+        )
+        scheduler.load_state_dict(torch.load(os.path.join(args.resume_from_checkpoint, "scheduler.pt")))
 
 
     # Train!
@@ -120,7 +203,7 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, ada
         "  Total train batch size (w. parallel, distributed & accumulation) = ",
         args.train_batch_size
         * args.gradient_accumulation_steps
-        * (1),
+        * (torch.distributed.get_world_size() if args.local_rank != -1 else 1),
     )
     print("  Gradient Accumulation steps = ", args.gradient_accumulation_steps)
     print("  Total optimization steps = ", t_total)
@@ -129,12 +212,9 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, ada
     epochs_trained = 0
     steps_trained_in_current_epoch = 0
     # Check if continuing training from a checkpoint
-    if os.path.exists(args.model_name_or_path):
-        # set global_step to gobal_step of last saved checkpoint from model path
-        try:
-            global_step = int(args.model_name_or_path.split("-")[-1].split("/")[0])
-        except ValueError:
-            global_step = 0
+    if args.resume_from_checkpoint:
+        # set global_step to gobal_step of the checkpoint, its adapter and head weights are already loaded
+        global_step = checkpoint_step(args.resume_from_checkpoint)
         epochs_trained = global_step // (len(train_dataloader) // args.gradient_accumulation_steps)
         steps_trained_in_current_epoch = global_step % (len(train_dataloader) // args.gradient_accumulation_steps)
 
@@ -143,14 +223,20 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, ada
         print("  Continuing training from global step", global_step)
         print(f"  Will skip the first {steps_trained_in_current_epoch} steps in the first epoch")
 
+    # DDP only all-reduces gradients of modules run through its forward, the packed head gets a module of its own
+    train_model = PackedTaggingForward(model, loss_fct.ignore_index) if args.packed_head else model
+    train_model = wrap_distributed(train_model, args)
+
+    checkpointer = AdapterCheckpointer()
     model.zero_grad()
-    train_iterator = trange(
-        epochs_trained, int(args.num_train_epochs), desc="Epoch", disable=args.local_rank not in [-1, 0]
-    )
+    train_iterator = trange(epochs_trained, int(args.num_train_epochs), desc="Epoch", disable=not is_main_process(args))
     set_seed(args)  # Added here for reproductibility
-    for _ in train_iterator:
+    for epoch in train_iterator:
+        if isinstance(train_sampler, (DistributedSampler, LengthGroupedBatchSampler)):
+            train_sampler.set_epoch(epoch)
         tr_loss, logging_loss = 0.0, 0.0
-        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
+        epoch_start, epoch_tokens = time.time(), 0
+        epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=not is_main_process(args))
         for step, batch in enumerate(epoch_iterator):
 
             # Skip past any already trained steps if resuming training
@@ -158,7 +244,8 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, ada
                 steps_trained_in_current_epoch -= 1
                 continue
 
-            model.train()
+            train_model.train()
+            epoch_tokens += int(batch[1].sum())
             batch = tuple(t.to(args.device) for t in batch)
             inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
             if args.model_type != "distilbert":
@@ -166,115 +253,101 @@ def train(args, train_dataset, model, tokenizer, labels, pad_token_label_id, ada
                     batch[2] if args.model_type in ["bert", "xlnet"] else None
                 )  # XLM and RoBERTa don"t use segment_ids
 
-            logits = model(inputs["input_ids"])['logits']#, attention_mask=inputs["attention_mask"], output_hidden_states=True)
-
-            active_loss = inputs["attention_mask"].view(-1) == 1
-            active_logits = logits.view(-1, args.num_labels)
-            active_labels = torch.where(
+            # Gradients are all-reduced across ranks on the last micro-batch of an accumulation step only
+            with gradient_sync(train_model, (step + 1) % args.gradient_accumulation_steps == 0):
+                with amp_autocast(args):
+                    if args.packed_head:
+                        active_logits, active_labels = train_model(
+                            inputs["input_ids"], inputs["attention_mask"], inputs["labels"]
+                        )
+                    else:
+                        logits = train_model(inputs["input_ids"], attention_mask=inputs["attention_mask"])['logits']
 
-                active_loss, inputs["labels"].view(-1), torch.tensor(loss_fct.ignore_index).type_as(inputs["labels"])
-            )
-            loss = loss_fct(active_logits, active_labels)
+                        active_loss = inputs["attention_mask"].view(-1) == 1
+                        active_logits = logits.view(-1, args.num_labels)
+                        active_labels = torch.where(
+                            active_loss,
+                            inputs["labels"].view(-1),
+                            torch.tensor(loss_fct.ignore_index).type_as(inputs["labels"]),
+                        )
+                    loss = loss_fct(active_logits, active_labels)
 
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
 
-            loss.backward()
+                scaler.scale(loss).backward()
 
             tr_loss += loss.item()
 
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                scaler.unscale_(optimizer)
+                clip_grad_norm_(trainable_params, args.max_grad_norm)
                 
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()  # Update learning rate schedule
-                model.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 global_step += 1
 
-                if args.local_rank in [-1, 0] and args.logging_steps > 0 and global_step % args.logging_steps == 0:
-                    # Log metrics
-                    if (
-                            args.local_rank == -1 and args.evaluate_during_training
-                    ):  # Only evaluate when single GPU otherwise metrics may not average well
+                if args.logging_steps > 0 and global_step % args.logging_steps == 0:
+                    # Log metrics, every rank takes part in the (sharded) evaluation
+                    if args.evaluate_during_training:
                         results, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev")
                         for key, value in results.items():
                             wandb.log({f"eval_{key}": value})
                     logging_loss = tr_loss
 
-                if args.local_rank in [-1, 0] and args.save_steps > 0 and global_step % args.save_steps == 0:
-                    # Save model checkpoint
+                if is_main_process(args) and args.save_steps > 0 and global_step % args.save_steps == 0:
+                    # Save the adapter and head weights with their optimizer state, written in the background
                     output_dir = os.path.join(args.output_dir, "checkpoint-{}".format(global_step))
-                    if not os.path.exists(output_dir):
-                        os.makedirs(output_dir)
-
-                    model_to_save = (
-                        model.module if hasattr(model, "module") else model
-                    )
-
-                    model_to_save.save_pretrained(args.output_dir)
-                    tokenizer.save_pretrained(args.output_dir)
-
-                    # Good practice: save your training arguments together with the trained model
-                    torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
-                    
-                    
-                    print("Saving model checkpoint to ", output_dir)
-
-                    torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
-                    torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
-                    print("Saving optimizer and scheduler states to", output_dir)
+                    checkpointer.save(output_dir, model, optimizer, scheduler, training_args=args)
+                    print("Saving adapter checkpoint to ", output_dir)
 
             if args.max_steps > 0 and global_step > args.max_steps:
                 epoch_iterator.close()
                 break
 
-        output_dir = os.path.join(args.output_dir, "checkpoint-{}".format(global_step))
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        model_to_save = (
-            model.module if hasattr(model, "module") else model
-        )
-
-        model_to_save.save_pretrained(args.output_dir)
-        tokenizer.save_pretrained(args.output_dir)
-
-        # Good practice: save your training arguments together with the trained model
-        torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
-        
-        
-        print("Saving model checkpoint to ", output_dir)
-
-        torch.save(optimizer.state_dict(), os.path.join(output_dir, "optimizer.pt"))
-        torch.save(scheduler.state_dict(), os.path.join(output_dir, "scheduler.pt"))
-        print("Saving optimizer and scheduler states to", output_dir)
-        print("training loss", tr_loss / args.logging_steps)
-        wandb.log({
-            f"lr": scheduler.get_lr()[0],
-            f"train_loss": tr_loss / args.logging_steps
-        })
+        if is_main_process(args):
+            output_dir = os.path.join(args.output_dir, "checkpoint-{}".format(global_step))
+            checkpointer.save(output_dir, model, optimizer, scheduler, training_args=args)
+            print("Saving adapter checkpoint to ", output_dir)
+            print("training loss", tr_loss / args.logging_steps)
+            wandb.log({
+                f"lr": scheduler.get_lr()[0],
+                f"train_loss": tr_loss / args.logging_steps,
+                # Tokens of this rank, the job processes world size times as many
+                f"train_tokens_per_sec": epoch_tokens / (time.time() - epoch_start),
+            })
         if args.max_steps > 0 and global_step > args.max_steps:
             train_iterator.close()
             break
 
-    for i in os.listdir(args.output_dir):
-        wandb.save(f"{args.output_dir}/{i}")
+    checkpointer.wait()
+
+    if is_main_process(args):
+        for i in os.listdir(args.output_dir):
+            wandb.save(f"{args.output_dir}/{i}")
 
     return global_step, tr_loss / global_step
 
 
-def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""):
+def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix="", return_probabilities=False):
     eval_dataset = load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode=mode)
 
     loss_fct = torch.nn.CrossEntropyLoss()
 
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset) if args.local_rank == -1 else DistributedSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    # Every rank evaluates its own shard of the split, the predictions are gathered before scoring
+    eval_sampler = ShardedEvalSampler(eval_dataset, *distributed_shard(args))
+    eval_dataloader = DataLoader(
+        eval_dataset,
+        sampler=eval_sampler,
+        batch_size=args.eval_batch_size,
+        collate_fn=get_collate_fn(args, tokenizer, pad_token_label_id),
+    )
 
-    # multi-gpu evaluate
-    if args.n_gpu > 1:
+    # multi-gpu evaluate (the packed head runs on the unwrapped model)
+    if args.n_gpu > 1 and args.local_rank == -1 and not args.packed_head:
         model = torch.nn.DataParallel(model)
 
     # Eval!
@@ -283,14 +356,14 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
     print("  Batch size =", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    out_label_ids = None
+    # Predictions stay on the device until the end of the run
+    accumulator = TokenPredictionAccumulator(len(labels), pad_token_label_id)
 
     model.eval()
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         batch = tuple(t.to(args.device) for t in batch)
 
-        with torch.no_grad():
+        with torch.no_grad(), amp_autocast(args):
             inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[3]}
             if args.model_type != "distilbert":
                 inputs["token_type_ids"] = (
@@ -299,41 +372,47 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
             #outputs = model(**inputs)
             #tmp_eval_loss, logits = outputs[:2]
 
-            logits = model(inputs["input_ids"])['logits']#, attention_mask=inputs["attention_mask"], output_hidden_states=True)
-
-            active_loss = inputs["attention_mask"].view(-1) == 1
-            active_logits = logits.view(-1, args.num_labels)
-            active_labels = torch.where(
-
-                active_loss, inputs["labels"].view(-1), torch.tensor(loss_fct.ignore_index).type_as(inputs["labels"])
-            )
+            if args.packed_head:
+                active_logits, active_labels = tagging_head_logits(
+                    model, inputs["input_ids"], inputs["attention_mask"], inputs["labels"], loss_fct.ignore_index
+                )
+                batch_preds = active_logits.argmax(-1)
+                batch_probabilities = active_logits.float().softmax(-1) if return_probabilities else None
+            else:
+                logits = model(inputs["input_ids"], attention_mask=inputs["attention_mask"])['logits']
+
+                active_loss = inputs["attention_mask"].view(-1) == 1
+                active_logits = logits.view(-1, args.num_labels)
+                active_labels = torch.where(
+
+                    active_loss, inputs["labels"].view(-1), torch.tensor(loss_fct.ignore_index).type_as(inputs["labels"])
+                )
+                batch_preds = logits.argmax(-1)
+                batch_probabilities = logits.float().softmax(-1) if return_probabilities else None
             tmp_eval_loss = loss_fct(active_logits, active_labels)
 
             if args.n_gpu > 1:
                 tmp_eval_loss = tmp_eval_loss.mean()  # mean() to average on multi-gpu parallel evaluating
 
-            eval_loss += tmp_eval_loss.item()
+            eval_loss += tmp_eval_loss.detach()
         nb_eval_steps += 1
-        if preds is None:
-            preds = logits.detach().cpu().numpy()
-            out_label_ids = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-            out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+        accumulator.add(batch_preds, inputs["labels"], batch_probabilities)
 
+    eval_loss, nb_eval_steps = all_reduce_sum(args, float(eval_loss), nb_eval_steps)
     eval_loss = eval_loss / nb_eval_steps
-    preds = np.argmax(preds, axis=2)
-
-    label_map = {i: label for i, label in enumerate(labels)}
-
-    out_label_list = [[] for _ in range(out_label_ids.shape[0])]
-    preds_list = [[] for _ in range(out_label_ids.shape[0])]
 
-    for i in range(out_label_ids.shape[0]):
-        for j in range(out_label_ids.shape[1]):
-            if out_label_ids[i, j] != pad_token_label_id:
-                out_label_list[i].append(label_map[out_label_ids[i][j]])
-                preds_list[i].append(label_map[preds[i][j]])
+    accumulator.gather(args.device, probabilities=return_probabilities)
+    out_label_list, preds_list = accumulator.decode(labels)
+    probabilities_list = accumulator.decode_probabilities() if return_probabilities else None
+    example_indices = eval_dataset.example_indices()
+    if example_indices is not None:
+        # One sequence per corpus sentence: the windows of long sentences are joined back, and sentences the
+        # conversion dropped are left empty so the predictions stay aligned with the test file
+        num_examples = eval_dataset.meta.get("num_source_examples")
+        out_label_list = stitch_windows(out_label_list, example_indices, num_examples)
+        preds_list = stitch_windows(preds_list, example_indices, num_examples)
+        if return_probabilities:
+            probabilities_list = stitch_windows(probabilities_list, example_indices, num_examples)
 
     results = {}
     if mode=="dev":
@@ -360,57 +439,95 @@ def evaluate(args, model, tokenizer, labels, pad_token_label_id, mode, prefix=""
     for key in sorted(results.keys()):
         print(f"{key} = {str(results[key])}")
 
+    if return_probabilities:
+        return results, preds_list, probabilities_list
     return results, preds_list
 
-def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode):
-    if args.local_rank not in [-1, 0] and not evaluate:
-        torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
-
-    # Load data features from cache or dataset file
-    cached_features_file = os.path.join(
-        args.data_dir,
-        "cached_{}_{}_{}".format(
-            mode, list(filter(None, args.model_name_or_path.split("/"))).pop(), str(args.max_seq_length)
-        ),
+def load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode, data_dir=None):
+    data_dir = data_dir or args.data_dir
+    sources = read_sources(data_dir, args.train_sources) if mode == "train" and data_dir == args.data_dir else None
+    if sources:
+        # A virtual concatenation of the sources, each read from its own feature cache
+        datasets = [
+            load_and_cache_examples(args, tokenizer, labels, pad_token_label_id, mode, data_dir=source)
+            for source, _ in sources
+        ]
+        dataset = CompositeDataset(
+            datasets,
+            [weight for _, weight in sources],
+            [os.path.basename(os.path.normpath(source)) for source, _ in sources],
+        )
+        logger.info("Composite %s set: %s", mode, dataset.describe())
+        return dataset
+
+    conversion_kwargs = dict(
+        cls_token_at_end=bool(args.model_type in ["xlnet"]),
+        # xlnet has a cls token at the end
+        cls_token=tokenizer.cls_token,
+        cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
+        sep_token=tokenizer.sep_token,
+        sep_token_extra=bool(args.model_type in ["roberta"]),
+        # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
+        pad_on_left=bool(args.model_type in ["xlnet"]),
+        # pad on the left for xlnet
+        pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
+        pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
+        pad_token_label_id=pad_token_label_id,
+        pad_to_max_length=False,
     )
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
-        print("Loading features from cached file", cached_features_file)
-        features = torch.load(cached_features_file)
-    else:
-        print("Creating features from dataset file at", args.data_dir)
-        examples = read_examples_from_file(args.data_dir, mode)
-        features = convert_examples_to_features(
+    if args.doc_stride:
+        conversion_kwargs["doc_stride"] = args.doc_stride
+    # Features are cached under a hash of the data file, labels, tokenizer and conversion parameters
+    data_file = find_data_file(data_dir, "{}.txt".format(mode))
+    key_params = dict(features="token_classification", max_seq_length=args.max_seq_length, **conversion_kwargs)
+    cache_key = feature_cache_key(data_file, labels, tokenizer, **key_params)
+    # Earlier versions of the same file converted the same way, their unchanged sentences are not converted again
+    family_key = feature_family_key(data_file, labels, tokenizer, **key_params)
+
+    def convert_examples(examples):
+        print("Creating features from dataset file at", data_dir)
+        # Batch whole sentences through the Rust tokenizer when we have one, the output is identical
+        # Windowing is only implemented for fast tokenizers, the fast conversion raises a ValueError otherwise
+        use_fast = tokenizer.is_fast or args.doc_stride
+        convert_fn = convert_examples_to_features_fast if use_fast else convert_examples_to_features
+        # Frequent words are tokenized once, the memo is shared by every split and task using this tokenizer
+        subword_cache = None
+        if use_fast and args.subword_cache_size > 0:
+            subword_cache = SubwordCache(
+                tokenizer, max_size=args.subword_cache_size, cache_dir=os.path.join(features_cache.cache_dir, "subwords")
+            )
+        features = convert_examples_to_features_parallel(
+            convert_fn,
             examples,
             labels,
             args.max_seq_length,
             tokenizer,
-            cls_token_at_end=bool(args.model_type in ["xlnet"]),
-            # xlnet has a cls token at the end
-            cls_token=tokenizer.cls_token,
-            cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
-            sep_token=tokenizer.sep_token,
-            sep_token_extra=bool(args.model_type in ["roberta"]),
-            # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-            pad_on_left=bool(args.model_type in ["xlnet"]),
-            # pad on the left for xlnet
-            pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-            pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
-            pad_token_label_id=pad_token_label_id,
+            num_workers=args.preprocessing_num_workers,
+            subword_cache=subword_cache,
+            **conversion_kwargs,
         )
-        if args.local_rank in [-1, 0]:
-            print("Saving features into cached file", cached_features_file)
-            torch.save(features, cached_features_file)
-
-    if args.local_rank == 0 and not evaluate:
-        torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
-
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_ids for f in features], dtype=torch.long)
-
-    dataset = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        if subword_cache is not None:
+            logger.info("Subword cache: %s", subword_cache.stats())
+            subword_cache.save()
+        return features
+
+    # Features are memory-mapped from the cache and padded per batch by the collate function, on a miss every
+    # rank converts its own shard of the examples
+    num_shards, shard = distributed_shard(args)
+    features_cache = FeatureCache(
+        args.features_cache_dir,
+        max_size=int(args.features_cache_size_gb * 1024 ** 3),
+        num_shards=num_shards,
+        shard=shard,
+    )
+    dataset = features_cache.load_or_update(
+        cache_key,
+        family_key,
+        lambda: read_examples_from_file(data_dir, mode),
+        convert_examples,
+        name="{}-{}".format(mode, os.path.basename(os.path.normpath(data_dir))),
+        overwrite=args.overwrite_cache,
+    )
     return dataset
 
 
@@ -470,6 +587,14 @@ def main():
         required=False,
         help="The test_result",
     )
+    parser.add_argument(
+        "--prediction_formats",
+        default=["conll"],
+        nargs="+",
+        choices=PREDICTION_FORMATS,
+        help="Formats of the test predictions. jsonl and arrow also carry the label probabilities of every word and "
+        "are written next to test_prediction_file with their own extension.",
+    )
 
     # Other parameters
     parser.add_argument(
@@ -500,6 +625,13 @@ def main():
         help="The maximum total input sequence length after tokenization. Sequences longer "
         "than this will be truncated, sequences shorter will be padded.",
     )
+    parser.add_argument(
+        "--doc_stride",
+        default=None,
+        type=int,
+        help="Split sentences longer than max_seq_length into overlapping windows starting every doc_stride "
+        "subwords instead of truncating them, the predictions are joined back per word.",
+    )
     parser.add_argument("--do_train", action="store_true", help="Whether to run training.")
     parser.add_argument("--do_finetune", action="store_true", help="Whether to run training.")
     parser.add_argument("--do_eval", action="store_true", help="Whether to run eval on the dev set.")
@@ -537,6 +669,44 @@ def main():
         help="If > 0: set total number of training steps to perform. Override num_train_epochs.",
     )
     parser.add_argument("--warmup_steps", default=0, type=int, help="Linear warmup over warmup_steps.")
+    parser.add_argument(
+        "--packed_head",
+        action="store_true",
+        help="Run the tagging head and loss only on labelled tokens instead of every padded position.",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch training sentences of similar length together to reduce padding.",
+    )
+    parser.add_argument(
+        "--bucket_boundaries",
+        default=None,
+        type=int,
+        nargs="+",
+        help="With --group_by_length, batch within fixed length buckets, bucket i holding the lengths up to the "
+        "i-th boundary.",
+    )
+    parser.add_argument(
+        "--use_length_profile",
+        action="store_true",
+        help="Take max_seq_length and bucket_boundaries from the length profile written to data_dir by "
+        "profile_datasets.py.",
+    )
+    parser.add_argument(
+        "--amp",
+        default="off",
+        type=str,
+        choices=AMP_MODES,
+        help="Mixed precision for the forward pass: fp16 (CUDA only, with loss scaling) or bf16 (CUDA or CPU).",
+    )
+    parser.add_argument(
+        "--frozen_dtype",
+        default="fp32",
+        type=str,
+        choices=FROZEN_DTYPES,
+        help="Storage for the frozen backbone weights: bf16/fp16 (with the same --amp) or weight-only int8 (CPU).",
+    )
 
     parser.add_argument("--logging_steps", type=int, default=500, help="Log every X updates steps.")
     parser.add_argument("--save_steps", type=int, default=500, help="Save checkpoint every X updates steps.")
@@ -545,6 +715,13 @@ def main():
         action="store_true",
         help="Evaluate all checkpoints starting with the same prefix as model_name ending and ending with step number",
     )
+    parser.add_argument(
+        "--resume_from_checkpoint",
+        type=str,
+        default=None,
+        help="A checkpoint-<step> directory of --output_dir to continue training from, its adapter and head "
+        "weights, optimizer and scheduler states are restored",
+    )
     parser.add_argument("--no_cuda", action="store_true", help="Avoid using CUDA when available")
     parser.add_argument(
         "--overwrite_output_dir", action="store_true", help="Overwrite the content of the output directory"
@@ -552,9 +729,48 @@ def main():
     parser.add_argument(
         "--overwrite_cache", action="store_true", help="Overwrite the cached training and evaluation sets"
     )
+    parser.add_argument(
+        "--preprocessing_num_workers",
+        default=None,
+        type=int,
+        help="The number of processes to use for the feature conversion.",
+    )
+    parser.add_argument(
+        "--subword_cache_size",
+        default=200000,
+        type=int,
+        help="Number of words whose subword ids are memoized (and kept next to the features cache) during the "
+        "feature conversion, 0 to tokenize every sentence.",
+    )
+    parser.add_argument(
+        "--train_sources",
+        default="",
+        type=str,
+        help="Train on a composite of data directories instead of data_dir's train file, e.g. "
+        "'en_ewt + ro_rrt + wol:2 + sna' (names are looked up next to data_dir, ':2' samples a source twice as "
+        "often). Defaults to the sources.txt of data_dir if it has one.",
+    )
+    parser.add_argument(
+        "--features_cache_dir",
+        default="",
+        type=str,
+        help="Shared directory for cached features, defaults to ~/.cache/double-bind-training/features.",
+    )
+    parser.add_argument(
+        "--features_cache_size_gb",
+        default=20.0,
+        type=float,
+        help="Delete the least recently used cached features when the cache grows past this size.",
+    )
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
 
-    parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
+    parser.add_argument(
+        "--local_rank",
+        "--local-rank",
+        type=int,
+        default=int(os.environ.get("LOCAL_RANK", -1)),
+        help="For distributed training: local_rank, taken from the environment under torchrun",
+    )
     parser.add_argument("--server_ip", type=str, default="", help="For distant debugging.")
     parser.add_argument("--server_port", type=str, default="", help="For distant debugging.")
     parser.add_argument("--tags", type=str, default="", help="Set the tag for wandb project run.")
@@ -562,6 +778,7 @@ def main():
 
     args = parser.parse_args()
     
+    # Only the main process of a distributed job logs to wandb
     wandb.init(project="masakhane-ner-test-run", entity="double-bind-ner", tags=args.tags.split(','), config = {
         "max length": os.getenv('MAX_LENGTH'),
         "adapter model": os.getenv('ADAPTER_MODEL'),
@@ -570,7 +787,7 @@ def main():
         "epochs": os.getenv('NUM_EPOCHS'),
         "save steps": os.getenv('SAVE_STEPS'),
         "seed": os.getenv('SEED'),
-    })
+    }, mode=None if is_main_process(args) else "disabled")
 
     if (
         os.path.exists(args.output_dir)
@@ -593,22 +810,14 @@ def main():
         ptvsd.enable_attach(address=(args.server_ip, args.server_port), redirect_output=True)
         ptvsd.wait_for_attach()
 
-    # Setup CUDA, GPU & distributed training
-    if args.local_rank == -1 or args.no_cuda:
-        device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
-        args.n_gpu = torch.cuda.device_count()
-    else:  # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-        torch.cuda.set_device(args.local_rank)
-        device = torch.device("cuda", args.local_rank)
-        torch.distributed.init_process_group(backend="nccl")
-        args.n_gpu = 1
-    args.device = device
+    # Setup CUDA, GPU & distributed training (NCCL on GPUs, gloo on CPU-only hosts)
+    init_distributed(args)
 
     # Setup logging
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
         datefmt="%m/%d/%Y %H:%M:%S",
-        level=logging.INFO if args.local_rank in [-1, 0] else logging.WARN,
+        level=logging.INFO if is_main_process(args) else logging.WARN,
     )
 
     # Set seed
@@ -633,12 +842,7 @@ def main():
     else:
         config_class, model_class, tokenizer_class = AutoConfig, AutoAdapterModel, AutoTokenizer #MODEL_CLASSES[args.model_type]
     
-    model = model_class.from_pretrained(args.model_name_or_path)
-    
-    adapter_name = model.load_adapter(args.path_to_adapter)
-    model.set_active_adapters(adapter_name)
-        
-    model.add_tagging_head("ner_head", num_labels=len(labels))
+    model, adapter_name = load_model(args, labels, args.resume_from_checkpoint)
     print(model)
 
     tokenizer = tokenizer_class.from_pretrained(
@@ -651,6 +855,9 @@ def main():
     if args.local_rank == 0:
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
+    if args.use_length_profile:
+        apply_length_profile(args, tokenizer)
+
     model.to(args.device)
     print("Training/evaluation parameters", args)
 
@@ -690,67 +897,85 @@ def main():
         )  # Take care of distributed/parallel training
 
         tokenizer.save_pretrained(args.output_dir)
-        model_to_save.save_pretrained(args.output_dir)
+        save_trained_weights(model_to_save, args.output_dir, args)
 
         # Good practice: save your training arguments together with the trained model
         torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
 
-    # Evaluation
+    if args.local_rank != -1 and (args.do_eval or args.do_predict):
+        torch.distributed.barrier()  # Make sure the main process has saved the tokenizer the evaluation reloads
+
+    # Evaluation, every rank evaluates a shard and the main process writes the results
     results = {}
-    if args.do_eval and args.local_rank in [-1, 0]:
+    if args.do_eval:
         tokenizer = tokenizer_class.from_pretrained(args.output_dir, do_lower_case=args.do_lower_case)
         checkpoints = [args.output_dir]
         if args.eval_all_checkpoints:
-            checkpoints = list(
-                os.path.dirname(c) for c in sorted(glob.glob(args.output_dir + "/**/" + WEIGHTS_NAME, recursive=True))
+            # Checkpoints hold the adapter and head weights only, the final model is the one in memory
+            checkpoints += sorted(
+                (
+                    os.path.dirname(c)
+                    for c in glob.glob(args.output_dir + "/**/" + TRAINABLE_WEIGHTS_NAME, recursive=True)
+                ),
+                key=checkpoint_step,
             )
             logging.getLogger("pytorch_transformers.modeling_utils").setLevel(logging.WARN)  # Reduce logging
         print("Evaluate the following checkpoints: ", checkpoints)
         for checkpoint in checkpoints:
-            global_step = checkpoint.split("-")[-1] if len(checkpoints) > 1 else ""
-
-            #model = model_class.from_pretrained(checkpoint)
-            #model.set_active_adapters("mlm")
-            #model.to(args.device)
-            
-            #print(model)
-            result, _ = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
+            if checkpoint == args.output_dir:
+                global_step, eval_model = "", model
+            else:
+                global_step = str(checkpoint_step(checkpoint))
+                eval_model, _ = load_model(args, labels, checkpoint)
+                eval_model.to(args.device)
+            result, _ = evaluate(args, eval_model, tokenizer, labels, pad_token_label_id, mode="dev", prefix=global_step)
+            del eval_model
             if global_step:
                 result = {"{}_{}".format(global_step, k): v for k, v in result.items()}
             results.update(result)
-        output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
-        with open(output_eval_file, "w") as writer:
-            for key in sorted(results.keys()):
-                writer.write("{} = {}\n".format(key, str(results[key])))
+        if is_main_process(args):
+            output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
+            with open(output_eval_file, "w") as writer:
+                for key in sorted(results.keys()):
+                    writer.write("{} = {}\n".format(key, str(results[key])))
 
-    if args.do_predict and args.local_rank in [-1, 0]:
+    if args.do_predict:
         tokenizer = tokenizer_class.from_pretrained(args.output_dir, do_lower_case=args.do_lower_case)
         #model = model_class.from_pretrained(args.output_dir)
         #model.set_active_adapters("mlm")
         #model.to(args.device)
-        result, predictions = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="test")
-        # Save results
-        output_test_results_file = os.path.join(args.output_dir, args.test_result_file)
-        with open(output_test_results_file, "w") as writer:
-            for key in sorted(result.keys()):
-                writer.write("{} = {}\n".format(key, str(result[key])))
-        # Save predictions
-        output_test_predictions_file = os.path.join(args.output_dir, args.test_prediction_file)
-        with open(output_test_predictions_file, "w") as writer:
-            with open(os.path.join(args.data_dir, "test.txt"), "r") as f:
-                example_id = 0
-                for line in f:
-                    if line.startswith("-DOCSTART-") or line == "" or line == "\n":
-                        writer.write(line)
-                        if not predictions[example_id]:
-                            example_id += 1
-                    elif predictions[example_id]:
-                        output_line = line.split()[0] + " " + predictions[example_id].pop(0) + "\n"
-                        writer.write(output_line)
-                    else:
-                        logger.warning("Maximum sequence length exceeded: No prediction for '%s'.", line.split()[0])
-    
+        probabilities = None
+        if any(output_format != "conll" for output_format in args.prediction_formats):
+            result, predictions, probabilities = evaluate(
+                args, model, tokenizer, labels, pad_token_label_id, mode="test", return_probabilities=True
+            )
+        else:
+            result, predictions = evaluate(args, model, tokenizer, labels, pad_token_label_id, mode="test")
+        if is_main_process(args):
+            # Save results
+            output_test_results_file = os.path.join(args.output_dir, args.test_result_file)
+            with open(output_test_results_file, "w") as writer:
+                for key in sorted(result.keys()):
+                    writer.write("{} = {}\n".format(key, str(result[key])))
+            # Save predictions, the words come from the parsed test file
+            test_corpus = read_examples_from_file(args.data_dir, "test")
+            output_test_predictions_file = os.path.join(args.output_dir, args.test_prediction_file)
+            for output_format in args.prediction_formats:
+                output_file = output_test_predictions_file
+                if output_format != "conll":
+                    output_file = "{}.{}".format(os.path.splitext(output_test_predictions_file)[0], output_format)
+                write_predictions(
+                    test_corpus,
+                    predictions,
+                    output_file,
+                    output_format,
+                    probabilities=probabilities,
+                    label_list=labels,
+                )
+
     wandb.finish(exit_code=0)
+    if args.local_rank != -1:
+        torch.distributed.destroy_process_group()
     return results
 
 if __name__ == "__main__":
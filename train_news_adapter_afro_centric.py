@@ -41,7 +41,6 @@ import random
 
 from transformers import (
     WEIGHTS_NAME,
-    AdamW,
     AutoConfig,
     AutoTokenizer,
     XLMRobertaTokenizer,
@@ -53,6 +52,30 @@ import wandb
 from utils_news import convert_examples_to_features, get_labels, read_examples_from_file
 from torch.utils.data import DataLoader
 import sklearn.metrics
+from utils_data import (
+    DynamicPaddingCollator,
+    FeatureCache,
+    LengthGroupedBatchSampler,
+    ShardedEvalSampler,
+    apply_length_profile,
+    feature_cache_key,
+    feature_family_key,
+    find_data_file,
+    open_data_file,
+)
+from utils_train import (
+    AMP_MODES,
+    FROZEN_DTYPES,
+    all_gather_variable,
+    all_reduce_sum,
+    amp_autocast,
+    amp_grad_scaler,
+    build_optimizer,
+    clip_grad_norm_,
+    distributed_shard,
+    save_trained_weights,
+    store_frozen_weights,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -77,13 +100,28 @@ def set_seed(args):
 
 def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_name):
     model.train_adapter(adapter_name)
+    store_frozen_weights(model, args)
     """ Train the model """
     if args.local_rank in [-1, 0]:
       tb_writer = SummaryWriter()
     # loss_fct = torch.nn.CrossEntropyLoss()
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
-    train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
-    train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+    collate_fn = DynamicPaddingCollator(pad_token=tokenizer.pad_token_id)
+    if args.group_by_length:
+        train_sampler = LengthGroupedBatchSampler(
+            train_dataset.lengths,
+            args.train_batch_size,
+            seed=args.seed,
+            num_replicas=torch.distributed.get_world_size() if args.local_rank != -1 else 1,
+            rank=torch.distributed.get_rank() if args.local_rank != -1 else 0,
+            bucket_boundaries=args.bucket_boundaries,
+        )
+        train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, collate_fn=collate_fn)
+    else:
+        train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
+        train_dataloader = DataLoader(
+            train_dataset, sampler=train_sampler, batch_size=args.train_batch_size, collate_fn=collate_fn
+        )
 
     if args.max_steps > 0:
         t_total = args.max_steps
@@ -91,19 +129,12 @@ def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_n
     else:
         t_total = len(train_dataloader) // args.gradient_accumulation_steps * args.num_train_epochs
 
-    # Prepare optimizer and schedule (linear warmup and decay)
-    no_decay = ["bias", "LayerNorm.weight"]
-    optimizer_grouped_parameters = [
-        {
-            "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
-            "weight_decay": args.weight_decay,
-        },
-        {"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], "weight_decay": 0.0},
-    ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate, eps=args.adam_epsilon)
+    # Prepare optimizer and schedule (linear warmup and decay), over the trainable parameters only
+    optimizer, trainable_params = build_optimizer(model, args)
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=t_total
     )
+    scaler = amp_grad_scaler(args)
 
     # Check if saved optimizer or scheduler states exist
     '''
@@ -162,7 +193,9 @@ def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_n
     set_seed(args)  # Added here for reproductibility
 
     eval_fones = []
-    for _ in train_iterator:
+    for epoch in train_iterator:
+        if isinstance(train_sampler, (DistributedSampler, LengthGroupedBatchSampler)):
+            train_sampler.set_epoch(epoch)
         epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
         for step, batch in enumerate(epoch_iterator):
             # Skip past any already trained steps if resuming training
@@ -177,7 +210,8 @@ def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_n
                 inputs["token_type_ids"] = (
                     batch[2] if args.model_type in ["bert"] else None
                 )  # XLM and DistilBERT don't use segment_ids
-            outputs = model(**inputs)
+            with amp_autocast(args):
+                outputs = model(**inputs)
             loss = outputs[0]  # model outputs are always tuple in transformers (see doc)
 
             if args.n_gpu > 1:
@@ -185,15 +219,17 @@ def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_n
             if args.gradient_accumulation_steps > 1:
                 loss = loss / args.gradient_accumulation_steps
 
-            loss.backward()
+            scaler.scale(loss).backward()
 
             tr_loss += loss.item()
             if (step + 1) % args.gradient_accumulation_steps == 0:
-                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
+                scaler.unscale_(optimizer)
+                clip_grad_norm_(trainable_params, args.max_grad_norm)
 
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
                 scheduler.step()  # Update learning rate schedule
-                model.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
                 global_step += 1
 
 
@@ -202,8 +238,10 @@ def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_n
                 break
 
         # EVALUATE + EARLY STOPPING
-        if global_step > 500 and args.n_gpu == 1: # and global_step % args.save_steps == 0:
-            eval_results, _ = evaluate(args, model, tokenizer, labels, "dev", display_res=True)
+        if global_step > 500: # and global_step % args.save_steps == 0:
+            # Every rank evaluates a shard, with the unwrapped model as the shards may differ by one batch
+            eval_model = model.module if args.local_rank != -1 else model
+            eval_results, _ = evaluate(args, eval_model, tokenizer, labels, "dev", display_res=True)
             f1_step = round(eval_results["eval_acc"], 5)
             eval_fones.append(f1_step)
             print("eval result: ", global_step, f1_step)
@@ -219,14 +257,14 @@ def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_n
 
             max_f1 = max(eval_fones)
 
-            if f1_step == max_f1:
+            if f1_step == max_f1 and args.local_rank in [-1, 0]:
                 output_dir = args.output_dir
                 if not os.path.exists(output_dir):
                     os.makedirs(output_dir)
                 model_to_save = (
                     model.module if hasattr(model, "module") else model
                 )  # Take care of distributed/parallel training
-                model_to_save.save_pretrained(output_dir)
+                save_trained_weights(model_to_save, output_dir, args)
                 tokenizer.save_pretrained(output_dir)
 
                 torch.save(args, os.path.join(output_dir, "training_args.bin"))
@@ -247,7 +285,7 @@ def train(args, train_dataset, dev_dataset, labels, model, tokenizer,  adapter_n
     model_to_save = (
         model.module if hasattr(model, "module") else model
     )  # Take care of distributed/parallel training
-    model_to_save.save_pretrained(output_dir)
+    save_trained_weights(model_to_save, output_dir, args)
     tokenizer.save_pretrained(output_dir)
 
     torch.save(args, os.path.join(output_dir, "training_args.bin"))
@@ -267,9 +305,14 @@ def evaluate(args, model, tokenizer, labels, mode, prefix="", display_res=False)
     eval_dataset = load_and_cache_examples(args, tokenizer, labels, mode)
     
     args.eval_batch_size = args.per_gpu_eval_batch_size * max(1, args.n_gpu)
-    # Note that DistributedSampler samples randomly
-    eval_sampler = SequentialSampler(eval_dataset)
-    eval_dataloader = DataLoader(eval_dataset, sampler=eval_sampler, batch_size=args.eval_batch_size)
+    # Every rank evaluates its own shard of the split, the predictions are gathered before scoring
+    eval_sampler = ShardedEvalSampler(eval_dataset, *distributed_shard(args))
+    eval_dataloader = DataLoader(
+        eval_dataset,
+        sampler=eval_sampler,
+        batch_size=args.eval_batch_size,
+        collate_fn=DynamicPaddingCollator(pad_token=tokenizer.pad_token_id),
+    )
 
     # multi-gpu eval
     #if args.n_gpu > 1:
@@ -281,13 +324,14 @@ def evaluate(args, model, tokenizer, labels, mode, prefix="", display_res=False)
     logger.info("  Batch size = %d", args.eval_batch_size)
     eval_loss = 0.0
     nb_eval_steps = 0
-    preds = None
-    out_label_ids = None
+    # A rank whose shard is empty still takes part in the gathers below
+    preds = np.zeros((0, len(labels)), dtype=np.float32)
+    out_label_ids = np.zeros((0,), dtype=np.int64)
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
         model.eval()
         batch = tuple(t.to(args.device) for t in batch)
 
-        with torch.no_grad():
+        with torch.no_grad(), amp_autocast(args):
             inputs = {"input_ids": batch[0], "attention_mask": batch[1], "labels": batch[-1]}
             if args.model_type != "distilbert":
                 inputs["token_type_ids"] = (
@@ -298,15 +342,14 @@ def evaluate(args, model, tokenizer, labels, mode, prefix="", display_res=False)
 
             eval_loss += tmp_eval_loss.mean().item()
         nb_eval_steps += 1
-        if preds is None:
-            preds = logits.detach().cpu().numpy()
-            out_label_ids = inputs["labels"].detach().cpu().numpy()
-        else:
-            preds = np.append(preds, logits.detach().cpu().numpy(), axis=0)
-            out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
+        preds = np.append(preds, logits.detach().float().cpu().numpy(), axis=0)
+        out_label_ids = np.append(out_label_ids, inputs["labels"].detach().cpu().numpy(), axis=0)
 
+    eval_loss, nb_eval_steps = all_reduce_sum(args, eval_loss, nb_eval_steps)
     eval_loss = eval_loss / nb_eval_steps
-    preds = np.argmax(preds, axis=1)
+    # Each rank sends the predicted label ids of its shard, not the logits
+    preds = all_gather_variable(torch.from_numpy(np.argmax(preds, axis=1)).to(args.device)).cpu().numpy()
+    out_label_ids = all_gather_variable(torch.from_numpy(out_label_ids).to(args.device)).cpu().numpy()
     eval_report = sklearn.metrics.classification_report(out_label_ids, preds,
                                                         labels=range(len(labels)),
                                                         target_names=labels,
@@ -361,59 +404,32 @@ def evaluate(args, model, tokenizer, labels, mode, prefix="", display_res=False)
     return results, preds
 
 def load_and_cache_examples(args, tokenizer, labels, mode):
-    if args.local_rank not in [-1, 0] and not evaluate:
-        torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
-
-    # Load data features from cache or dataset file
-    cached_features_file = os.path.join(
-        args.data_dir,
-        "cached_{}_{}_{}".format(
-            mode, list(filter(None, args.model_name_or_path.split("/"))).pop(), str(args.max_seq_length)
-        ),
-    )
-    if os.path.exists(cached_features_file) and not args.overwrite_cache:
-        print("Loading features from cached file", cached_features_file)
-        features = torch.load(cached_features_file)
-    else:
-        print("Creating features from dataset file at", args.data_dir)
-      #  logger.info("Creating features from dataset file at %s", args.data_dir)
-        instances = read_examples_from_file(args, args.data_dir, mode)
-        features = convert_examples_to_features(instances, tokenizer, labels, args.max_seq_length)
-        if args.local_rank in [-1, 0]:
-            logger.info("Saving features into cached file %s", cached_features_file)
-            torch.save(features, cached_features_file)
-        # print("Creating features from dataset file at", args.data_dir)
-        # examples = read_examples_from_file(args,args.data_dir, mode)
-        # features = convert_examples_to_features(
-        #     examples,
-        #     labels,
-        #     args.max_seq_length,
-        #     tokenizer,
-        #     cls_token_at_end=bool(args.model_type in ["xlnet"]),
-        #     # xlnet has a cls token at the end
-        #     cls_token=tokenizer.cls_token,
-        #     cls_token_segment_id=2 if args.model_type in ["xlnet"] else 0,
-        #     sep_token=tokenizer.sep_token,
-        #     sep_token_extra=bool(args.model_type in ["roberta"]),
-        #     # roberta uses an extra separator b/w pairs of sentences, cf. github.com/pytorch/fairseq/commit/1684e166e3da03f5b600dbb7855cb98ddfcd0805
-        #     pad_on_left=bool(args.model_type in ["xlnet"]),
-        #     # pad on the left for xlnet
-        #     pad_token=tokenizer.convert_tokens_to_ids([tokenizer.pad_token])[0],
-        #     pad_token_segment_id=4 if args.model_type in ["xlnet"] else 0,
-        #     pad_token_label_id=pad_token_label_id,
-        # )
-        if args.local_rank in [-1, 0]:
-            print("Saving features into cached file", cached_features_file)
-            torch.save(features, cached_features_file)
+    # Features are cached under a hash of the data file, labels, tokenizer and conversion parameters
+    data_file = find_data_file(args.data_dir, "{}.tsv".format(mode))
+    key_params = dict(features="news", max_seq_length=args.max_seq_length, pad_to_max_length=False)
+    cache_key = feature_cache_key(data_file, labels, tokenizer, **key_params)
 
-    if args.local_rank == 0 and not evaluate:
-        torch.distributed.barrier()  # Make sure only the first process in distributed training process the dataset, and the others will use the cache
-    # Convert to Tensors and build dataset
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_label_ids = torch.tensor([f.label_ids for f in features], dtype=torch.long)
-
-    dataset = TensorDataset(all_input_ids, all_input_mask, all_label_ids)
+    def convert_examples(instances):
+        print("Creating features from dataset file at", args.data_dir)
+        return convert_examples_to_features(instances, tokenizer, labels, args.max_seq_length)
+
+    # Features are memory-mapped from the cache and padded per batch by the collate function. On a miss every
+    # rank converts its own shard of the instances (the features record no example index, so all of them)
+    num_shards, shard = distributed_shard(args)
+    features_cache = FeatureCache(
+        args.features_cache_dir,
+        max_size=int(args.features_cache_size_gb * 1024 ** 3),
+        num_shards=num_shards,
+        shard=shard,
+    )
+    dataset = features_cache.load_or_update(
+        cache_key,
+        feature_family_key(data_file, labels, tokenizer, **key_params),
+        lambda: read_examples_from_file(args, args.data_dir, mode),
+        convert_examples,
+        name="{}-{}".format(mode, os.path.basename(os.path.normpath(args.data_dir))),
+        overwrite=args.overwrite_cache,
+    )
     return dataset
 
 
@@ -545,6 +561,39 @@ def main():
         help="If > 0: set total number of training steps to perform. Override num_train_epochs.",
     )
     parser.add_argument("--warmup_steps", default=0, type=int, help="Linear warmup over warmup_steps.")
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch training texts of similar length together to reduce padding.",
+    )
+    parser.add_argument(
+        "--bucket_boundaries",
+        default=None,
+        type=int,
+        nargs="+",
+        help="With --group_by_length, batch within fixed length buckets, bucket i holding the lengths up to the "
+        "i-th boundary.",
+    )
+    parser.add_argument(
+        "--use_length_profile",
+        action="store_true",
+        help="Take max_seq_length and bucket_boundaries from the length profile written to data_dir by "
+        "profile_datasets.py.",
+    )
+    parser.add_argument(
+        "--amp",
+        default="off",
+        type=str,
+        choices=AMP_MODES,
+        help="Mixed precision for the forward pass: fp16 (CUDA only, with loss scaling) or bf16 (CUDA or CPU).",
+    )
+    parser.add_argument(
+        "--frozen_dtype",
+        default="fp32",
+        type=str,
+        choices=FROZEN_DTYPES,
+        help="Storage for the frozen backbone weights: bf16/fp16 (with the same --amp) or weight-only int8 (CPU).",
+    )
 
     parser.add_argument("--logging_steps", type=int, default=500, help="Log every X updates steps.")
     parser.add_argument("--save_steps", type=int, default=500, help="Save checkpoint every X updates steps.")
@@ -560,6 +609,18 @@ def main():
     parser.add_argument(
         "--overwrite_cache", action="store_true", help="Overwrite the cached training and evaluation sets"
     )
+    parser.add_argument(
+        "--features_cache_dir",
+        default="",
+        type=str,
+        help="Shared directory for cached features, defaults to ~/.cache/double-bind-training/features.",
+    )
+    parser.add_argument(
+        "--features_cache_size_gb",
+        default=20.0,
+        type=float,
+        help="Delete the least recently used cached features when the cache grows past this size.",
+    )
     parser.add_argument("--seed", type=int, default=42, help="random seed for initialization")
 
     parser.add_argument("--local_rank", type=int, default=-1, help="For distributed training: local_rank")
@@ -657,6 +718,9 @@ def main():
     if args.local_rank == 0:
         torch.distributed.barrier()  # Make sure only the first process in distributed training will download model & vocab
 
+    if args.use_length_profile:
+        apply_length_profile(args, tokenizer)
+
     model.to(args.device)
     print("Training/evaluation parameters", args)
 
@@ -701,14 +765,17 @@ def main():
         )  # Take care of distributed/parallel training
 
         tokenizer.save_pretrained(args.output_dir)
-        model_to_save.save_pretrained(args.output_dir)
+        save_trained_weights(model_to_save, args.output_dir, args)
 
         # Good practice: save your training arguments together with the trained model
         torch.save(args, os.path.join(args.output_dir, "training_args.bin"))
     
-    # Evaluation
+    if args.local_rank != -1 and (args.do_eval or args.do_predict):
+        torch.distributed.barrier()  # Make sure the main process has saved the tokenizer the evaluation reloads
+
+    # Evaluation, every rank evaluates a shard and the main process writes the results
     results = {}
-    if args.do_eval and args.local_rank in [-1, 0]:
+    if args.do_eval:
         tokenizer = tokenizer_class.from_pretrained(args.output_dir, do_lower_case=args.do_lower_case)
         checkpoints = [args.output_dir]
         if args.eval_all_checkpoints:
@@ -727,7 +794,7 @@ def main():
             result = dict((k + "_{}".format(global_step), v) for k, v in result.items())
             results.update(result)
 
-    if args.do_predict and args.local_rank in [-1, 0]:
+    if args.do_predict:
         tokenizer = tokenizer_class.from_pretrained(args.output_dir, do_lower_case=args.do_lower_case)
         # model = model_class.from_pretrained(args.output_dir)
         # model.to(args.device)
@@ -735,25 +802,27 @@ def main():
         predictions = list(predictions)
         id2label = {str(i): label for i, label in enumerate(labels)}
 
-        # Save results
-        output_test_results_file = os.path.join(args.output_dir,"result.txt")
-        with open(output_test_results_file, "w") as writer:
-            for key in sorted(result.keys()):
-                writer.write("{} = {}\n".format(key, str(result[key])))
-
-        output_test_predictions_file = os.path.join(args.output_dir, "prediction_result.txt")
-        with open(output_test_predictions_file, "w", encoding='utf-8') as writer:
-            test_path = os.path.join(args.data_dir, "test.tsv")
-            test_set = pd.read_csv(test_path, delimiter = "\t")
+        if args.local_rank in [-1, 0]:
+            # Save results
+            output_test_results_file = os.path.join(args.output_dir,"result.txt")
+            with open(output_test_results_file, "w") as writer:
+                for key in sorted(result.keys()):
+                    writer.write("{} = {}\n".format(key, str(result[key])))
+
+            output_test_predictions_file = os.path.join(args.output_dir, "prediction_result.txt")
+            with open(output_test_predictions_file, "w", encoding='utf-8') as writer:
+                test_path = find_data_file(args.data_dir, "test.tsv")
+                with open_data_file(test_path) as test_file:
+                    test_set = pd.read_csv(test_file, delimiter = "\t")
             
-            texts = test_set['text'].values
-            labels = test_set['category'].values
-            headlines  = test_set['headline'].values
-
-            for idx, (text_, headline_, label_) in enumerate(zip(texts, headlines, labels)):
-                text_ = headline_.strip() + ". " + text_.strip()
-                output_line = text_ + "\t" + id2label[str(predictions[idx])] + "\n"
-                writer.write(output_line)
+                texts = test_set['text'].values
+                labels = test_set['category'].values
+                headlines  = test_set['headline'].values
+
+                for idx, (text_, headline_, label_) in enumerate(zip(texts, headlines, labels)):
+                    text_ = headline_.strip() + ". " + text_.strip()
+                    output_line = text_ + "\t" + id2label[str(predictions[idx])] + "\n"
+                    writer.write(output_line)
 
     wandb.finish(exit_code=0)
     return results
@@ -0,0 +1,739 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HuggingFace Inc. team.
+# Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Memory-mapped feature store, samplers and collate functions for unpadded features. """
+
+
+import collections
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import ConcatDataset, Dataset, Sampler
+
+
+logger = logging.getLogger(__name__)
+
+FEATURE_FIELDS = ["input_ids", "input_mask", "segment_ids", "label_ids", "example_index"]
+FEATURE_DTYPES = {
+    "input_ids": np.int32,
+    "input_mask": np.int8,
+    "segment_ids": np.int8,
+    # Holds -100 for pad labels
+    "label_ids": np.int16,
+    "example_index": np.int32,
+}
+EXAMPLE_HASH_DTYPE = np.dtype("V16")
+# Bump when the store layout or the feature conversion changes, so old cache entries are not reused
+FEATURE_CACHE_VERSION = 1
+DEFAULT_FEATURE_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "double-bind-training", "features")
+
+
+class FeatureView(object):
+    """The features of one example, as read-only array views into a `FeatureStore`."""
+
+    __slots__ = FEATURE_FIELDS
+
+    def __init__(self, input_ids, input_mask=None, segment_ids=None, label_ids=None, example_index=None):
+        self.input_ids = input_ids
+        self.input_mask = input_mask
+        self.segment_ids = segment_ids
+        self.label_ids = label_ids
+        self.example_index = example_index
+
+
+def save_feature_store(features, store_dir, example_hashes=None, family=None):
+    """ Writes a list of `InputFeatures` to `store_dir` as one flat binary file per field.
+
+        Per-token fields (lists) are concatenated and share an `offsets.bin` index of `len(features) + 1`
+        int64 entries, per-example fields (ints, e.g. sequence classification labels) get one entry per
+        example, and fields that are `None` are not stored. The directory is written next to `store_dir`
+        and renamed into place, so readers never see a partial store.
+
+        `example_hashes` (see `example_content_hashes`) index the source examples the features' `example_index`
+        refer to, so a later version of the data file can reuse the features of unchanged examples. `family`
+        is the `feature_family_key` of the store.
+    """
+    tmp_dir = "{}.tmp-{}".format(store_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    lengths = np.fromiter((len(f.input_ids) for f in features), dtype=np.int64, count=len(features))
+    offsets = np.zeros(len(features) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    offsets.tofile(os.path.join(tmp_dir, "offsets.bin"))
+
+    meta = {"num_examples": len(features), "num_tokens": int(offsets[-1]), "fields": {}}
+    if example_hashes is not None:
+        np.asarray(example_hashes, dtype=EXAMPLE_HASH_DTYPE).tofile(os.path.join(tmp_dir, "example_hashes.bin"))
+        meta["num_source_examples"] = len(example_hashes)
+        meta["family"] = family
+    for field in FEATURE_FIELDS:
+        values = [getattr(f, field, None) for f in features]
+        if not values or values[0] is None:
+            continue
+        dtype = FEATURE_DTYPES[field]
+        per_token = isinstance(values[0], (list, tuple, np.ndarray))
+        if per_token and any(isinstance(v, np.ndarray) for v in values):
+            # Features reused from another store are array views, copy them in blocks rather than per token
+            array = np.concatenate([np.asarray(v, dtype=dtype) for v in values])
+        elif per_token:
+            array = np.fromiter(itertools.chain.from_iterable(values), dtype=dtype, count=int(offsets[-1]))
+        else:
+            array = np.asarray(values, dtype=dtype)
+        array.tofile(os.path.join(tmp_dir, "{}.bin".format(field)))
+        meta["fields"][field] = {"dtype": np.dtype(dtype).name, "per_token": per_token}
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as writer:
+        json.dump(meta, writer)
+
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+
+
+class FeatureStore(Dataset):
+    """A dataset reading features written by `save_feature_store` through `np.memmap`.
+
+    Opening a store maps the files read-only without reading them, and every item is a `FeatureView` slicing
+    the mapped arrays, so nothing is copied until a batch is collated. Every process that opens the store, e.g.
+    the ranks of a node and their DataLoader workers, shares the same pages of the OS page cache, so the host
+    memory used by the features does not grow with the number of processes. For the same reason a store is
+    pickled by path, a spawned worker maps the files again instead of receiving a copy of the arrays.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as reader:
+            self.meta = json.load(reader)
+
+        self.offsets = self._open("offsets", np.int64, self.meta["num_examples"] + 1)
+        self.lengths = np.diff(self.offsets)
+        self.fields = {}
+        for field, info in self.meta["fields"].items():
+            count = self.meta["num_tokens"] if info["per_token"] else self.meta["num_examples"]
+            self.fields[field] = (self._open(field, np.dtype(info["dtype"]), count), info["per_token"])
+
+    def __getstate__(self):
+        return {"store_dir": self.store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["store_dir"])
+
+    def _open(self, name, dtype, count):
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.store_dir, "{}.bin".format(name)), dtype=dtype, mode="r", shape=(count,))
+
+    def __len__(self):
+        return self.meta["num_examples"]
+
+    def example_indices(self):
+        """The source example of every feature, or None if the store does not record them."""
+        if "example_index" not in self.fields:
+            return None
+        return self.fields["example_index"][0]
+
+    def example_hashes(self):
+        """The content hashes of the source examples, or None if the store was written without them."""
+        if "num_source_examples" not in self.meta:
+            return None
+        return self._open("example_hashes", EXAMPLE_HASH_DTYPE, self.meta["num_source_examples"])
+
+    def __getitem__(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        values = {}
+        for field, (array, per_token) in self.fields.items():
+            values[field] = array[start:end] if per_token else array[index]
+        return FeatureView(**values)
+
+
+# A data directory without its own training file can list the directories it combines here, e.g. `en_ewt + ro_rrt`
+SOURCES_FILE = "sources.txt"
+
+
+def parse_sources(spec, base_dir=""):
+    """ Parses a composite dataset spec such as `en_ewt + ro_rrt + wol:2 + sna` into `(data_dir, weight)` pairs.
+
+        Every source is a data directory, names that are not a directory are looked up in `base_dir`. The
+        weight (1 by default) scales how often the examples of a source are sampled: `wol:2` draws every wol
+        sentence twice as often as a plain concatenation would, `wol:0.5` half as often.
+    """
+    sources = []
+    for entry in spec.split("+"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, weight = entry.rpartition(":") if ":" in entry else (entry, None, "1")
+        data_dir = name if os.path.isdir(name) else os.path.join(base_dir, name)
+        if not os.path.isdir(data_dir):
+            raise ValueError("Source {} of {!r} is not a data directory".format(data_dir, spec))
+        try:
+            weight = float(weight)
+        except ValueError:
+            raise ValueError("Source {} of {!r} has weight {!r}, not a number".format(name, spec, weight))
+        if weight <= 0:
+            raise ValueError("Source {} of {!r} needs a positive weight".format(name, spec))
+        sources.append((data_dir, weight))
+    if not sources:
+        raise ValueError("Empty composite dataset spec {!r}".format(spec))
+    return sources
+
+
+def read_sources(data_dir, spec=None):
+    """ The `(data_dir, weight)` sources of `spec`, or of the `SOURCES_FILE` of `data_dir` when no spec is given.
+
+        Returns None if there is neither. Relative names are looked up next to `data_dir`.
+    """
+    if not spec:
+        path = os.path.join(data_dir, SOURCES_FILE)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as reader:
+            spec = " + ".join(line.strip() for line in reader if line.strip() and not line.startswith("#"))
+    return parse_sources(spec, os.path.dirname(os.path.normpath(data_dir)))
+
+
+class CompositeDataset(ConcatDataset):
+    """ A virtual concatenation of the datasets (e.g. per-language `FeatureStore`s) of several sources.
+
+        Items are read from the source datasets, nothing is copied. `lengths` concatenates the lengths of the
+        sources for `LengthGroupedBatchSampler`, and `sample_weights` gives every example the weight of its
+        source for weighted sampling.
+    """
+
+    def __init__(self, datasets, weights=None, names=None):
+        super(CompositeDataset, self).__init__(datasets)
+        self.weights = list(weights) if weights is not None else [1.0] * len(self.datasets)
+        self.names = list(names) if names is not None else [str(i) for i in range(len(self.datasets))]
+        self.lengths = np.concatenate([np.asarray(dataset.lengths) for dataset in self.datasets])
+
+    def sample_weights(self):
+        """Per-example sampling weights, or None when every source has weight 1 (a plain concatenation)."""
+        if all(weight == 1 for weight in self.weights):
+            return None
+        return np.repeat(np.asarray(self.weights, dtype=np.float64), [len(dataset) for dataset in self.datasets])
+
+    def describe(self):
+        """One line listing the size, weight and share of the samples of every source."""
+        total = sum(weight * len(dataset) for weight, dataset in zip(self.weights, self.datasets))
+        return ", ".join(
+            "{} ({} examples, weight {:g}, {:.1%} of samples)".format(
+                name, len(dataset), weight, weight * len(dataset) / max(total, 1e-12)
+            )
+            for name, dataset, weight in zip(self.names, self.datasets, self.weights)
+        )
+
+
+# Compressed data files are found next to (and read like) the plain ones, e.g. `train.txt.gz` for `train.txt`
+COMPRESSED_EXTENSIONS = (".gz", ".zst")
+
+
+def find_data_file(data_dir, file_name):
+    """Returns the path of `file_name` in `data_dir`, or of a compressed version of it if only that exists."""
+    path = os.path.join(data_dir, file_name)
+    if not os.path.exists(path):
+        for extension in COMPRESSED_EXTENSIONS:
+            if os.path.exists(path + extension):
+                return path + extension
+    return path
+
+
+def strip_compression_extension(path):
+    """`train.txt.gz` -> `train.txt`, other paths are returned unchanged."""
+    for extension in COMPRESSED_EXTENSIONS:
+        if path.endswith(extension):
+            return path[: -len(extension)]
+    return path
+
+
+def open_data_file(path, mode="rb", encoding="utf-8"):
+    """ Opens a plain, gzip (`.gz`) or zstd (`.zst`) file for reading.
+
+        Compressed files are decompressed as they are read, in the chunks the caller asks for, without a
+        temporary file. Use mode "rt" for a text stream. Reading `.zst` files requires the `zstandard` package.
+    """
+    if path.endswith(".gz"):
+        stream = gzip.open(path, "rb")
+    elif path.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading {} requires the zstandard package: pip install zstandard".format(path))
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    else:
+        stream = open(path, "rb")
+    if "t" in mode:
+        return io.TextIOWrapper(stream, encoding=encoding)
+    return stream
+
+
+def read_data_file(path, chunk_size=1 << 24):
+    """Returns the (decompressed) bytes of a data file opened with `open_data_file`."""
+    data = bytearray()
+    with open_data_file(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            data += chunk
+    return data
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """Returns the sha256 of a file's contents."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """ Returns a hash of everything that decides how a tokenizer splits and numbers text.
+
+        Fast tokenizers are hashed through their serialized backend (normalizer, pre-tokenizer, vocab and
+        scores), slow ones through their vocab file when they have one and their vocab otherwise. The
+        class name and special tokens are always included, paths are not, so the same tokenizer gives the
+        same fingerprint on every machine.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(type(tokenizer).__name__.encode("utf-8"))
+    hasher.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode("utf-8"))
+    hasher.update(str(getattr(tokenizer, "do_lower_case", None)).encode("utf-8"))
+    vocab_file = getattr(tokenizer, "vocab_file", None)
+    if getattr(tokenizer, "is_fast", False):
+        hasher.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    elif vocab_file and os.path.isfile(vocab_file):
+        hasher.update(file_fingerprint(vocab_file).encode("utf-8"))
+    else:
+        hasher.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def example_content_hashes(examples):
+    """ Returns a 16 byte hash of the contents (every attribute but the guid) of every example.
+
+        Examples with equal hashes convert to equal features under the same labels, tokenizer and parameters.
+    """
+    hashes = np.empty(len(examples), dtype=EXAMPLE_HASH_DTYPE)
+    for index, example in enumerate(examples):
+        content = {key: value for key, value in vars(example).items() if key != "guid"}
+        hashes[index] = hashlib.blake2b(
+            json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8"), digest_size=16
+        ).digest()
+    return hashes
+
+
+def feature_family_key(data_file, labels, tokenizer, **params):
+    """ Like `feature_cache_key` but with the path of `data_file` instead of its contents.
+
+        Stores of the same family hold features of successive versions of a data file, converted the same way.
+    """
+    description = {
+        "version": FEATURE_CACHE_VERSION,
+        "data_file": os.path.normpath(strip_compression_extension(data_file)),
+        "labels": list(labels),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def feature_cache_key(data_file, labels, tokenizer, **params):
+    """ Content address of the features converted from `data_file`.
+
+        Combines the data file contents, the label list, the tokenizer fingerprint and the conversion
+        parameters (`max_seq_length`, `sep_token_extra`, `pad_on_left`, ...), so any change to one of
+        them gives a new key instead of silently reusing stale features.
+    """
+    description = {
+        "version": FEATURE_CACHE_VERSION,
+        "data": file_fingerprint(data_file),
+        "labels": list(labels),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "params": params,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+LENGTH_PROFILE_FILE = "length_profile.json"
+
+
+def special_tokens_count(model_type):
+    """Special tokens the token level feature conversion adds: [CLS] and [SEP], and a second [SEP] for roberta."""
+    return 3 if model_type == "roberta" else 2
+
+
+def apply_length_profile(args, tokenizer):
+    """ Sets `args.max_seq_length` and `args.bucket_boundaries` to the values recommended in the length profile
+        that `profile_datasets.py` wrote to `args.data_dir`.
+
+        The profile is ignored, with a warning, if it is missing or was computed with another tokenizer or, for
+        the token level tasks, another number of special tokens. `model_type`s that add the same special tokens
+        (e.g. bert and xlmroberta) share their profiles.
+    """
+    path = os.path.join(args.data_dir, LENGTH_PROFILE_FILE)
+    if not os.path.isfile(path):
+        logger.warning("No length profile at %s, keeping max_seq_length %d", path, args.max_seq_length)
+        return
+    with open(path) as reader:
+        profile = json.load(reader)
+    profile_special_tokens = profile.get("special_tokens_count")
+    if profile_special_tokens is None:
+        # Written before the count was recorded, only the token level tasks add special tokens to the lengths
+        profile_special_tokens = special_tokens_count(profile["model_type"]) if profile["task"] in ["ner", "pos"] else 0
+    # The lengths of a sequence level profile count no special tokens, they fit every model type
+    special_tokens_differ = profile_special_tokens and profile_special_tokens != special_tokens_count(args.model_type)
+    if profile["tokenizer"] != tokenizer_fingerprint(tokenizer) or special_tokens_differ:
+        logger.warning(
+            "The length profile at %s was computed for another tokenizer or number of special tokens, "
+            "keeping max_seq_length %d",
+            path,
+            args.max_seq_length,
+        )
+        return
+    args.max_seq_length = profile["recommended"]["max_seq_length"]
+    args.bucket_boundaries = profile["recommended"]["bucket_boundaries"]
+    logger.info(
+        "Using max_seq_length %d and bucket boundaries %s from %s", args.max_seq_length, args.bucket_boundaries, path
+    )
+
+
+class FeatureCache(object):
+    """A directory of feature stores addressed by `feature_cache_key`, capped at `max_size` bytes.
+
+    Every hit touches the store, and after a new store is written the least recently used ones are
+    deleted until the directory fits in `max_size`. Stores are written atomically, so the directory
+    can be shared by concurrent runs and by several machines on a shared filesystem.
+
+    With `num_shards > 1` the cache is shared by the ranks of a distributed job, `shard` being the rank of
+    this process. On a miss of `load_or_update` every rank converts its own shard of the examples and rank 0
+    assembles the store, so every rank must make the same calls in the same order (they are synchronized
+    with `torch.distributed.barrier()`).
+    """
+
+    def __init__(self, cache_dir=None, max_size=20 * 1024 ** 3, num_shards=1, shard=0):
+        self.cache_dir = cache_dir or DEFAULT_FEATURE_CACHE_DIR
+        self.max_size = max_size
+        self.num_shards = num_shards
+        self.shard = shard
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def store_dir(self, key, name=""):
+        return os.path.join(self.cache_dir, "{}-{}".format(name, key) if name else key)
+
+    def load_or_update(self, key, family, read_examples, convert_examples, name="", overwrite=False):
+        """ Opens the store for `key`. On a miss, converts only the examples that are not in an earlier store of
+            the same `family` (see `feature_family_key`), typically the cache of a previous version of the file,
+            saves the store and evicts the least recently used ones.
+
+            `name` is a human readable prefix for the store directory, e.g. `train-hau`.
+            `read_examples()` returns the examples and `convert_examples(examples)` their features, each feature
+            recording the index of its example in the list it was given as `example_index`. The features of
+            unchanged examples are copied from the most recent store of the family, matched by content hash, so
+            appended, edited and reordered sentences all reuse what they can. If the converter does not record
+            example indices the store is written without an index and the next update converts everything.
+        """
+        store_dir = self.store_dir(key, name)
+        meta_file = os.path.join(store_dir, "meta.json")
+        cached = os.path.exists(meta_file) and not overwrite
+        if self.num_shards > 1:
+            # Every rank looks for the store before rank 0 can write it, so they all take the same branch
+            torch.distributed.barrier()
+        if cached:
+            logger.info("Loading features from cached file %s", store_dir)
+            os.utime(meta_file)
+            return FeatureStore(store_dir)
+
+        examples = read_examples()
+        hashes = example_content_hashes(examples)
+        base = None if overwrite else self.latest_store(family)
+        previous = {}
+        if base is not None:
+            base_indices = np.asarray(base.example_indices())
+            base_hashes = base.example_hashes()
+            # First feature of every base example, examples dropped by the conversion have none
+            feature_starts = np.searchsorted(base_indices, np.arange(len(base_hashes) + 1))
+            for base_index in range(len(base_hashes) - 1, -1, -1):
+                previous[base_hashes[base_index].tobytes()] = (feature_starts[base_index], feature_starts[base_index + 1])
+
+        changed = [index for index, example_hash in enumerate(hashes) if example_hash.tobytes() not in previous]
+        logger.info(
+            "Converting %d of %d examples%s",
+            len(changed),
+            len(examples),
+            ", reusing the others from {}".format(base.store_dir) if base is not None else "",
+        )
+        changed_features = self._convert_sharded(store_dir, [examples[index] for index in changed], convert_examples)
+        if changed_features is None:
+            # Rank 0 assembles the store from the shards
+            torch.distributed.barrier()
+            return FeatureStore(store_dir)
+        if any(getattr(f, "example_index", None) is None for f in changed_features):
+            features = changed_features if len(changed) == len(examples) else convert_examples(examples)
+            hashes = None
+        else:
+            features_by_example = collections.defaultdict(list)
+            for feature in changed_features:
+                features_by_example[changed[feature.example_index]].append(feature)
+            features = []
+            for index, example_hash in enumerate(hashes):
+                if index in features_by_example:
+                    example_features = features_by_example[index]
+                else:
+                    start, end = previous.get(example_hash.tobytes(), (0, 0))
+                    example_features = [base[position] for position in range(start, end)]
+                for feature in example_features:
+                    feature.example_index = index
+                features.extend(example_features)
+
+        logger.info("Saving features into cached file %s", store_dir)
+        save_feature_store(features, store_dir, example_hashes=hashes, family=family)
+        for shard in range(self.num_shards if self.num_shards > 1 else 0):
+            shutil.rmtree(self.shard_dir(store_dir, shard), ignore_errors=True)
+        self.evict(keep=store_dir)
+        if self.num_shards > 1:
+            torch.distributed.barrier()
+        return FeatureStore(store_dir)
+
+    def shard_dir(self, store_dir, shard):
+        return "{}.shard-{}-of-{}".format(store_dir, shard, self.num_shards)
+
+    def _convert_sharded(self, store_dir, examples, convert_examples):
+        """ Converts `examples`, or with several shards only the contiguous shard of this process.
+
+            Each rank writes its shard next to `store_dir`, and rank 0 returns the features of all the examples,
+            in order, with their `example_index` (if the converter records one) into `examples`. The other
+            ranks return None.
+        """
+        if not examples:
+            return [] if self.shard == 0 else None
+        if self.num_shards == 1:
+            return convert_examples(examples)
+
+        shard_size, remainder = divmod(len(examples), self.num_shards)
+        starts = [shard * shard_size + min(shard, remainder) for shard in range(self.num_shards + 1)]
+        start, end = starts[self.shard], starts[self.shard + 1]
+        logger.info("Converting examples %d to %d on shard %d of %d", start, end, self.shard, self.num_shards)
+        shard_features = convert_examples(examples[start:end]) if end > start else []
+        save_feature_store(shard_features, self.shard_dir(store_dir, self.shard))
+        torch.distributed.barrier()
+        if self.shard != 0:
+            return None
+
+        features = []
+        for shard in range(self.num_shards):
+            shard_store = FeatureStore(self.shard_dir(store_dir, shard))
+            for position in range(len(shard_store)):
+                feature = shard_store[position]
+                if feature.example_index is not None:
+                    feature.example_index = starts[shard] + int(feature.example_index)
+                features.append(feature)
+        return features
+
+    def latest_store(self, family):
+        """The most recently used store of `family` that has an example index, or None."""
+        latest = None
+        for entry in os.scandir(self.cache_dir):
+            meta_file = os.path.join(entry.path, "meta.json")
+            if not entry.is_dir() or not os.path.exists(meta_file):
+                continue
+            with open(meta_file) as reader:
+                meta = json.load(reader)
+            if meta.get("family") != family or "num_source_examples" not in meta:
+                continue
+            mtime = os.stat(meta_file).st_mtime
+            if latest is None or mtime > latest[0]:
+                latest = (mtime, entry.path)
+        return FeatureStore(latest[1]) if latest is not None else None
+
+    def evict(self, keep=None):
+        """Deletes the least recently used stores until the cache fits in `max_size`."""
+        stores = []
+        for entry in os.scandir(self.cache_dir):
+            meta_file = os.path.join(entry.path, "meta.json")
+            if not entry.is_dir() or not os.path.exists(meta_file):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            stores.append((os.stat(meta_file).st_mtime, size, entry.path))
+
+        total_size = sum(size for _, size, _ in stores)
+        for _, size, path in sorted(stores):
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            logger.info("Evicting cached features %s (%.1f MB)", path, size / 1024 ** 2)
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+
+class DynamicPaddingCollator(object):
+    """Pads a list of features to the longest one in the batch.
+
+    Returns `(input_ids, input_mask, segment_ids, label_ids)` like the `TensorDataset` the scripts used
+    before, so the training loops index the batch the same way. Features may be `InputFeatures` or
+    `FeatureView`s, and a scalar `label_ids` gives one label per sequence.
+    """
+
+    def __init__(self, pad_token=0, pad_token_segment_id=0, pad_token_label_id=-100, pad_on_left=False):
+        self.pad_token = pad_token
+        self.pad_token_segment_id = pad_token_segment_id
+        self.pad_token_label_id = pad_token_label_id
+        self.pad_on_left = pad_on_left
+
+    def __call__(self, features):
+        max_length = max(len(f.input_ids) for f in features)
+        input_ids = torch.full((len(features), max_length), self.pad_token, dtype=torch.long)
+        input_mask = torch.zeros((len(features), max_length), dtype=torch.long)
+        segment_ids = torch.full((len(features), max_length), self.pad_token_segment_id, dtype=torch.long)
+        if np.ndim(features[0].label_ids) == 0:
+            # One label per sequence, e.g. news and sentiment classification
+            label_ids = torch.tensor([int(f.label_ids) for f in features], dtype=torch.long)
+        else:
+            label_ids = torch.full((len(features), max_length), self.pad_token_label_id, dtype=torch.long)
+
+        for i, f in enumerate(features):
+            length = len(f.input_ids)
+            positions = slice(max_length - length, max_length) if self.pad_on_left else slice(0, length)
+            input_ids[i, positions] = torch.as_tensor(np.asarray(f.input_ids, dtype=np.int64))
+            if f.input_mask is None:
+                input_mask[i, positions] = 1
+            else:
+                input_mask[i, positions] = torch.as_tensor(np.asarray(f.input_mask, dtype=np.int64))
+            if f.segment_ids is not None:
+                segment_ids[i, positions] = torch.as_tensor(np.asarray(f.segment_ids, dtype=np.int64))
+            if label_ids.dim() == 2:
+                label_ids[i, positions] = torch.as_tensor(np.asarray(f.label_ids, dtype=np.int64))
+        return input_ids, input_mask, segment_ids, label_ids
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """Yields shuffled batches of indices whose sequences have similar lengths.
+
+    Indices are shuffled and cut into mega-batches of `batch_size * bucket_size_multiplier`, each mega-batch
+    is sorted by length and split into batches, and the order of the batches is shuffled again. With
+    `bucket_boundaries` (e.g. from a length profile) the shuffled indices are instead put in fixed buckets,
+    bucket `i` holding the lengths up to `bucket_boundaries[i]`, and batches are cut within each bucket. The
+    shuffle is seeded with `seed + epoch`, `epoch` being set by `set_epoch()` before every epoch as for a
+    `DistributedSampler`, so every rank of a distributed job sees the same batches and then keeps every
+    `num_replicas`-th one. Like `DistributedSampler`, the batch order is padded by repeating its first batches
+    so that every rank yields the same number of batches (and runs the same number of all-reduces). With
+    `sample_weights` (see `CompositeDataset.sample_weights`) an epoch draws `round(sum(sample_weights))`
+    indices with replacement instead of a permutation of all indices.
+    """
+
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        bucket_size_multiplier=100,
+        seed=0,
+        num_replicas=1,
+        rank=0,
+        bucket_boundaries=None,
+        sample_weights=None,
+    ):
+        self.lengths = lengths
+        self.sample_weights = None if sample_weights is None else torch.as_tensor(sample_weights, dtype=torch.double)
+        self.batch_size = batch_size
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.bucket_boundaries = bucket_boundaries
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _buckets(self):
+        if not self.bucket_boundaries:
+            return None
+        return np.searchsorted(np.asarray(self.bucket_boundaries), np.asarray(self.lengths), side="left")
+
+    def _num_samples(self):
+        if self.sample_weights is None:
+            return len(self.lengths)
+        return int(round(float(self.sample_weights.sum())))
+
+    def _indices(self, generator):
+        if self.sample_weights is None:
+            return torch.randperm(len(self.lengths), generator=generator).tolist()
+        indices = torch.multinomial(self.sample_weights, self._num_samples(), replacement=True, generator=generator)
+        return indices.tolist()
+
+    def __len__(self):
+        buckets = self._buckets()
+        if buckets is not None and self.sample_weights is not None:
+            # The bucket sizes depend on the draw, count them in the draw of the coming epoch
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            buckets = buckets[self._indices(generator)]
+        if buckets is None:
+            num_batches = (self._num_samples() + self.batch_size - 1) // self.batch_size
+        else:
+            num_batches = int(((np.bincount(buckets) + self.batch_size - 1) // self.batch_size).sum())
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        indices = self._indices(generator)
+        batches = []
+        buckets = self._buckets()
+        if buckets is None:
+            megabatch_size = self.batch_size * self.bucket_size_multiplier
+            for start in range(0, len(indices), megabatch_size):
+                megabatch = sorted(indices[start : start + megabatch_size], key=lambda i: self.lengths[i], reverse=True)
+                batches.extend(megabatch[i : i + self.batch_size] for i in range(0, len(megabatch), self.batch_size))
+        else:
+            for bucket in range(int(buckets.max()) + 1 if len(buckets) else 0):
+                members = [i for i in indices if buckets[i] == bucket]
+                batches.extend(members[i : i + self.batch_size] for i in range(0, len(members), self.batch_size))
+
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        # Pad so that the number of batches divides evenly between the ranks
+        num_padded = -len(order) % self.num_replicas
+        order += (order * (num_padded // max(1, len(order)) + 1))[:num_padded]
+        for position in order[self.rank :: self.num_replicas]:
+            yield batches[position]
+
+
+class ShardedEvalSampler(Sampler):
+    """Yields one contiguous shard of the indices of a dataset, in order, for evaluation on `num_replicas` ranks.
+
+    Unlike `DistributedSampler` nothing is padded or repeated: shard sizes differ by at most one, so every
+    example is evaluated exactly once, and concatenating the shards in rank order gives back the dataset order
+    (which `stitch_windows` and the prediction files rely on).
+    """
+
+    def __init__(self, dataset, num_replicas=1, rank=0):
+        self.num_replicas = num_replicas
+        self.rank = rank
+        shard_size, remainder = divmod(len(dataset), num_replicas)
+        self.start = rank * shard_size + min(rank, remainder)
+        self.end = self.start + shard_size + (1 if rank < remainder else 0)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
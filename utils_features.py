@@ -0,0 +1,368 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HuggingFace Inc. team.
+# Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Token classification: feature conversion shared by the NER and POS tasks. """
+
+
+import collections
+import logging
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+
+from utils_data import tokenizer_fingerprint
+from utils_ner import InputFeatures
+
+
+logger = logging.getLogger(__name__)
+
+
+def convert_examples_to_features_fast(
+    examples,
+    label_list,
+    max_seq_length,
+    tokenizer,
+    cls_token_at_end=False,
+    cls_token="[CLS]",
+    cls_token_segment_id=1,
+    sep_token="[SEP]",
+    sep_token_extra=False,
+    pad_on_left=False,
+    pad_token=0,
+    pad_token_segment_id=0,
+    pad_token_label_id=-100,
+    sequence_a_segment_id=0,
+    mask_padding_with_zero=True,
+    pad_to_max_length=True,
+    batch_size=1000,
+    doc_stride=None,
+    subword_cache=None,
+):
+    """ Same as `utils_ner.convert_examples_to_features` but tokenizes whole sentences in batches
+        with a fast (Rust) tokenizer, using `word_ids()` to put each word's label on its first subword.
+
+        The output is identical to the word-by-word conversion, including its quirks: a word that
+        tokenizes to nothing still contributes a label id, so such sentences are dropped or misaligned
+        exactly as before.
+        `batch_size` is the number of sentences sent to the tokenizer per call.
+
+        Every feature records the `example_index` it was converted from. With `doc_stride`, sentences longer
+        than `max_seq_length` are not truncated but split into windows starting every `doc_stride` subwords
+        (see `split_into_windows`), and the per-word predictions of the windows are stitched back by example
+        with `stitch_windows`.
+
+        With a `SubwordCache`, words are looked up in the cache and only the missing ones are sent to the
+        tokenizer.
+    """
+    if not getattr(tokenizer, "is_fast", False):
+        raise ValueError("convert_examples_to_features_fast requires a fast tokenizer, got %s" % type(tokenizer))
+
+    label_map = {label: i for i, label in enumerate(label_list)}
+    cls_token_id, sep_token_id = tokenizer.convert_tokens_to_ids([cls_token, sep_token])
+    # Account for [CLS] and [SEP] with "- 2" and with "- 3" for RoBERTa.
+    special_tokens_count = 3 if sep_token_extra else 2
+    window_length = max_seq_length - special_tokens_count
+    if doc_stride is not None and not 0 < doc_stride <= window_length:
+        raise ValueError(
+            "doc_stride must be between 1 and max_seq_length - %d, got %d" % (special_tokens_count, doc_stride)
+        )
+
+    features = []
+    for batch_start in range(0, len(examples), batch_size):
+        logger.info("Writing example %d of %d", batch_start, len(examples))
+        batch = examples[batch_start : batch_start + batch_size]
+        if subword_cache is None:
+            encodings = tokenizer(
+                [example.words for example in batch],
+                is_split_into_words=True,
+                add_special_tokens=False,
+                return_attention_mask=False,
+                return_token_type_ids=False,
+            )
+        else:
+            word_tokens = subword_cache.encode([word for example in batch for word in example.words])
+            first_word = 0
+
+        for batch_index, example in enumerate(batch):
+            ex_index = batch_start + batch_index
+            if subword_cache is None:
+                tokens = encodings["input_ids"][batch_index]
+                # Number of subwords per word, in word order
+                word_lengths = [0] * len(example.words)
+                for word_id in encodings.word_ids(batch_index):
+                    if word_id is not None:
+                        word_lengths[word_id] += 1
+            else:
+                sentence_tokens = word_tokens[first_word : first_word + len(example.words)]
+                first_word += len(example.words)
+                tokens = [token for subwords in sentence_tokens for token in subwords]
+                word_lengths = [len(subwords) for subwords in sentence_tokens]
+
+            label_ids = []
+            for label, word_length in zip(example.labels, word_lengths):
+                # Use the real label id for the first token of the word, and padding ids for the remaining tokens
+                label_ids.extend([label_map[label]] + [pad_token_label_id] * (word_length - 1))
+
+            # A word that tokenizes to nothing misaligns the labels, such sentences are truncated as before
+            if doc_stride is not None and len(label_ids) == len(tokens):
+                windows = split_into_windows(tokens, label_ids, window_length, doc_stride, pad_token_label_id)
+            elif len(tokens) > window_length:
+                windows = [(tokens[:window_length], label_ids[:window_length])]
+            else:
+                # Like the word-by-word conversion, the labels are only cut together with too long subwords
+                windows = [(tokens, label_ids)]
+
+            for tokens, label_ids in windows:
+                input_ids = tokens + [sep_token_id]
+                label_ids += [pad_token_label_id]
+                if sep_token_extra:
+                    # roberta uses an extra separator b/w pairs of sentences
+                    input_ids += [sep_token_id]
+                    label_ids += [pad_token_label_id]
+                segment_ids = [sequence_a_segment_id] * len(input_ids)
+
+                if cls_token_at_end:
+                    input_ids += [cls_token_id]
+                    label_ids += [pad_token_label_id]
+                    segment_ids += [cls_token_segment_id]
+                else:
+                    input_ids = [cls_token_id] + input_ids
+                    label_ids = [pad_token_label_id] + label_ids
+                    segment_ids = [cls_token_segment_id] + segment_ids
+
+                # The mask has 1 for real tokens and 0 for padding tokens. Only real
+                # tokens are attended to.
+                input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
+
+                # Zero-pad up to the sequence length.
+                padding_length = max_seq_length - len(input_ids) if pad_to_max_length else 0
+                if pad_on_left:
+                    input_ids = ([pad_token] * padding_length) + input_ids
+                    input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
+                    segment_ids = ([pad_token_segment_id] * padding_length) + segment_ids
+                    label_ids = ([pad_token_label_id] * padding_length) + label_ids
+                else:
+                    input_ids += [pad_token] * padding_length
+                    input_mask += [0 if mask_padding_with_zero else 1] * padding_length
+                    segment_ids += [pad_token_segment_id] * padding_length
+                    label_ids += [pad_token_label_id] * padding_length
+
+                if len(label_ids) != len(input_ids):
+                    continue
+
+                if ex_index < 5:
+                    logger.info("*** Example ***")
+                    logger.info("guid: %s", example.guid)
+                    logger.info("tokens: %s", " ".join(tokenizer.convert_ids_to_tokens(input_ids)))
+                    logger.info("input_ids: %s", " ".join([str(x) for x in input_ids]))
+                    logger.info("input_mask: %s", " ".join([str(x) for x in input_mask]))
+                    logger.info("segment_ids: %s", " ".join([str(x) for x in segment_ids]))
+                    logger.info("label_ids: %s", " ".join([str(x) for x in label_ids]))
+
+                features.append(
+                    InputFeatures(
+                        input_ids=input_ids,
+                        input_mask=input_mask,
+                        segment_ids=segment_ids,
+                        label_ids=label_ids,
+                        example_index=ex_index,
+                    )
+                )
+    return features
+
+
+def split_into_windows(tokens, label_ids, window_length, doc_stride, pad_token_label_id=-100):
+    """ Splits the subword and label ids of a sentence into windows of `window_length` subwords, starting every
+        `doc_stride` subwords, the last one ending with the sentence.
+
+        A word seen by several overlapping windows keeps its label only in the one where its first subword has
+        the most context on both sides (the earlier one on ties) and gets `pad_token_label_id` in the others.
+        The labelled positions of the windows, read in order, are therefore every word of the sentence once.
+    """
+    if len(tokens) <= window_length:
+        return [(tokens, label_ids)]
+
+    starts = list(range(0, len(tokens) - window_length, doc_stride)) + [len(tokens) - window_length]
+    owner = [0] * len(tokens)
+    best_context = [-1] * len(tokens)
+    for window, start in enumerate(starts):
+        for position in range(window_length):
+            context = min(position, window_length - 1 - position)
+            if context > best_context[start + position]:
+                best_context[start + position] = context
+                owner[start + position] = window
+
+    windows = []
+    for window, start in enumerate(starts):
+        window_labels = [
+            label_id if owner[start + position] == window else pad_token_label_id
+            for position, label_id in enumerate(label_ids[start : start + window_length])
+        ]
+        windows.append((tokens[start : start + window_length], window_labels))
+    return windows
+
+
+def stitch_windows(sequences, example_indices, num_examples=None):
+    """ Joins the per-word sequences (labels or predictions) of the features of each example.
+
+        `example_indices` is the `example_index` of every feature, in the order of `sequences`, as stored by
+        the feature conversions. Returns one sequence per example, indexed by `example_index`: examples the
+        conversion dropped (e.g. a sentence with a word that tokenizes to nothing) get an empty sequence, so the
+        sequences stay aligned with the corpus. `num_examples` defaults to the largest index plus one.
+    """
+    example_indices = np.asarray(example_indices)
+    if num_examples is None:
+        num_examples = int(example_indices.max()) + 1 if len(example_indices) else 0
+    stitched = [[] for _ in range(num_examples)]
+    for sequence, example_index in zip(sequences, example_indices.tolist()):
+        stitched[example_index].extend(sequence)
+    return stitched
+
+
+class SubwordCache(object):
+    """A bounded LRU memo of the subword ids of single words for one fast tokenizer.
+
+    Words are encoded exactly as in `is_split_into_words` mode, where every word is normalized and tokenized
+    on its own, so looking them up gives the same ids as tokenizing the whole sentence. With a `cache_dir`
+    the memo is loaded from and `save()`d to a file named after the tokenizer fingerprint, and is shared by
+    the splits, tasks and runs that use the same tokenizer.
+    """
+
+    def __init__(self, tokenizer, max_size=200000, cache_dir=None):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.path = None
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            self.path = os.path.join(cache_dir, "subwords-{}.pkl".format(tokenizer_fingerprint(tokenizer)))
+            if os.path.isfile(self.path):
+                with open(self.path, "rb") as reader:
+                    self.entries.update(pickle.load(reader))
+                logger.info("Loaded %d words from the subword cache %s", len(self.entries), self.path)
+
+    def encode(self, words):
+        """Returns the subword ids of every word, tokenizing the words that are not cached in one batched call."""
+        missing = [word for word in dict.fromkeys(words) if word not in self.entries]
+        if missing:
+            encodings = self.tokenizer(
+                [[word] for word in missing],
+                is_split_into_words=True,
+                add_special_tokens=False,
+                return_attention_mask=False,
+                return_token_type_ids=False,
+            )
+            for word, input_ids in zip(missing, encodings["input_ids"]):
+                self.entries[word] = tuple(input_ids)
+        # A miss is a word that had to be tokenized, its repeats within `words` are hits
+        self.misses += len(missing)
+        self.hits += len(words) - len(missing)
+
+        result = []
+        for word in words:
+            self.entries.move_to_end(word)
+            result.append(self.entries[word])
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return result
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return "{} lookups, {:.1%} hits, {} words cached".format(
+            self.hits + self.misses, self.hit_rate(), len(self.entries)
+        )
+
+    def save(self):
+        """Writes the memo next to the final file and renames it into place."""
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = "{}.tmp-{}".format(self.path, os.getpid())
+        with open(tmp_path, "wb") as writer:
+            pickle.dump(dict(self.entries), writer, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+
+# The tokenizer (and subword cache) of a conversion worker process, sent once by the pool initializer instead of
+# with every shard
+_worker_tokenizer = None
+_worker_subword_cache = None
+
+
+def _init_conversion_worker(tokenizer, subword_cache=None):
+    global _worker_tokenizer, _worker_subword_cache
+    _worker_tokenizer = tokenizer
+    _worker_subword_cache = subword_cache
+
+
+def _convert_shard(shard):
+    convert_fn, examples, label_list, max_seq_length, kwargs = shard
+    logging.disable(logging.INFO)  # The shards would log their first examples again
+    if _worker_subword_cache is not None:
+        kwargs = dict(kwargs, subword_cache=_worker_subword_cache)
+    return convert_fn(examples, label_list, max_seq_length, _worker_tokenizer, **kwargs)
+
+
+def convert_examples_to_features_parallel(
+    convert_fn,
+    examples,
+    label_list,
+    max_seq_length,
+    tokenizer,
+    num_workers=None,
+    shards_per_worker=4,
+    subword_cache=None,
+    **kwargs
+):
+    """ Runs `convert_fn` (`convert_examples_to_features_fast` or a task's `convert_examples_to_features`)
+        over contiguous shards of `examples` in a pool of `num_workers` processes, each holding its own copy of
+        the tokenizer.
+
+        Every example is converted independently, and the shards are merged back in their original order, so
+        the features are the same as those of a single `convert_fn` call. With `num_workers` of None or 1, or
+        fewer examples than shards, `convert_fn` simply runs in this process.
+
+        A `subword_cache` is passed on to `convert_examples_to_features_fast`. Every worker starts from a copy of
+        it, the words the workers add are not merged back.
+    """
+    num_shards = (num_workers or 1) * shards_per_worker
+    if not num_workers or num_workers <= 1 or len(examples) < num_shards:
+        if subword_cache is not None:
+            kwargs["subword_cache"] = subword_cache
+        return convert_fn(examples, label_list, max_seq_length, tokenizer, **kwargs)
+
+    shard_size = -(-len(examples) // num_shards)
+    shards = [
+        (convert_fn, examples[start : start + shard_size], label_list, max_seq_length, kwargs)
+        for start in range(0, len(examples), shard_size)
+    ]
+    logger.info("Converting %d examples in %d shards with %d workers", len(examples), len(shards), num_workers)
+    pool = multiprocessing.Pool(num_workers, initializer=_init_conversion_worker, initargs=(tokenizer, subword_cache))
+    with pool:
+        features = []
+        # imap yields the shards in submission order whatever order the workers finish them in
+        for shard_start, shard_features in zip(range(0, len(examples), shard_size), pool.imap(_convert_shard, shards)):
+            for feature in shard_features:
+                # Example indices are counted from the start of the shard
+                if getattr(feature, "example_index", None) is not None:
+                    feature.example_index += shard_start
+            features.extend(shard_features)
+    return features
@@ -16,8 +16,12 @@
 """ Named entity recognition fine-tuning: utilities to work with CoNLL-2003 task. """
 
 
+import json
 import logging
-import os
+
+import numpy as np
+
+from utils_data import find_data_file, open_data_file, read_data_file
 
 
 logger = logging.getLogger(__name__)
@@ -42,17 +46,181 @@ class InputExample(object):
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_ids):
+    def __init__(self, input_ids, input_mask, segment_ids, label_ids, example_index=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
         self.label_ids = label_ids
+        # Index of the source example, several features share it when a long example is split into windows
+        self.example_index = example_index
+
+
+# bytes.strip() whitespace
+_ASCII_WHITESPACE = np.zeros(256, dtype=bool)
+_ASCII_WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+# First and last UTF-8 bytes of the other characters str.strip() removes, lines starting or ending with one are
+# stripped as text
+_UNICODE_WHITESPACE = [chr(c) for c in [0x1C, 0x1D, 0x1E, 0x1F, 0x85, 0xA0, 0x1680, 0x2028, 0x2029, 0x202F, 0x205F]]
+_UNICODE_WHITESPACE += [chr(c) for c in range(0x2000, 0x200B)] + [chr(0x3000)]
+_UNICODE_WHITESPACE_FIRST = np.zeros(256, dtype=bool)
+_UNICODE_WHITESPACE_FIRST[[c.encode("utf-8")[0] for c in _UNICODE_WHITESPACE]] = True
+_UNICODE_WHITESPACE_LAST = np.zeros(256, dtype=bool)
+_UNICODE_WHITESPACE_LAST[[c.encode("utf-8")[-1] for c in _UNICODE_WHITESPACE]] = True
+
+
+class CoNLLCorpus(object):
+    """A parsed CoNLL file stored as flat arrays.
+
+    `word_buffer` holds every word, UTF-8 encoded and separated by single spaces (words never contain one),
+    word `i` starting at `word_offsets[i]`. `label_ids` index into `label_list` and `sentence_offsets[s]` is
+    the index of the first word of sentence `s`. Indexing or iterating yields `InputExample`s built on the fly,
+    so the corpus can be passed wherever a list of examples is expected.
+    """
+
+    __slots__ = ("mode", "word_buffer", "word_offsets", "label_ids", "label_list", "sentence_offsets")
+
+    def __init__(self, mode, word_buffer, word_offsets, label_ids, label_list, sentence_offsets):
+        self.mode = mode
+        self.word_buffer = word_buffer
+        self.word_offsets = word_offsets
+        self.label_ids = label_ids
+        self.label_list = label_list
+        self.sentence_offsets = sentence_offsets
+
+    def __len__(self):
+        return len(self.sentence_offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("sentence index out of range")
+        return InputExample(
+            guid="{}-{}".format(self.mode, index + 1), words=self.words(index), labels=self.labels(index)
+        )
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def sentence_lengths(self):
+        """Number of words of every sentence."""
+        return np.diff(self.sentence_offsets)
+
+    def words(self, index):
+        first, last = self.sentence_offsets[index], self.sentence_offsets[index + 1]
+        # Drop the separator after the last word
+        return self.word_buffer[self.word_offsets[first] : self.word_offsets[last] - 1].decode("utf-8").split(" ")
+
+    def labels(self, index):
+        first, last = self.sentence_offsets[index], self.sentence_offsets[index + 1]
+        return [self.label_list[label_id] for label_id in self.label_ids[first:last].tolist()]
+
+
+def _intern_fields(buffer, starts, ends):
+    """ Maps the byte strings `buffer[starts[i]:ends[i]]` to ids in order of first appearance.
+
+        Returns the ids and the distinct byte strings.
+    """
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64), []
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1)
+    offsets = np.arange(width)
+    padded = np.where(offsets < lengths[:, None], buffer[np.minimum(starts[:, None] + offsets, len(buffer) - 1)], 0)
+    # Fixed width byte strings, labels never contain NUL bytes
+    fields = np.ascontiguousarray(padded.astype(np.uint8)).view("S{}".format(width)).ravel()
+    values, first_index, inverse = np.unique(fields, return_index=True, return_inverse=True)
+    order = np.argsort(first_index)
+    ranks = np.empty_like(order)
+    ranks[order] = np.arange(len(order))
+    return ranks[inverse.ravel()], [bytes(value) for value in values[order]]
+
+
+def read_conll_corpus(file_path, mode, default_label="O"):
+    """ Reads a CoNLL file (`word ... label` per line, sentences separated by blank lines) in one binary pass.
+
+        Lines are split exactly as in the text based readers: a stripped line shorter than two characters ends
+        the sentence, the word is the first space separated field and the label the last one, `default_label`
+        if there is only one field. Line boundaries, stripping and fields are found with array operations on
+        the raw bytes, only lines that may start or end with non-ASCII whitespace are stripped as text.
+        `.gz` and `.zst` files are decompressed while they are read.
+    """
+    data = read_data_file(file_path)
+    if b"\r" in data:
+        # Same newlines as a file opened in text mode
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    # The default label goes after the last line, so label-less lines can point at it
+    data += b"\n" + default_label.encode("utf-8")
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    newlines = np.flatnonzero(buffer == ord("\n"))
+    line_starts = np.concatenate([[0], newlines[:-1] + 1])
+    line_ends = newlines
+
+    # Strip every line: first and last non-whitespace byte within it
+    content_bytes = np.flatnonzero(~_ASCII_WHITESPACE[buffer])
+    content_bytes = np.append(content_bytes, len(buffer))
+    starts = np.minimum(content_bytes[np.searchsorted(content_bytes, line_starts)], line_ends)
+    ends = np.where(starts < line_ends, content_bytes[np.searchsorted(content_bytes, line_ends) - 1] + 1, starts)
+
+    non_empty = np.flatnonzero(starts < ends)
+    edges = _UNICODE_WHITESPACE_FIRST[buffer[starts[non_empty]]] | _UNICODE_WHITESPACE_LAST[buffer[ends[non_empty] - 1]]
+    for line in non_empty[edges].tolist():
+        text = data[starts[line] : ends[line]].decode("utf-8")
+        stripped = text.strip()
+        starts[line] += len(text[: len(text) - len(text.lstrip())].encode("utf-8"))
+        ends[line] = starts[line] + len(stripped.encode("utf-8"))
+
+    # Lines shorter than two characters separate sentences, count characters (not UTF-8 continuation bytes)
+    # of the few lines where that differs from the byte length
+    lengths = ends - starts
+    short = np.flatnonzero((lengths >= 2) & (lengths < 5))
+    short_bytes = buffer[starts[short, None] + np.arange(4)]
+    short_lead_bytes = ((short_bytes & 0xC0) != 0x80) & (np.arange(4) < lengths[short, None])
+    lengths[short] = short_lead_bytes.sum(axis=1)
+    content = np.flatnonzero(lengths >= 2)
+    starts, ends = starts[content], ends[content]
+    sentence_offsets = np.append(np.flatnonzero(np.diff(content, prepend=-2) != 1), len(content)).astype(np.int64)
+
+    # The word is the first field, the label the last one
+    spaces = np.append(np.flatnonzero(buffer == ord(" ")), len(buffer))
+    word_ends = np.minimum(spaces[np.searchsorted(spaces, starts)], ends)
+    last_spaces = np.searchsorted(spaces, ends) - 1
+    has_label = (last_spaces >= 0) & (spaces[last_spaces] > starts)
+    label_starts = np.where(has_label, spaces[last_spaces] + 1, newlines[-1] + 1)
+    label_ends = np.where(has_label, ends, len(buffer))
+    label_ids, label_vocab = _intern_fields(buffer, label_starts, label_ends)
+
+    # Copy the words, each followed by a space, with a single gather
+    word_lengths = word_ends - starts
+    word_offsets = np.concatenate([[0], np.cumsum(word_lengths + 1)]).astype(np.int64)
+    word_buffer = np.full(word_offsets[-1], ord(" "), dtype=np.uint8)
+    first_bytes = np.cumsum(word_lengths) - word_lengths
+    word_positions = np.arange(word_lengths.sum()) + np.repeat(word_offsets[:-1] - first_bytes, word_lengths)
+    word_buffer[word_positions] = buffer[np.repeat(starts - word_offsets[:-1], word_lengths) + word_positions]
+
+    label_dtype = np.int32
+    for dtype in [np.uint8, np.uint16]:
+        if len(label_vocab) <= np.iinfo(dtype).max + 1:
+            label_dtype = dtype
+            break
+    return CoNLLCorpus(
+        mode=mode,
+        word_buffer=word_buffer.tobytes(),
+        word_offsets=word_offsets,
+        label_ids=label_ids.astype(label_dtype),
+        label_list=[label.decode("utf-8") for label in label_vocab],
+        sentence_offsets=sentence_offsets,
+    )
 
 
 def read_examples_from_file_flexible(file_path, mode):
     guid_index = 1
     examples = []
-    with open(file_path, encoding="utf-8") as f:
+    with open_data_file(file_path, "rt") as f:
         words = []
         labels = []
         for line in f:
@@ -76,32 +244,8 @@ def read_examples_from_file_flexible(file_path, mode):
 
 
 def read_examples_from_file(data_dir, mode):
-    file_path = os.path.join(data_dir, "{}.txt".format(mode))
-    guid_index = 1
-    examples = []
-    with open(file_path, encoding="utf-8") as f:
-        words = []
-        labels = []
-        for line in f:
-            line = line.strip()
-            if len(line) < 2  or line == "\n":
-                #print(line, words)
-                if words:
-                    examples.append(InputExample(guid="{}-{}".format(mode, guid_index), words=words, labels=labels))
-                    guid_index += 1
-                    words = []
-                    labels = []
-            else:
-                splits = line.split(" ")
-                words.append(splits[0])
-                if len(splits) > 1:
-                    labels.append(splits[-1].replace("\n", ""))
-                else:
-                    # Examples could have no label for mode = "test"
-                    labels.append("O")
-        if words:
-            examples.append(InputExample(guid="{}-{}".format(mode, guid_index), words=words, labels=labels))
-    return examples
+    file_path = find_data_file(data_dir, "{}.txt".format(mode))
+    return read_conll_corpus(file_path, mode, default_label="O")
 
 
 def convert_examples_to_features(
@@ -120,12 +264,15 @@ def convert_examples_to_features(
     pad_token_label_id=-100,
     sequence_a_segment_id=0,
     mask_padding_with_zero=True,
+    pad_to_max_length=True,
 ):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `pad_to_max_length` pads every feature to `max_seq_length`, set it to False to store unpadded
+        features and pad per batch with `utils_data.DynamicPaddingCollator`
     """
 
     label_map = {label: i for i, label in enumerate(label_list)}
@@ -192,7 +339,7 @@ def convert_examples_to_features(
         input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
 
         # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
+        padding_length = max_seq_length - len(input_ids) if pad_to_max_length else 0
         if pad_on_left:
             input_ids = ([pad_token] * padding_length) + input_ids
             input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
@@ -204,11 +351,11 @@ def convert_examples_to_features(
             segment_ids += [pad_token_segment_id] * padding_length
             label_ids += [pad_token_label_id] * padding_length
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+        assert len(input_mask) == len(input_ids)
+        assert len(segment_ids) == len(input_ids)
+        assert not pad_to_max_length or len(input_ids) == max_seq_length
         try:
-            assert len(label_ids) == max_seq_length
+            assert len(label_ids) == len(input_ids)
         except:
             continue
 
@@ -222,7 +369,13 @@ def convert_examples_to_features(
             logger.info("label_ids: %s", " ".join([str(x) for x in label_ids]))
 
         features.append(
-            InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_ids=label_ids)
+            InputFeatures(
+                input_ids=input_ids,
+                input_mask=input_mask,
+                segment_ids=segment_ids,
+                label_ids=label_ids,
+                example_index=ex_index,
+            )
         )
     return features
 
@@ -236,4 +389,83 @@ def get_labels(path):
             labels = ["O"] + labels
         return labels
     else:
-        return ["O", "B-DATE", "I-DATE", "B-PER", "I-PER", "B-ORG", "I-ORG", "B-LOC", "I-LOC"]
\ No newline at end of file
+        return ["O", "B-DATE", "I-DATE", "B-PER", "I-PER", "B-ORG", "I-ORG", "B-LOC", "I-LOC"]
+
+PREDICTION_FORMATS = ["conll", "jsonl", "arrow"]
+
+
+def write_predictions(
+    corpus, predictions, output_file, output_format="conll", probabilities=None, label_list=None, buffer_size=1 << 20
+):
+    """ Writes the predicted labels of the sentences of a `CoNLLCorpus`, in corpus order.
+
+        `conll` writes `word label` lines with a blank line after every sentence. `jsonl` writes one object per
+        sentence with its guid, words, gold labels, predicted labels and, given `probabilities` (one
+        `(num_words, num_labels)` array per sentence, columns ordered like `label_list`), a `{label: probability}`
+        mapping per word. `arrow` writes the same columns to an Arrow IPC file, the probabilities as a list of
+        floats per word and `label_list` in the schema metadata; it needs `pyarrow`.
+
+        `predictions` (and `probabilities`) hold one entry per corpus sentence, indexed like the corpus, as
+        returned by `stitch_windows`; a sentence the feature conversion dropped has an empty entry. Words past the
+        end of a sentence's predictions (truncated by `max_seq_length`, or dropped) are left out with a warning.
+    """
+    if output_format not in PREDICTION_FORMATS:
+        raise ValueError("Unknown prediction format {}, expected one of {}".format(output_format, PREDICTION_FORMATS))
+    if output_format != "conll" and probabilities is not None and label_list is None:
+        raise ValueError("label_list is required to write probabilities")
+
+    def sentences():
+        for index in range(len(corpus)):
+            words = corpus.words(index)
+            sentence_predictions = predictions[index] if index < len(predictions) else []
+            if len(sentence_predictions) < len(words):
+                logger.warning(
+                    "Maximum sequence length exceeded: No prediction for the last %d words of '%s'.",
+                    len(words) - len(sentence_predictions),
+                    " ".join(words),
+                )
+            num_words = min(len(words), len(sentence_predictions))
+            sentence_probabilities = None
+            if probabilities is not None and index < len(probabilities):
+                sentence_probabilities = np.asarray(probabilities[index], dtype=np.float32)[:num_words]
+            yield index, words[:num_words], sentence_predictions[:num_words], sentence_probabilities
+
+    if output_format == "conll":
+        with open(output_file, "w", encoding="utf-8", buffering=buffer_size) as writer:
+            for _, words, sentence_predictions, _ in sentences():
+                writer.write("".join("{} {}\n".format(w, p) for w, p in zip(words, sentence_predictions)) + "\n")
+    elif output_format == "jsonl":
+        with open(output_file, "w", encoding="utf-8", buffering=buffer_size) as writer:
+            for index, words, sentence_predictions, sentence_probabilities in sentences():
+                record = {
+                    "guid": "{}-{}".format(corpus.mode, index + 1),
+                    "words": words,
+                    "labels": corpus.labels(index)[: len(words)],
+                    "predictions": sentence_predictions,
+                }
+                if sentence_probabilities is not None:
+                    record["probabilities"] = [
+                        dict(zip(label_list, (round(p, 6) for p in row.tolist()))) for row in sentence_probabilities
+                    ]
+                writer.write(json.dumps(record, ensure_ascii=False) + "\n")
+    else:
+        import pyarrow as pa
+
+        columns = {"guid": [], "words": [], "labels": [], "predictions": []}
+        if probabilities is not None:
+            columns["probabilities"] = []
+        for index, words, sentence_predictions, sentence_probabilities in sentences():
+            columns["guid"].append("{}-{}".format(corpus.mode, index + 1))
+            columns["words"].append(words)
+            columns["labels"].append(corpus.labels(index)[: len(words)])
+            columns["predictions"].append(sentence_predictions)
+            if probabilities is not None:
+                columns["probabilities"].append(
+                    sentence_probabilities.tolist() if sentence_probabilities is not None else []
+                )
+        table = pa.table(columns)
+        if probabilities is not None:
+            table = table.replace_schema_metadata({"label_list": json.dumps(label_list)})
+        with pa.OSFile(output_file, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
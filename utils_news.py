@@ -17,9 +17,10 @@
 
 
 import logging
-import os
 import pandas as pd
 
+from utils_data import find_data_file, open_data_file
+
 
 logger = logging.getLogger(__name__)
 
@@ -50,54 +51,59 @@ class InputFeatures(object):
         self.label_ids = label_ids
 
 
-def read_examples_from_file(args, data_dir, mode, delimiter="\t"):
-    file_path = os.path.join(data_dir, "{}.tsv".format(mode))
-    examples = []
+def read_examples_from_file(args, data_dir, mode, delimiter="\t", text_column="text", label_column="category"):
+    file_path = find_data_file(data_dir, "{}.tsv".format(mode))
+
+    # Only parse the two columns we use, the headline and url columns are not needed
+    with open_data_file(file_path) as f:
+        line_data = pd.read_csv(f, sep=delimiter, usecols=[text_column, label_column], dtype=str, keep_default_na=False)
+
+    texts = line_data[text_column].values
+    labels = line_data[label_column].values
 
-    line_data  = pd.read_csv(file_path, sep=delimiter)
+    return [InputExample(text_, label_) for text_, label_ in zip(texts, labels)]
 
-    texts = line_data['text'].values
-    labels = line_data['category'].values
-    headlines  = line_data['headline'].values
 
-    for text_, label_ in zip(texts, labels):
-        examples.append(InputExample(text_, label_))
+def convert_examples_to_features(instances, tokenizer, labels, max_seq_length, batch_size=1000):
+    """ Tokenizes the texts `batch_size` at a time, one call into the Rust tokenizer per batch for fast
+        tokenizers, and truncates them to `max_seq_length`.
 
-    return examples
-def convert_examples_to_features(instances, tokenizer, labels, max_seq_length):
+        Features are not padded, `utils_data.DynamicPaddingCollator` pads every batch to its longest sequence,
+        so `input_mask` is left out. Instances whose label is not in `labels` are skipped.
+    """
     label_map = {label: i for i, label in enumerate(labels)}
+    instances = [instance for instance in instances if instance.labels in label_map]
 
     features = []
-    for instance_idx, instance in enumerate(instances):
-        tokenization_result = tokenizer.encode_plus(text=instance.texts,
-                                                    max_length=max_seq_length, pad_to_max_length=True,
-                                                     truncation=True)
-        token_ids = tokenization_result["input_ids"]
-        try:
-            token_type_ids = tokenization_result["token_type_ids"]
-        except:
-            token_type_ids = None
-        attention_masks = tokenization_result["attention_mask"]
-
-        if instance.labels not in label_map:
-            continue
-        label = label_map[instance.labels]
-
-        if "num_truncated_tokens" in tokenization_result:
-            logger.info(f"Removed {tokenization_result['num_truncated_tokens']} tokens from {instance.text} as they "
-                         f"were longer than max_seq_length {max_seq_length}.")
-
-        if instance_idx < 3:
-            logger.info("Tokenization example")
-            logger.info(f"  text: {instance.texts}")
-            logger.info(f"  tokens (by input): {tokenizer.tokenize(instance.texts)}")
-            logger.info(f"  token_ids: {tokenization_result['input_ids']}")
-            # logger.info(f"  token_type_ids: {tokenization_result['token_type_ids']}")
-            logger.info(f"  attention mask: {tokenization_result['attention_mask']}")
-
-        features.append(
-            InputFeatures(input_ids=token_ids, input_mask=attention_masks, segment_ids=token_type_ids, label_ids=label)
+    for batch_start in range(0, len(instances), batch_size):
+        logger.info("Writing example %d of %d", batch_start, len(instances))
+        batch = instances[batch_start : batch_start + batch_size]
+        tokenization_result = tokenizer(
+            [instance.texts for instance in batch],
+            max_length=max_seq_length,
+            truncation=True,
+            return_attention_mask=False,
         )
+        token_type_ids = tokenization_result.get("token_type_ids")
+
+        for batch_index, instance in enumerate(batch):
+            instance_idx = batch_start + batch_index
+            token_ids = tokenization_result["input_ids"][batch_index]
+
+            if instance_idx < 3:
+                logger.info("Tokenization example")
+                logger.info(f"  text: {instance.texts}")
+                logger.info(f"  tokens (by input): {tokenizer.convert_ids_to_tokens(token_ids)}")
+                logger.info(f"  token_ids: {token_ids}")
+
+            features.append(
+                InputFeatures(
+                    input_ids=token_ids,
+                    input_mask=None,
+                    segment_ids=token_type_ids[batch_index] if token_type_ids is not None else None,
+                    label_ids=label_map[instance.labels],
+                )
+            )
 
     return features
 
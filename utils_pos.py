@@ -17,7 +17,9 @@
 
 
 import logging
-import os
+
+from utils_data import find_data_file
+from utils_ner import read_conll_corpus
 
 
 logger = logging.getLogger(__name__)
@@ -42,45 +44,17 @@ class InputExample(object):
 class InputFeatures(object):
     """A single set of features of data."""
 
-    def __init__(self, input_ids, input_mask, segment_ids, label_ids):
+    def __init__(self, input_ids, input_mask, segment_ids, label_ids, example_index=None):
         self.input_ids = input_ids
         self.input_mask = input_mask
         self.segment_ids = segment_ids
         self.label_ids = label_ids
+        self.example_index = example_index
 
 
 def read_examples_from_file(data_dir, mode):
-    file_path = os.path.join(data_dir, "{}.txt".format(mode))
-    guid_index = 1
-    examples = []
-    with open(file_path, encoding="utf-8") as f:
-        words = []
-        labels = []
-        for line in f:
-            line = line.strip()
-            #print(line)
-            if len(line) < 2  or line == "\n":
-                #print(line, words)
-                if len(words) <1:
-                    print(guid_index)
-                    print(line, words)
-                if words:
-                    #print(guid_index, words)
-                    examples.append(InputExample(guid="{}-{}".format(mode, guid_index), words=words, labels=labels))
-                    guid_index += 1
-                    words = []
-                    labels = []
-            else:
-                splits = line.split(" ")
-                words.append(splits[0])
-                if len(splits) > 1:
-                    labels.append(splits[-1].replace("\n", ""))
-                else:
-                    # Examples could have no label for mode = "test"
-                    labels.append("X")
-        if words:
-            examples.append(InputExample(guid="{}-{}".format(mode, guid_index), words=words, labels=labels))
-    return examples
+    file_path = find_data_file(data_dir, "{}.txt".format(mode))
+    return read_conll_corpus(file_path, mode, default_label="X")
 
 
 def convert_examples_to_features(
@@ -99,12 +73,15 @@ def convert_examples_to_features(
     pad_token_label_id=-100,
     sequence_a_segment_id=0,
     mask_padding_with_zero=True,
+    pad_to_max_length=True,
 ):
     """ Loads a data file into a list of `InputBatch`s
         `cls_token_at_end` define the location of the CLS token:
             - False (Default, BERT/XLM pattern): [CLS] + A + [SEP] + B + [SEP]
             - True (XLNet/GPT pattern): A + [SEP] + B + [SEP] + [CLS]
         `cls_token_segment_id` define the segment id associated to the CLS token (0 for BERT, 2 for XLNet)
+        `pad_to_max_length` pads every feature to `max_seq_length`, set it to False to store unpadded
+        features and pad per batch with `utils_data.DynamicPaddingCollator`
     """
 
     label_map = {label: i for i, label in enumerate(label_list)}
@@ -171,7 +148,7 @@ def convert_examples_to_features(
         input_mask = [1 if mask_padding_with_zero else 0] * len(input_ids)
 
         # Zero-pad up to the sequence length.
-        padding_length = max_seq_length - len(input_ids)
+        padding_length = max_seq_length - len(input_ids) if pad_to_max_length else 0
         if pad_on_left:
             input_ids = ([pad_token] * padding_length) + input_ids
             input_mask = ([0 if mask_padding_with_zero else 1] * padding_length) + input_mask
@@ -183,11 +160,11 @@ def convert_examples_to_features(
             segment_ids += [pad_token_segment_id] * padding_length
             label_ids += [pad_token_label_id] * padding_length
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+        assert len(input_mask) == len(input_ids)
+        assert len(segment_ids) == len(input_ids)
+        assert not pad_to_max_length or len(input_ids) == max_seq_length
         try:
-            assert len(label_ids) == max_seq_length
+            assert len(label_ids) == len(input_ids)
         except:
             continue
 
@@ -201,7 +178,13 @@ def convert_examples_to_features(
             logger.info("label_ids: %s", " ".join([str(x) for x in label_ids]))
 
         features.append(
-            InputFeatures(input_ids=input_ids, input_mask=input_mask, segment_ids=segment_ids, label_ids=label_ids)
+            InputFeatures(
+                input_ids=input_ids,
+                input_mask=input_mask,
+                segment_ids=segment_ids,
+                label_ids=label_ids,
+                example_index=ex_index,
+            )
         )
     return features
 
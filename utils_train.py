@@ -0,0 +1,509 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HuggingFace Inc. team.
+# Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Helpers shared by the hand-written adapter training and evaluation loops. """
+
+
+import contextlib
+import copy
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+AMP_MODES = ["off", "fp16", "bf16"]
+
+
+def amp_autocast(args):
+    """Returns the autocast context for the forward pass and loss under `--amp`, a no-op context when it is off."""
+    if args.amp == "off":
+        return contextlib.nullcontext()
+    if args.amp == "fp16" and args.device.type != "cuda":
+        raise ValueError("--amp fp16 needs a CUDA device, use --amp bf16 on CPU")
+    dtype = torch.float16 if args.amp == "fp16" else torch.bfloat16
+    return torch.autocast(device_type=args.device.type, dtype=dtype)
+
+
+def amp_grad_scaler(args):
+    """ Returns the loss scaler for `--amp fp16`.
+
+        For fp32 and bf16 (which has the fp32 exponent range) the scaler is disabled, so `scale()`, `unscale_()`
+        and `step()` pass straight through and the training loop is the same for every mode.
+    """
+    try:
+        return torch.amp.GradScaler("cuda", enabled=args.amp == "fp16")
+    except AttributeError:
+        # torch < 2.3 only has the CUDA-specific scaler
+        return torch.cuda.amp.GradScaler(enabled=args.amp == "fp16")
+
+
+NO_DECAY = ["bias", "LayerNorm.weight"]
+
+
+def build_optimizer(model, args):
+    """ Returns an AdamW over the trainable parameters only, and the flat list of those parameters.
+
+        Must be called after `model.train_adapter(...)`. The parameters are collected once, so neither the
+        optimizer nor `clip_grad_norm_` walks the frozen backbone at every step. The step is torch's fused
+        AdamW where the device has it and the multi-tensor (foreach) one otherwise; both update every
+        parameter of a group with a few kernel launches instead of a Python loop over the parameters.
+    """
+    decay, no_decay = [], []
+    for name, param in model.named_parameters():
+        if param.requires_grad:
+            (no_decay if any(nd in name for nd in NO_DECAY) else decay).append(param)
+    groups = [
+        {"params": params, "weight_decay": weight_decay}
+        for params, weight_decay in [(decay, args.weight_decay), (no_decay, 0.0)]
+        if params
+    ]
+    try:
+        optimizer = torch.optim.AdamW(groups, lr=args.learning_rate, eps=args.adam_epsilon, fused=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.0 has no fused AdamW, older 2.x only fuse on CUDA
+        optimizer = torch.optim.AdamW(groups, lr=args.learning_rate, eps=args.adam_epsilon, foreach=True)
+    params = decay + no_decay
+    logger.info("Optimizing %d trainable tensors (%d parameters)", len(params), sum(p.numel() for p in params))
+    return optimizer, params
+
+
+def clip_grad_norm_(parameters, max_norm):
+    """`torch.nn.utils.clip_grad_norm_` over a precomputed list of parameters, with the foreach kernels."""
+    try:
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm, foreach=True)
+    except (TypeError, RuntimeError):
+        # torch < 2.0 has no foreach argument, older 2.x have no foreach norm on CPU
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm)
+
+
+def init_distributed(args):
+    """ Sets `args.device` and `args.n_gpu`, and joins the process group of a distributed job.
+
+        A job is distributed when `--local_rank` is set or, under `torchrun`, `LOCAL_RANK` is in the environment.
+        Every process then drives one GPU through NCCL, or, with `--no_cuda` or without GPUs, its share of the
+        host's cores through gloo.
+    """
+    if args.local_rank == -1:
+        args.device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+        args.n_gpu = torch.cuda.device_count() if args.device.type == "cuda" else 0
+        return
+    if torch.cuda.is_available() and not args.no_cuda:
+        torch.cuda.set_device(args.local_rank)
+        args.device = torch.device("cuda", args.local_rank)
+        args.n_gpu = 1
+        backend = "nccl"
+    else:
+        args.device = torch.device("cpu")
+        args.n_gpu = 0
+        backend = "gloo"
+        # Otherwise every rank of a host starts one thread per core
+        local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+    torch.distributed.init_process_group(backend=backend)
+    rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    logger.info("Rank %d of %d on %s (%s)", rank, world_size, args.device, backend)
+
+
+def is_main_process(args):
+    """True on the process that logs and writes checkpoints: the only one, or global rank 0 of a distributed job."""
+    if args.local_rank == -1:
+        return True
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank() == 0
+    return int(os.environ.get("RANK", args.local_rank)) == 0
+
+
+def wrap_distributed(model, args):
+    """ Wraps `model` in `DistributedDataParallel` over its trainable parameters only.
+
+        Must be called after `model.train_adapter(...)`. The frozen parameters and the buffers are left out of
+        DDP, so the backbone is neither broadcast at construction nor bucketed, and only the adapter and head
+        gradients are all-reduced. Returns `model` unchanged outside of a distributed job.
+    """
+    if args.local_rank == -1:
+        return model
+    frozen = [name for name, param in model.named_parameters() if not param.requires_grad]
+    frozen += [name for name, _ in model.named_buffers()]
+    torch.nn.parallel.DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(model, frozen)
+    return torch.nn.parallel.DistributedDataParallel(
+        model,
+        device_ids=[args.local_rank] if args.device.type == "cuda" else None,
+        output_device=args.local_rank if args.device.type == "cuda" else None,
+        # Heads loaded with the adapter are trainable but not run by the active head
+        find_unused_parameters=True,
+    )
+
+
+def gradient_sync(model, sync):
+    """ Context for the forward and backward pass of one micro-batch.
+
+        Inside gradient accumulation (`sync` False) a `DistributedDataParallel` model skips the all-reduce and
+        only accumulates locally, the gradients are reduced once on the last micro-batch.
+    """
+    if sync or not isinstance(model, torch.nn.parallel.DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+def distributed_shard(args):
+    """ `(num_shards, shard)` of this process: `(world_size, rank)` in a distributed job, `(1, 0)` otherwise.
+
+        Every rank evaluates its own shard of a split (`ShardedEvalSampler`) and converts its own shard of the
+        examples on a feature cache miss (`FeatureCache`).
+    """
+    if args.local_rank == -1:
+        return 1, 0
+    return torch.distributed.get_world_size(), torch.distributed.get_rank()
+
+
+def all_gather_variable(tensor):
+    """ Concatenates, in rank order, a tensor from every rank whose first dimension differs between ranks.
+
+        The other dimensions and the dtype must agree. The shards are padded to the longest one for the
+        all-gather (which needs equal shapes) and trimmed again. Returns `tensor` outside of a distributed job.
+    """
+    if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+        return tensor
+    world_size = torch.distributed.get_world_size()
+    size = torch.tensor([tensor.shape[0]], dtype=torch.long, device=tensor.device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    torch.distributed.all_gather(sizes, size)
+    sizes = [int(s) for s in sizes]
+    if max(sizes) == 0:
+        return tensor
+    padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]))
+    padded[: tensor.shape[0]] = tensor
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    torch.distributed.all_gather(gathered, padded)
+    return torch.cat([shard[:n] for shard, n in zip(gathered, sizes)])
+
+
+def all_reduce_sum(args, *values):
+    """Sums Python numbers over the ranks of a distributed job, returns them unchanged otherwise."""
+    if args.local_rank == -1:
+        return values
+    totals = torch.tensor([float(v) for v in values], dtype=torch.float64, device=args.device)
+    torch.distributed.all_reduce(totals)
+    return tuple(totals.tolist())
+
+
+class PackedTaggingForward(torch.nn.Module):
+    """`tagging_head_logits` as a module, so the packed head can run (and be all-reduced) under DDP."""
+
+    def __init__(self, model, pad_token_label_id=-100):
+        super().__init__()
+        self.model = model
+        self.pad_token_label_id = pad_token_label_id
+
+    def forward(self, input_ids, attention_mask, label_ids):
+        return tagging_head_logits(self.model, input_ids, attention_mask, label_ids, self.pad_token_label_id)
+
+
+FROZEN_DTYPES = ["fp32", "bf16", "fp16", "int8"]
+
+
+class _Int8WeightOnlyLinearFunction(torch.autograd.Function):
+    """Linear layer over an int8 weight that only propagates gradients to its input.
+
+    The weight is dequantized again in backward instead of being saved, so the full precision copy of a
+    frozen weight never outlives the op.
+    """
+
+    @staticmethod
+    def forward(ctx, input, weight, scale, bias):
+        ctx.save_for_backward(weight, scale)
+        output = torch.nn.functional.linear(input, weight.to(input.dtype) * scale.to(input.dtype), None)
+        return output + bias.to(output.dtype) if bias is not None else output
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        weight, scale = ctx.saved_tensors
+        return grad_output.matmul(weight.to(grad_output.dtype) * scale.to(grad_output.dtype)), None, None, None
+
+
+class Int8WeightOnlyLinear(torch.nn.Module):
+    """Frozen `nn.Linear` stored as per-output-channel symmetric int8 weights and an fp32 scale."""
+
+    def __init__(self, linear):
+        super().__init__()
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        self.register_buffer("weight", torch.round(weight / scale).to(torch.int8))
+        self.register_buffer("scale", scale)
+        self.register_buffer("bias", None if linear.bias is None else linear.bias.detach().float())
+
+    def forward(self, input):
+        return _Int8WeightOnlyLinearFunction.apply(input, self.weight, self.scale, self.bias)
+
+
+class Int8WeightOnlyEmbedding(torch.nn.Module):
+    """Frozen `nn.Embedding` stored as per-row symmetric int8 vectors and an fp32 scale."""
+
+    def __init__(self, embedding):
+        super().__init__()
+        weight = embedding.weight.detach().float()
+        scale = weight.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        self.register_buffer("weight", torch.round(weight / scale).to(torch.int8))
+        self.register_buffer("scale", scale)
+        self.padding_idx = embedding.padding_idx
+
+    def forward(self, input):
+        return self.weight[input].float() * self.scale[input]
+
+
+def store_frozen_weights(model, args):
+    """ Stores the parameters that do not require gradients in `args.frozen_dtype`.
+
+        Must be called after `model.train_adapter(...)`, the trainable adapter and head parameters stay in fp32.
+        bf16 and fp16 cast the frozen parameters in place, which relies on `--amp` autocasting the mixed
+        precision ops. int8 replaces the frozen `nn.Linear` and `nn.Embedding` modules with weight-only int8
+        versions that dequantize on the fly; it is meant for CPU nodes, where the fp32 compute is unchanged.
+
+        The conversion is lossy and done once per model: a model whose frozen weights are already stored in
+        `args.frozen_dtype` (e.g. the backbone shared by the runs of `train_adapter_sweep.py`) is left as is.
+    """
+    if args.frozen_dtype in ["bf16", "fp16"] and args.amp != args.frozen_dtype:
+        raise ValueError("--frozen_dtype {0} needs --amp {0}".format(args.frozen_dtype))
+
+    model = model.module if hasattr(model, "module") else model
+    stored_dtype = getattr(model, "frozen_dtype", "fp32")
+    if stored_dtype == args.frozen_dtype:
+        return model
+    if stored_dtype != "fp32":
+        raise ValueError("The frozen weights are already stored in {}".format(stored_dtype))
+    if args.frozen_dtype == "int8":
+        frozen_modules = [
+            (name, module)
+            for name, module in model.named_modules()
+            if isinstance(module, (torch.nn.Linear, torch.nn.Embedding))
+            and not any(param.requires_grad for param in module.parameters())
+        ]
+        for name, module in frozen_modules:
+            parent_name, _, child_name = name.rpartition(".")
+            parent = model.get_submodule(parent_name) if parent_name else model
+            if isinstance(module, torch.nn.Linear):
+                setattr(parent, child_name, Int8WeightOnlyLinear(module))
+            else:
+                setattr(parent, child_name, Int8WeightOnlyEmbedding(module))
+    else:
+        dtype = torch.float16 if args.frozen_dtype == "fp16" else torch.bfloat16
+        for param in model.parameters():
+            if not param.requires_grad:
+                param.data = param.data.to(dtype)
+    model.frozen_dtype = args.frozen_dtype
+    logger.info("Stored frozen weights in %s", args.frozen_dtype)
+    return model
+
+
+def save_trained_weights(model, output_dir, args):
+    """ `save_pretrained()` for a full precision backbone.
+
+        After `store_frozen_weights` the backbone is no longer a loadable checkpoint, so only the adapters and
+        heads are saved, to be loaded on top of the original pre-trained model.
+    """
+    if args.frozen_dtype == "fp32":
+        model.save_pretrained(output_dir)
+    else:
+        model.save_all_adapters(output_dir)
+        model.save_all_heads(output_dir)
+
+
+def tagging_head_logits(model, input_ids, attention_mask, label_ids, pad_token_label_id=-100):
+    """ Runs the encoder and the active tagging head on the labelled positions only.
+
+        The encoder still sees the padded batch (with its attention mask), but the hidden states of
+        padding, special tokens and non-first subwords are dropped before the head, so the head and
+        the loss work on a packed `(num_labelled_tokens, hidden_size)` tensor.
+
+        Returns the packed logits and the matching label ids, ready for `CrossEntropyLoss`.
+    """
+    model = model.module if hasattr(model, "module") else model
+    active_positions = label_ids != pad_token_label_id
+
+    sequence_output = model.base_model(input_ids, attention_mask=attention_mask)[0]
+    hidden_states = sequence_output[active_positions]
+    # Prediction heads are `nn.Sequential`s over the sequence output, apply their layers to the packed tokens
+    for layer in model.heads[model.active_head]:
+        hidden_states = layer(hidden_states)
+    return hidden_states, label_ids[active_positions]
+
+
+class TokenPredictionAccumulator(object):
+    """Collects token classification predictions over an evaluation run.
+
+    Only the labelled positions of each batch are kept, as small integer tensors on the model's device,
+    so there is a single device to host copy at the end and no per-batch `np.append`. `decode()` turns
+    them back into per-sentence label sequences with one mask-and-split pass. The label probabilities
+    of the same positions are kept in fp16 if they are passed to `add()`.
+    """
+
+    def __init__(self, num_labels, pad_token_label_id=-100):
+        self.num_labels = num_labels
+        self.pad_token_label_id = pad_token_label_id
+        self.dtype = torch.int8 if num_labels <= torch.iinfo(torch.int8).max else torch.int16
+        self.preds = []
+        self.label_ids = []
+        self.lengths = []
+        self.probabilities = []
+
+    def add(self, preds, label_ids, probabilities=None):
+        """ Adds a batch of predicted label ids, given for every position `(batch, seq_len)` or only for the
+            labelled positions `(num_labelled_tokens,)` as returned by `tagging_head_logits`, and optionally
+            their label probabilities with an extra `num_labels` dimension.
+        """
+        active_positions = label_ids != self.pad_token_label_id
+        if preds.dim() == label_ids.dim():
+            preds = preds[active_positions]
+        self.preds.append(preds.detach().to(self.dtype))
+        self.label_ids.append(label_ids[active_positions].to(self.dtype))
+        self.lengths.append(active_positions.sum(dim=1))
+        if probabilities is not None:
+            if probabilities.dim() == label_ids.dim() + 1:
+                probabilities = probabilities[active_positions]
+            self.probabilities.append(probabilities.detach().to(torch.float16))
+
+    def gather(self, device, probabilities=False):
+        """ Replaces the predictions of this rank's shard (see `ShardedEvalSampler`) by those of all ranks,
+            concatenated in rank order. Every rank must call it, with the same `probabilities` flag.
+        """
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+            return
+
+        def gathered(chunks, empty):
+            return [all_gather_variable(torch.cat(chunks) if chunks else empty)]
+
+        self.preds = gathered(self.preds, torch.empty(0, dtype=self.dtype, device=device))
+        self.label_ids = gathered(self.label_ids, torch.empty(0, dtype=self.dtype, device=device))
+        self.lengths = gathered(self.lengths, torch.empty(0, dtype=torch.long, device=device))
+        if probabilities:
+            empty = torch.empty(0, self.num_labels, dtype=torch.float16, device=device)
+            self.probabilities = gathered(self.probabilities, empty)
+        if not len(self.lengths[0]):
+            self.preds, self.label_ids, self.lengths, self.probabilities = [], [], [], []
+
+    def decode(self, labels):
+        """Returns `(out_label_list, preds_list)`, one list of label strings per evaluated sentence."""
+        if not self.lengths:
+            return [], []
+        label_names = np.asarray(labels, dtype=object)
+        split_points = torch.cat(self.lengths).cumsum(0)[:-1].cpu().numpy()
+        preds = torch.cat(self.preds).cpu().numpy().astype(np.int64)
+        label_ids = torch.cat(self.label_ids).cpu().numpy().astype(np.int64)
+
+        out_label_list = [sentence.tolist() for sentence in np.split(label_names[label_ids], split_points)]
+        preds_list = [sentence.tolist() for sentence in np.split(label_names[preds], split_points)]
+        return out_label_list, preds_list
+
+    def decode_probabilities(self):
+        """Returns one `(num_words, num_labels)` float32 array of label probabilities per evaluated sentence."""
+        if not self.lengths:
+            return []
+        split_points = torch.cat(self.lengths).cumsum(0)[:-1].cpu().numpy()
+        return np.split(torch.cat(self.probabilities).float().cpu().numpy(), split_points)
+
+
+def _detached_cpu_copy(obj):
+    """Recursively copies every tensor in a (nested) state dict to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _detached_cpu_copy(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_detached_cpu_copy(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+TRAINABLE_WEIGHTS_NAME = "trainable_weights.pt"
+
+
+class AdapterCheckpointer(object):
+    """Writes adapter-only checkpoints on a background thread.
+
+    After `model.train_adapter(...)` only the adapter and prediction head require gradients, so a checkpoint
+    holds just those weights (`trainable_weights.pt`, loaded back by `load_trainable_weights`),
+    the optimizer and scheduler state and any extra objects. `save()` takes a CPU snapshot and returns, the
+    files are written to a temporary directory that is renamed into place once complete. Only one write is
+    in flight at a time, and `wait()` must be called before the process exits.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def save(self, output_dir, model, optimizer=None, scheduler=None, **extra):
+        self.wait()
+        model = model.module if hasattr(model, "module") else model
+        snapshot = {
+            TRAINABLE_WEIGHTS_NAME: {
+                name: param.detach().to("cpu", copy=True) for name, param in model.named_parameters() if param.requires_grad
+            }
+        }
+        if optimizer is not None:
+            snapshot["optimizer.pt"] = _detached_cpu_copy(optimizer.state_dict())
+        if scheduler is not None:
+            snapshot["scheduler.pt"] = copy.deepcopy(scheduler.state_dict())
+        for name, obj in extra.items():
+            snapshot["{}.bin".format(name)] = obj
+
+        self._thread = threading.Thread(target=self._write, args=(output_dir, snapshot))
+        self._thread.start()
+
+    def _write(self, output_dir, snapshot):
+        try:
+            tmp_dir = "{}.tmp-{}".format(output_dir.rstrip("/"), os.getpid())
+            os.makedirs(tmp_dir, exist_ok=True)
+            for file_name, obj in snapshot.items():
+                torch.save(obj, os.path.join(tmp_dir, file_name))
+            if os.path.isdir(output_dir):
+                shutil.rmtree(output_dir)
+            os.replace(tmp_dir, output_dir)
+        except Exception as e:  # re-raised on the training thread by wait()
+            self._error = e
+
+    def wait(self):
+        """Blocks until the pending checkpoint is on disk, re-raising any error from the writer thread."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def load_trainable_weights(model, checkpoint_dir):
+    """ Loads the adapter and head weights of an `AdapterCheckpointer` checkpoint into `model`.
+
+        `model` must be the pre-trained model with the same adapters and heads added, as built for training;
+        its other weights are left as they are. Returns `model`.
+    """
+    state_dict = torch.load(os.path.join(checkpoint_dir, TRAINABLE_WEIGHTS_NAME), map_location="cpu")
+    unexpected_keys = model.load_state_dict(state_dict, strict=False).unexpected_keys
+    if unexpected_keys:
+        raise ValueError(
+            "{} holds weights the model does not have: {}".format(checkpoint_dir, ", ".join(unexpected_keys))
+        )
+    logger.info("Loaded %d trainable tensors from %s", len(state_dict), checkpoint_dir)
+    return model
+
+
+def checkpoint_step(checkpoint_dir):
+    """The global step of a `checkpoint-<step>` directory."""
+    return int(os.path.basename(os.path.normpath(checkpoint_dir)).split("-")[-1])